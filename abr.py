@@ -0,0 +1,109 @@
+import struct
+
+from constents import *
+
+
+class Report:
+    """receiver statistics a client sends to the server every REPORT_INTERVAL
+
+    Loss is counted by the client from the frames it finished with, so it
+    does not depend on the server's counters.
+    """
+
+    # Expected Packets, Received Packets, CRC Errors, Good Frames, Lost Frames
+    STRUCT = struct.Struct("<IIIII")
+
+    def __init__(self, values=(0, 0, 0, 0, 0)):
+        (
+            self.expected_packets,
+            self.received_packets,
+            self.CRC_errors,
+            self.good_frames,
+            self.lost_frames,
+        ) = values
+
+    def add_frame(self, expected, received, good):
+        self.expected_packets += expected
+        self.received_packets += min(received, expected)
+        if good:
+            self.good_frames += 1
+        else:
+            self.lost_frames += 1
+
+    def add_CRC_error(self, amount=1):
+        self.CRC_errors += amount
+
+    def get_packet_loss(self) -> float:
+        if self.expected_packets == 0:
+            return 0.0
+        return 1 - float(self.received_packets) / self.expected_packets
+
+    def get_frame_loss(self) -> float:
+        frames = self.good_frames + self.lost_frames
+        if frames == 0:
+            return 0.0
+        return float(self.lost_frames) / frames
+
+    def get_good_frames(self) -> int:
+        return self.good_frames
+
+    def is_empty(self) -> bool:
+        return self.good_frames + self.lost_frames == 0
+
+    def encode(self) -> bytes:
+        return self.STRUCT.pack(
+            self.expected_packets,
+            self.received_packets,
+            self.CRC_errors,
+            self.good_frames,
+            self.lost_frames,
+        )
+
+    @classmethod
+    def decode(cls, body):
+        """:raises ValueError: if the body is too short"""
+        if len(body) < cls.STRUCT.size:
+            raise ValueError("Invalid report {}".format(bytes(body)))
+        return cls(cls.STRUCT.unpack_from(body))
+
+    def __str__(self) -> str:
+        return "Packet Loss: {}%, Frame Loss: {}%, Good Frames: {}".format(
+            self.get_packet_loss() * 100,
+            self.get_frame_loss() * 100,
+            self.good_frames,
+        )
+
+
+class ABRController:
+    """picks a quality level for one client from its reports
+
+    Levels index ABR_LEVELS, higher is better. Loss drops a level right
+    away, a level is only added back after ABR_UP_REPORTS clean reports.
+    """
+
+    def __init__(self, levels=len(ABR_LEVELS), level=None):
+        self.levels = levels
+        self.level = levels - 1 if level is None else level
+        self.clean_reports = 0
+
+    def update(self, report: Report) -> int:
+        if report.is_empty():
+            return self.level
+
+        if (
+            report.get_packet_loss() > ABR_DOWN_PACKET_LOSS
+            or report.get_frame_loss() > ABR_DOWN_FRAME_LOSS
+        ):
+            self.level = max(0, self.level - 1)
+            self.clean_reports = 0
+        elif report.get_frame_loss() <= ABR_UP_FRAME_LOSS:
+            self.clean_reports += 1
+            if self.clean_reports >= ABR_UP_REPORTS:
+                self.level = min(self.levels - 1, self.level + 1)
+                self.clean_reports = 0
+        else:
+            self.clean_reports = 0
+        return self.level
+
+    def get_level(self) -> int:
+        return self.level
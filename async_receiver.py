@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+from codec import PacketView
+from protocol import Agent, Data
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncReceiver(asyncio.DatagramProtocol):
+    """receives packets for an Agent from an asyncio event loop
+
+    Datagrams are decoded and reassembled as they arrive, and next_frame()
+    wakes up as soon as a frame's last missing chunk is received, so a
+    single loop can drive several streams without polling.
+    The same receiver can serve several endpoints of one stream, like its
+    unicast and multicast sockets.
+    """
+
+    def __init__(self, agent: Agent):
+        self.agent = agent
+        self.transports = []
+        self.closed = False
+        self.frame_ready = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.transports.append(transport)
+
+    def datagram_received(self, data, addr):
+        self.agent.get_analytics().add_packets_received()
+        self.agent.get_analytics().add_bytes_received(len(data))
+        if self.agent.handle_packet(PacketView(data)):
+            self.frame_ready.set()
+
+    def error_received(self, exc):
+        logger.warning("Error while receiving: {}".format(exc))
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.frame_ready.set()
+
+    async def next_frame(self):
+        """waits for the newest complete frame
+
+        :return: the frame and its serial, or empty data and -1 once closed
+            or when the last frame should be shown again
+        :rtype: tuple
+        """
+        while not self.closed:
+            data, serial = self.agent.get_last_data()
+            if serial != -1:
+                self.agent.take_repeats()  # The new frame replaces them
+                return data, serial
+            if self.agent.take_repeats():
+                return data, serial
+            self.frame_ready.clear()
+            await self.frame_ready.wait()
+        return Data(b""), -1
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
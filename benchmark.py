@@ -0,0 +1,1195 @@
+import cv2
+import gc
+import os
+import multiprocessing
+import socket
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+from threading import Thread, Condition
+import numpy as np
+
+from constents import *
+from capture import FrameSlot, ChangeDetector
+from pipeline import EncodePipeline
+from decoder import FrameDecoder
+from tiles import TileEncoder
+from strips import StripEncoder
+from tiers import Simulcast
+from shards import SenderPool
+from local import LocalSender, LocalReceiver
+from codec import PacketView, build_flags, build_repeat, encode_into
+from protocol import Agent, Data, FramePool, Packet, PacketizedFrame, get_route_MTU
+
+
+def timeit(func, amount):
+    start_time = time.perf_counter()
+    for _ in range(amount):
+        func()
+    return amount / (time.perf_counter() - start_time)
+
+
+def packet_codec(amount=20000):
+    data = np.random.bytes(RAW_SIZE)
+    payload = "1234567890"
+
+    def old_encode():
+        return Packet(
+            (
+                CHUNK_NORMAL_FLAG,
+                FEC_OFF_FLAG,
+                SEC_OFF_FLAG,
+                np.uint8(3),
+                np.uint16(7),
+                np.uint16(RAW_SIZE - len(payload)),
+                np.uint16(len(payload)),
+                payload,
+                data[: RAW_SIZE - len(payload)],
+            )
+        )
+
+    buffer = bytearray(PACKET_SIZE)
+    view = memoryview(data)
+    flags = build_flags(CHUNK_NORMAL_FLAG, FEC_OFF_FLAG, SEC_OFF_FLAG)
+    encoded_payload = payload.encode()
+
+    def new_encode():
+        encode_into(
+            buffer,
+            flags,
+            3,
+            7,
+            encoded_payload,
+            view[: RAW_SIZE - len(encoded_payload)],
+        )
+
+    new_encode()
+    raw = bytes(buffer)
+    if bytes(old_encode().get_raw()) != raw:
+        print("Codec output is not wire compatible!")
+
+    def old_decode():
+        Packet(raw).is_valid()
+
+    def new_decode():
+        PacketView(raw).is_valid()
+
+    for name, old, new in (
+        ("Encode", old_encode, new_encode),
+        ("Decode", old_decode, new_decode),
+    ):
+        old_rate = timeit(old, amount)
+        new_rate = timeit(new, amount)
+        print("{} Packet: {} packets/s".format(name, old_rate))
+        print("{} PacketView: {} packets/s".format(name, new_rate))
+        print("{} Speedup: {}x".format(name, new_rate / old_rate))
+
+
+def build_packets(
+    data, serial=0, FEC_flag=FEC_OFF_FLAG, FEC_ratio=FEC_RATIO, packet_size=PACKET_SIZE
+):
+    """packetizes data the same way Agent.send_data does"""
+    frame = PacketizedFrame(
+        Data(data), serial, FEC_flag, FEC_ratio=FEC_ratio, packet_size=packet_size
+    )
+    return [bytes(packet) for packet in frame.get_packets()]
+
+
+def reassembly(amount=500, frame_size=400000):
+    packets = [PacketView(raw) for raw in build_packets(np.random.bytes(frame_size))]
+
+    def old_reassembly():
+        chunks = dict()
+        for packet in packets:
+            chunks[str(packet.get_index())] = packet
+        data = b""
+        for i in range(len(chunks)):
+            data += chunks[str(i)].get_data()
+        return data
+
+    pool = FramePool()
+
+    def new_reassembly():
+        packet_list = pool.acquire(0)
+        for packet in packets:
+            packet_list.add_packet(packet)
+        frame = packet_list.get_frame()
+        pool.release(packet_list)
+        return frame
+
+    if bytes(new_reassembly()) != old_reassembly():
+        print("Reassembled frames do not match!")
+
+    old_rate = timeit(old_reassembly, amount)
+    new_rate = timeit(new_reassembly, amount)
+    print("Concatenation: {} frames/s".format(old_rate))
+    print("PacketList: {} frames/s".format(new_rate))
+    print("Speedup: {}x".format(new_rate / old_rate))
+    print("Frame buffers allocated: {}".format(pool.get_allocated()))
+
+
+def large_frames(amount=10, frame_sizes=(1000000, 4000000, 16000000)):
+    """packetizes and reassembles frames past MAX_CHUNKS chunks with version 2 packets"""
+    pool = FramePool()
+    for frame_size in frame_sizes:
+        raw = np.random.bytes(frame_size)
+        try:
+            PacketizedFrame(Data(raw), 0)
+            print("{} bytes: version 1 packetized it".format(frame_size))
+        except ValueError:
+            print("{} bytes: too large for version 1".format(frame_size))
+
+        frames = []
+
+        def packetize():
+            frames.append(
+                PacketizedFrame(Data(raw), len(frames), version=VERSION_2_FLAG)
+            )
+
+        packetize_rate = timeit(packetize, amount)
+        packets = [PacketView(bytes(packet)) for packet in frames[0].get_packets()]
+        matched = []
+
+        def reassemble():
+            packet_list = pool.acquire(0)
+            for packet in packets:
+                packet_list.add_packet(packet)
+            matched.append(bytes(packet_list.get_frame()) == raw)
+            pool.release(packet_list)
+
+        reassemble_rate = timeit(reassemble, amount)
+        print(
+            "{} bytes: {} packets, {} MB/s packetized, {} MB/s reassembled, intact {}".format(
+                frame_size,
+                len(packets),
+                packetize_rate * frame_size / 1e6,
+                reassemble_rate * frame_size / 1e6,
+                all(matched),
+            )
+        )
+    print("Frame buffers allocated: {}".format(pool.get_allocated()))
+
+
+def fanout(amount=50, frame_size=400000, clients=(1, 2, 5, 10, 20)):
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))  # Never read, the kernel drops what overflows
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    raw = np.random.bytes(frame_size)
+
+    for amount_of_clients in clients:
+        agents = [
+            Agent(sock, None, sink.getsockname()) for _ in range(amount_of_clients)
+        ]
+
+        def per_agent():
+            data = Data(raw)
+            for agent in agents:
+                agent.send_data(data.clone())
+
+        def shared():
+            frame = PacketizedFrame(Data(raw), 0)
+            for agent in agents:
+                agent.send_frame(frame)
+
+        for name, func in (("Per agent", per_agent), ("Shared", shared)):
+            start_time = time.process_time()
+            for _ in range(amount):
+                func()
+            cpu = (time.process_time() - start_time) / amount * 1000
+            print(
+                "{} clients, {}: {} ms CPU per frame".format(
+                    amount_of_clients, name, cpu
+                )
+            )
+
+
+def drain(socks) -> int:
+    """reads every waiting datagram, returns the bytes read"""
+    received = 0
+    for sock in socks:
+        while True:
+            try:
+                received += len(sock.recv(MAX_PACKET_SIZE))
+            except BlockingIOError:
+                break
+    return received
+
+
+def multicast(amount=50, frame_size=200000, clients=(1, 2, 5, 10, 20)):
+    """server CPU and egress per frame, unicast fan-out vs one multicast send
+
+    Runs on loopback, every client socket joins the group on 127.0.0.1.
+    """
+    group = (MULTICAST_GROUP, MULTICAST_PORT)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+    sock.setsockopt(
+        socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton("127.0.0.1")
+    )
+    raw = np.random.bytes(frame_size)
+    frame = PacketizedFrame(Data(raw), 0)
+
+    for amount_of_clients in clients:
+        unicast_socks = []
+        multicast_socks = []
+        for _ in range(amount_of_clients):
+            client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client_sock.bind(("127.0.0.1", 0))
+            unicast_socks.append(client_sock)
+
+            client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            client_sock.bind(("", MULTICAST_PORT))
+            client_sock.setsockopt(
+                socket.IPPROTO_IP,
+                socket.IP_ADD_MEMBERSHIP,
+                struct.pack(
+                    "4s4s",
+                    socket.inet_aton(MULTICAST_GROUP),
+                    socket.inet_aton("127.0.0.1"),
+                ),
+            )
+            multicast_socks.append(client_sock)
+        for client_sock in unicast_socks + multicast_socks:
+            client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+            client_sock.setblocking(False)
+
+        modes = (
+            (
+                "Unicast",
+                [Agent(sock, None, s.getsockname()) for s in unicast_socks],
+                unicast_socks,
+            ),
+            ("Multicast", [Agent(sock, None, group)], multicast_socks),
+        )
+        for name, agents, socks in modes:
+            cpu = 0.0
+            received = 0
+            for _ in range(amount):
+                start_time = time.process_time()
+                for agent in agents:
+                    agent.send_frame(frame)
+                cpu += time.process_time() - start_time
+                received += drain(socks)
+            egress = sum(agent.get_analytics().get_bytes_sent() for agent in agents)
+            print(
+                "{} clients, {}: {} ms CPU per frame, {} KB sent per frame, "
+                "{}% delivered".format(
+                    amount_of_clients,
+                    name,
+                    cpu / amount * 1000,
+                    egress / 1024.0 / amount,
+                    received * 100.0 / (frame.get_wire_size() * amount * len(socks)),
+                )
+            )
+        for client_sock in unicast_socks + multicast_socks:
+            client_sock.close()
+
+
+def sender_processes(
+    duration=3.0, fps=480, frame_size=300000, clients=40, processes=(0, 1, 2, 4)
+):
+    """client frames sent per second by the server process alone and by sender processes
+
+    Frames are offered at fps to every client, more than can be sent, so
+    the result is the throughput. 0 processes sends like the server does
+    without sender processes.
+    """
+    sinks = []
+    for _ in range(clients):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))  # Never read, the kernel drops what overflows
+        sinks.append(sink)
+    raw = np.random.bytes(frame_size)
+    print("{} cores".format(os.cpu_count()))
+
+    for amount_of_processes in processes:
+        if amount_of_processes == 0:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            agents = [Agent(sock, None, sink.getsockname()) for sink in sinks]
+            for agent in agents:
+                agent.start_sender()
+
+            def publish(serial):
+                frame = PacketizedFrame(Data(raw), serial)
+                for agent in agents:
+                    agent.enqueue_frame(frame)
+
+        else:
+            pool = SenderPool(amount_of_processes)
+            pool.start()
+            for sink in sinks:
+                pool.add_agent(sink.getsockname(), fps)
+            time.sleep(2.0)  # Processes start and take their clients
+
+            def publish(serial):
+                pool.publish(raw, serial, 1.0 / fps)
+
+        serial = 0
+        start_time = time.perf_counter()
+        next_time = start_time
+        while time.perf_counter() - start_time < duration:
+            serial += 1
+            publish(serial)
+            next_time += 1.0 / fps
+            time.sleep(max(0.0, next_time - time.perf_counter()))
+        time.sleep(0.5)
+
+        if amount_of_processes == 0:
+            analytics = [agent.get_analytics() for agent in agents]
+            for agent in agents:
+                agent.stop_sender()
+            sock.close()
+        else:
+            analytics = [data for _, data, _ in pool.get_analytics()]
+            pool.stop()
+        sent = sum(data.get_frames_sent() for data in analytics)
+        print(
+            "{} sender processes: {} client frames/s, {} offered".format(
+                amount_of_processes, sent / duration, serial * clients / duration
+            )
+        )
+
+
+def _read_frames(name, ports, results, amount):
+    """runs in another process, reads frames from a ring or over UDP
+
+    Every frame starts with the time it was sent.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(2)
+    ports.put(sock.getsockname())
+    latencies = []
+    start_time = time.process_time()
+    if name is not None:
+        receiver = LocalReceiver(name, track=True)  # Started by the ring's creator
+        while len(latencies) < amount:
+            try:
+                data, serial = receiver.read(sock.recv(64))
+            except socket.timeout:
+                break
+            if serial != -1:
+                latencies.append(time.perf_counter() - struct.unpack_from("d", data)[0])
+        receiver.close()
+    else:
+        agent = Agent(sock, None, None)
+        thread = Thread(target=agent.start_receive)
+        thread.start()
+        while len(latencies) < amount:
+            data, serial = agent.wait_for_data(timeout=2)
+            if serial == -1:
+                break
+            frame = bytes(data.get_data())
+            latencies.append(time.perf_counter() - struct.unpack_from("d", frame)[0])
+        agent.stop_receive()
+        thread.join()
+    results.put((latencies, time.process_time() - start_time))
+
+
+def local_transport(amount=200, fps=100, frame_size=200000):
+    """latency and CPU of a frame to a client in another process on this host
+
+    Compares the shared memory ring with the UDP path and a plain copy.
+    """
+    context = multiprocessing.get_context("spawn")
+    raw = bytearray(np.random.bytes(frame_size))
+    start_time = time.perf_counter()
+    for _ in range(amount):
+        bytes(raw)
+    print(
+        "Copy: {} ms per frame".format(
+            (time.perf_counter() - start_time) / amount * 1000
+        )
+    )
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 22)
+    for name in ("Shared memory", "UDP"):
+        local_sender = LocalSender(sock) if name == "Shared memory" else None
+        ports = context.Queue()
+        results = context.Queue()
+        reader = context.Process(
+            target=_read_frames,
+            args=(
+                None if local_sender is None else local_sender.get_name(),
+                ports,
+                results,
+                amount,
+            ),
+        )
+        reader.start()
+        addr = ports.get()
+        if local_sender is not None:
+            local_sender.add_client(addr)
+        else:
+            agent = Agent(sock, None, addr)
+        time.sleep(0.5)
+
+        cpu = 0.0
+        for serial in range(1, amount + 1):
+            struct.pack_into("d", raw, 0, time.perf_counter())
+            start_time = time.process_time()
+            if local_sender is not None:
+                local_sender.publish(raw, serial)
+            else:
+                agent.send_frame(PacketizedFrame(Data(bytes(raw)), serial))
+            cpu += time.process_time() - start_time
+            time.sleep(1.0 / fps)
+
+        latencies, reader_cpu = results.get()
+        reader.join()
+        if local_sender is not None:
+            local_sender.close()
+        print(
+            "{}: {} ms latency (median), {} ms sender CPU, {} ms reader CPU "
+            "per frame, {} of {} frames".format(
+                name,
+                np.median(latencies) * 1000,
+                cpu / amount * 1000,
+                reader_cpu / max(1, len(latencies)) * 1000,
+                len(latencies),
+                amount,
+            )
+        )
+
+
+class CountingSocket(socket.socket):
+    """counts the send syscalls made through it"""
+
+    syscalls = 0
+
+    def sendto(self, *args):
+        self.syscalls += 1
+        return super().sendto(*args)
+
+    def sendmsg(self, *args):
+        self.syscalls += 1
+        return super().sendmsg(*args)
+
+
+def batched_send(
+    amount=300,
+    frame_size=200000,
+    packet_sizes=(PACKET_SIZE, 1472),
+    remote=("192.0.2.1", 9),
+    remote_amount=20,
+):
+    """syscalls and CPU per frame, a sendto per packet vs UDP_SEGMENT batches
+
+    Loopback has a 64 KB MTU, remote is sent to as well to cover a route
+    with a normal MTU, where larger packets can not be batched. The
+    default is a TEST-NET-1 address, its discard port on the default route.
+    """
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))  # Never read, the kernel drops what overflows
+    raw = np.random.bytes(frame_size)
+    targets = [("loopback", sink.getsockname(), amount)]
+    if remote is not None:
+        targets.append(("remote", remote, remote_amount))
+
+    for target, addr, frames in targets:
+        MTU = get_route_MTU(addr)
+        for packet_size in packet_sizes:
+            frame = PacketizedFrame(Data(raw), 0, packet_size=packet_size)
+            for name, batch_send in (("sendto", False), ("UDP_SEGMENT", True)):
+                sock = CountingSocket(socket.AF_INET, socket.SOCK_DGRAM)
+                agent = Agent(
+                    sock,
+                    None,
+                    addr,
+                    packet_size=packet_size,
+                    batch_send=batch_send,
+                )
+                agent.send_frame(frame)
+                syscalls = sock.syscalls
+                sock.close()
+
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                agent.udp_sock = sock
+                start_time = time.process_time()
+                for _ in range(frames):
+                    agent.send_frame(frame)
+                cpu = (time.process_time() - start_time) / frames * 1000
+                sent = agent.get_analytics().get_packets_sent()
+                sock.close()
+                print(
+                    "{} (MTU {}), {} byte packets, {}: {} packets, {} syscalls, {} ms CPU per frame, {} of {} packets sent{}".format(
+                        target,
+                        MTU,
+                        packet_size,
+                        name,
+                        len(frame),
+                        syscalls,
+                        cpu,
+                        sent,
+                        len(frame) * (frames + 1),
+                        "" if agent.use_GSO == batch_send else " (not batched)",
+                    )
+                )
+
+
+def burst_receive(rounds=50, frames=10, frame_size=50000, bad=8):
+    """CPU and garbage collections per packet, a datagram at a time vs bursts
+
+    Every round the frames, and some packets with a wrong cookie, are queued
+    on the socket before the client reads them.
+    """
+    garbage = np.random.bytes(PACKET_SIZE)
+    for name, receive_burst in (("datagram", 1), ("burst", RECEIVE_BURST)):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4194304)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(0.5)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client = Agent(receiver, None, None, receive_burst=receive_burst)
+        server = Agent(sock, None, receiver.getsockname())
+        thread = Thread(target=client.start_receive)
+        thread.start()
+
+        cpu = 0.0
+        collections = 0
+        for _ in range(rounds):
+            client.lock.acquire()  # Holds the receiver until the round is queued
+            for frame in range(frames):
+                server.send_data(Data(np.random.bytes(frame_size)))
+                if frame < bad:
+                    sock.sendto(garbage, receiver.getsockname())
+            serial = server.data_serial
+            collected = sum(stats["collections"] for stats in gc.get_stats())
+            start_time = time.process_time()
+            client.frame_ready.wait_for(lambda: client.complete_serial >= serial)
+            cpu += time.process_time() - start_time
+            collections += sum(stats["collections"] for stats in gc.get_stats())
+            collections -= collected
+            client.lock.release()
+
+        client.stop_receive()
+        thread.join()
+        analytics = client.get_analytics()
+        packets = analytics.get_packets_received()
+        print(
+            "{}: {} packets, {} rejected by header, {} by CRC, {} us CPU per packet and {} collections per 1000 packets".format(
+                name,
+                packets,
+                analytics.get_packets_header_error(),
+                analytics.get_packet_CRC(),
+                cpu / packets * 1e6,
+                collections / packets * 1000,
+            )
+        )
+        sock.close()
+        receiver.close()
+
+
+def frame_latency(amount=60, fps=30, frame_size=200000):
+    """frame complete to consumer latency, polling vs waiting on the agent"""
+
+    def run(consume):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(0.5)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        agent = Agent(receiver, None, None)
+        agent.RUN = True
+        receive_thread = Thread(target=agent.start_receive)
+        receive_thread.start()
+        consume_thread = Thread(target=consume, args=(agent,))
+        consume_thread.start()
+
+        for serial in range(1, amount + 1):
+            for raw in build_packets(np.random.bytes(frame_size), serial):
+                sender.sendto(raw, receiver.getsockname())
+            time.sleep(1.0 / fps)
+
+        agent.stop_receive()
+        receive_thread.join()
+        consume_thread.join()
+        receiver.close()
+        sender.close()
+        return agent.get_analytics()
+
+    def polling(agent):
+        while agent.RUN:
+            data, serial = agent.get_last_data()
+            if serial == -1:
+                time.sleep(1.0 / fps / 10)
+                continue
+            agent.get_analytics().add_display_latency(
+                time.perf_counter() - agent.get_complete_time()
+            )
+
+    def waiting(agent):
+        while agent.RUN:
+            data, serial = agent.wait_for_data(timeout=0.5)
+            if serial == -1:
+                continue
+            agent.get_analytics().add_display_latency(
+                time.perf_counter() - agent.get_complete_time()
+            )
+
+    for name, consume in (("Polling", polling), ("Waiting", waiting)):
+        analytics = run(consume)
+        print(
+            "{}: {} ms average latency over {} frames".format(
+                name, analytics.get_display_latency(), analytics.get_good_frames()
+            )
+        )
+
+
+def FEC_goodput(
+    amount=200, frame_size=300000, loss_rates=(0, 0.005, 0.01, 0.02, 0.05, 0.1)
+):
+    """good frames and goodput against random packet loss, with and without FEC"""
+    frames = [np.random.bytes(frame_size) for _ in range(4)]
+    modes = (
+        ("FEC off", FEC_OFF_FLAG, FEC_RATIO),
+        ("FEC 10%", FEC_ON_FLAG, 0.1),
+        ("FEC 20%", FEC_ON_FLAG, 0.2),
+    )
+    pool = FramePool()
+
+    for name, FEC_flag, FEC_ratio in modes:
+        packets = [
+            [PacketView(raw) for raw in build_packets(frame, 0, FEC_flag, FEC_ratio)]
+            for frame in frames
+        ]
+        for loss_rate in loss_rates:
+            good_frames = 0
+            bytes_sent = 0
+            for i in range(amount):
+                frame_packets = packets[i % len(packets)]
+                lost = np.random.random_sample(len(frame_packets)) < loss_rate
+                packet_list = pool.acquire(0)
+                for packet, is_lost in zip(frame_packets, lost):
+                    if not is_lost:
+                        packet_list.add_packet(packet)
+                good_frames += packet_list.is_complete()
+                bytes_sent += sum(len(packet.get_raw()) for packet in frame_packets)
+                pool.release(packet_list)
+
+            goodput = good_frames * frame_size / float(bytes_sent)
+            print(
+                "{}, {}% loss: {}% good frames, {}% goodput".format(
+                    name,
+                    loss_rate * 100,
+                    good_frames * 100.0 / amount,
+                    goodput * 100,
+                )
+            )
+
+
+def strip_frames(
+    amount=120,
+    loss_rates=(0, 0.01, 0.02, 0.05),
+    packet_size=PACKET_SIZE,
+    res_w=1280,
+    res_h=720,
+    quality=50,
+):
+    """frames shown against random packet loss, whole JPEGs vs strips
+
+    Packets are handed to a client Agent in order, and a frame is taken
+    whenever the Agent has one, like the asyncio client does. The pixel
+    error is against the frame that was sent, so stale strips count.
+    """
+    x = np.linspace(0, 255, res_w, dtype=np.float32)
+    y = np.linspace(0, 255, res_h, dtype=np.float32)[:, None]
+    gradient = ((x + y) / 2).astype(np.uint8)
+    background = np.dstack([gradient, gradient[::-1], gradient[:, ::-1]])
+    # Texture, so a frame takes about as many packets as a camera frame
+    texture = np.random.randint(0, 32, (res_h // 4, res_w // 4, 3), dtype=np.uint8)
+    background += cv2.resize(texture, (res_w, res_h))
+    sources = []
+    for i in range(amount):
+        frame = background.copy()
+        position = i * 8 % (res_w - 100)
+        frame[300:400, position : position + 100] = 255
+        sources.append(frame)
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+    strip_encoder = StripEncoder(packet_size)
+
+    for name, encode in (
+        ("JPEG", lambda frame: cv2.imencode(".jpg", frame, encode_param)[1].tobytes()),
+        ("Strips", lambda frame: strip_encoder.encode(frame, encode_param)),
+    ):
+        frames = [
+            PacketizedFrame(Data(encode(source)), serial + 1, packet_size=packet_size)
+            for serial, source in enumerate(sources)
+        ]
+        wire_size = sum(frame.get_wire_size() for frame in frames) / amount
+        for loss_rate in loss_rates:
+            agent = Agent(None, None, None, packet_size=packet_size)
+            agent.set_use_partial(name == "Strips")
+            decoder = FrameDecoder(res_w, res_h)
+            shown = 0
+            error = 0.0
+            for frame in frames:
+                packets = frame.get_packets()
+                lost = np.random.random_sample(len(packets)) < loss_rate
+                for packet, is_lost in zip(packets, lost):
+                    if is_lost or not agent.handle_packet(PacketView(packet)):
+                        continue
+                    data, serial = agent.get_last_data()
+                    if serial == -1:
+                        continue
+                    output = decoder.decode(data.get_data(), agent.is_partial())
+                    if output is not None:
+                        shown += 1
+                        error += cv2.absdiff(output, sources[serial - 1]).mean()
+            print(
+                "{}, {}% loss: {}% frames shown, {} KB per frame, {} mean pixel error".format(
+                    name,
+                    loss_rate * 100,
+                    shown * 100.0 / amount,
+                    wire_size // 1024,
+                    error / max(shown, 1),
+                )
+            )
+
+
+def packet_sizes(
+    amount=300,
+    frame_size=150000,
+    MTU=DEFAULT_MTU,
+    sizes=(MTU_PACKET_SIZE, 4096, PACKET_SIZE, MAX_PACKET_SIZE),
+    loss_rates=(0.001, 0.005, 0.01, 0.02),
+):
+    """good frames and goodput per packet size, losing IP fragments on an MTU
+
+    Datagrams larger than the MTU are split into fragments by IP and are
+    lost when any of their fragments is, so the emulator drops fragments.
+    Goodput counts the IP and UDP headers of every fragment.
+    """
+    frames = [np.random.bytes(frame_size) for _ in range(4)]
+    fragment_size = MTU - IP_HEADER_SIZE
+
+    for packet_size in sizes:
+        packets = [
+            [
+                PacketView(raw)
+                for raw in build_packets(frame, 0, packet_size=packet_size)
+            ]
+            for frame in frames
+        ]
+        pool = FramePool(packet_size)
+
+        def packetize():
+            build_packets(frames[0], 0, packet_size=packet_size)
+
+        def reassemble():
+            packet_list = pool.acquire(0)
+            for packet in packets[0]:
+                packet_list.add_packet(packet)
+            pool.release(packet_list)
+
+        print(
+            "{} bytes: {} packets per frame, packetize {} frames/s, reassemble {} frames/s".format(
+                packet_size,
+                len(packets[0]),
+                timeit(packetize, 100),
+                timeit(reassemble, 100),
+            )
+        )
+
+        for loss_rate in loss_rates:
+            good_frames = 0
+            wire_bytes = 0
+            for i in range(amount):
+                frame_packets = packets[i % len(packets)]
+                packet_list = pool.acquire(0)
+                for packet in frame_packets:
+                    # The UDP header is carried by the first fragment
+                    length = len(packet.get_raw()) + UDP_HEADER_SIZE
+                    fragments = -(-length // fragment_size)
+                    wire_bytes += length + fragments * IP_HEADER_SIZE
+                    if np.random.random_sample(fragments).min() >= loss_rate:
+                        packet_list.add_packet(packet)
+                good_frames += packet_list.is_complete()
+                pool.release(packet_list)
+
+            print(
+                "{} bytes, {}% fragment loss: {}% good frames, {}% goodput".format(
+                    packet_size,
+                    loss_rate * 100,
+                    good_frames * 100.0 / amount,
+                    good_frames * frame_size * 100.0 / wire_bytes,
+                )
+            )
+
+
+def camera_capture(amount=150, frame_devider=2, res_w=1280, res_h=720):
+    """CPU per kept frame reading every camera frame vs grabbing skipped ones
+
+    A motion JPEG file stands in for the camera, decoding it costs about
+    as much as decoding a webcam's MJPEG stream.
+    """
+    path = os.path.join(tempfile.mkdtemp(), "capture.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (res_w, res_h))
+    for _ in range(amount):
+        writer.write(np.random.randint(0, 256, (res_h, res_w, 3), dtype=np.uint8))
+    writer.release()
+
+    def read_all(cam, slot):
+        index = -1
+        while True:
+            status, frame = cam.read()
+            if not status:
+                return
+            index += 1
+            if index % frame_devider == 0:
+                slot.publish(frame)
+
+    def grab_skipped(cam, slot):
+        index = -1
+        while True:
+            index += 1
+            if not index % frame_devider == 0:
+                if not cam.grab():
+                    return
+                continue
+            status, frame = cam.read()
+            if not status:
+                return
+            slot.publish(frame)
+
+    for name, capture in (("Read all", read_all), ("Grab skipped", grab_skipped)):
+        cam = cv2.VideoCapture(path)
+        slot = FrameSlot()
+        start_time = time.process_time()
+        capture(cam, slot)
+        cpu = time.process_time() - start_time
+        cam.release()
+        kept = slot.get_analytics().get_frames_received()
+        print("{}: {} ms CPU per kept frame".format(name, cpu / kept * 1000))
+    os.remove(path)
+
+    # Waiting for a client, the old loop checked the agents list nonstop
+    def spinning(agents, duration):
+        end_time = time.time() + duration
+        while time.time() < end_time:
+            if len(agents) == 0:
+                continue
+
+    def waiting(agents, duration):
+        condition = Condition()
+        condition.acquire()
+        while len(agents) == 0 and condition.wait(duration):
+            pass
+        condition.release()
+
+    for name, idle in (("Spinning", spinning), ("Waiting", waiting)):
+        start_time = time.process_time()
+        idle([], 1.0)
+        print(
+            "{}: {}% CPU while idle".format(
+                name, (time.process_time() - start_time) * 100
+            )
+        )
+
+
+def encode_pipeline(duration=3.0, res_w=1920, res_h=1080, quality=90):
+    """sustained encoded fps of 1080p frames per amount of encode workers"""
+    x = np.linspace(0, 255, res_w, dtype=np.float32)
+    y = np.linspace(0, 255, res_h, dtype=np.float32)[:, None]
+    gradient = (x + y) / 2
+    frames = [
+        np.dstack([gradient, gradient[::-1], gradient[:, ::-1]]).astype(np.uint8)
+        + np.random.randint(0, 16, (res_h, res_w, 3), dtype=np.uint8)
+        for _ in range(4)
+    ]
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+
+    def encode(frame):
+        resized = cv2.resize(frame, (res_w, res_h), cv2.INTER_AREA)
+        status, encoded = cv2.imencode(".jpg", resized, encode_param)
+        return status, encoded.tobytes()
+
+    for workers in sorted({1, 2, 4, os.cpu_count()}):
+        slot = FrameSlot()
+        pipeline = EncodePipeline(slot, encode, workers)
+        pipeline.start()
+        RUN = [True]
+
+        def camera():
+            index = 0
+            while RUN[0]:
+                slot.publish(frames[index % len(frames)])
+                index += 1
+                time.sleep(0.001)
+
+        camera_thread = Thread(target=camera)
+        camera_thread.start()
+
+        encoded_frames = 0
+        last_index = -1
+        in_order = True
+        end_time = time.perf_counter() + duration
+        while time.perf_counter() < end_time:
+            data, index = pipeline.get(timeout=0.5)
+            if index == -1:
+                continue
+            in_order = in_order and index > last_index
+            last_index = index
+            encoded_frames += 1
+
+        RUN[0] = False
+        camera_thread.join()
+        pipeline.stop()
+        print(
+            "{} workers: {} encoded fps, {} ms per encode, in order: {}".format(
+                workers,
+                encoded_frames / duration,
+                pipeline.get_stage_times().get_average("encode"),
+                in_order,
+            )
+        )
+
+
+def frame_decoding(amount=100, source=(1920, 1080), outputs=((1280, 720), (640, 360))):
+    """client decode to output time and allocations, full decode vs FrameDecoder
+
+    The full decode path is the old one: decode at the source size, resize
+    to the output and let the virtual camera convert BGR to I420.
+    """
+    x = np.linspace(0, 255, source[0], dtype=np.float32)
+    y = np.linspace(0, 255, source[1], dtype=np.float32)[:, None]
+    gradient = ((x + y) / 2).astype(np.uint8)
+    image = np.dstack([gradient, gradient[::-1], gradient[:, ::-1]])
+    _, encoded = cv2.imencode(".jpg", image, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+    data = encoded.tobytes()
+
+    for res_w, res_h in outputs:
+
+        def full_decode():
+            frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), 1)
+            frame = cv2.resize(frame, (res_w, res_h))
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+
+        decoder = FrameDecoder(res_w, res_h, "I420")
+        decoder.decode(data)  # Learns the source size
+
+        for name, func in (
+            ("Full decode", full_decode),
+            ("FrameDecoder", lambda: decoder.decode(data)),
+        ):
+            rate = timeit(func, amount)
+            tracemalloc.start()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(
+                "{}x{} {}: {} ms per frame, {} KB allocated per frame".format(
+                    res_w, res_h, name, 1000.0 / rate, peak // 1024
+                )
+            )
+
+
+def static_scene(amount=300, moving=0.2, res_w=1280, res_h=720, quality=50):
+    """bytes and CPU with and without suppressing unchanged frames
+
+    The scene is static with sensor noise, and a square moves across it
+    for the given part of the frames.
+    """
+    x = np.linspace(0, 255, res_w, dtype=np.float32)
+    y = np.linspace(0, 255, res_h, dtype=np.float32)[:, None]
+    gradient = ((x + y) / 2).astype(np.uint8) // 2  # Room for the noise
+    background = np.dstack([gradient, gradient[::-1], gradient[:, ::-1]])
+    noise = [
+        np.random.randint(0, 3, background.shape, dtype=np.uint8) for _ in range(4)
+    ]
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+    moving_frames = int(amount * moving)
+
+    def get_frame(i):
+        frame = background + noise[i % len(noise)]
+        if i < moving_frames:
+            position = i * 8 % (res_w - 100)
+            frame[300:400, position : position + 100] = 255
+        return frame
+
+    frames = [get_frame(i) for i in range(amount)]
+
+    for name, detector in (
+        ("All frames", None),
+        ("Unchanged suppressed", ChangeDetector(refresh_interval=float("inf"))),
+    ):
+        sent_bytes = 0
+        encoded_frames = 0
+        start_time = time.process_time()
+        for frame in frames:
+            if detector is None or detector.is_changed(frame):
+                _, encoded = cv2.imencode(".jpg", frame, encode_param)
+                frame = PacketizedFrame(Data(encoded.tobytes()), 0)
+                sent_bytes += frame.get_wire_size()
+                encoded_frames += 1
+            else:
+                sent_bytes += len(build_repeat(0))
+        cpu = time.process_time() - start_time
+        print(
+            "{}: {} frames encoded, {} KB sent, {} ms CPU per frame".format(
+                name, encoded_frames, sent_bytes // 1024, cpu / amount * 1000
+            )
+        )
+
+
+def tile_encoding(amount=150, res_w=1280, res_h=720, quality=50):
+    """encode time and bytes of full JPEGs vs tile frames on screen-like content
+
+    A desktop with windows of text where one line is typed and a clock
+    ticks, so only a few tiles change per frame.
+    """
+    screen = np.full((res_h, res_w, 3), 235, dtype=np.uint8)
+    cv2.rectangle(screen, (40, 40), (760, 680), (255, 255, 255), -1)
+    cv2.rectangle(screen, (800, 40), (1240, 400), (60, 60, 60), -1)
+    for line in range(20):
+        cv2.putText(
+            screen,
+            "Line {} of a document that is being edited".format(line),
+            (60, 80 + line * 28),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.6,
+            (20, 20, 20),
+            1,
+        )
+    frames = []
+    for i in range(amount):
+        frame = screen.copy()
+        cv2.putText(
+            frame,
+            "typing" + "." * (i % 40),
+            (60, 650),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.6,
+            (20, 20, 20),
+            1,
+        )
+        cv2.putText(
+            frame,
+            "{:02d}:{:02d}".format(i // 30, i % 30),
+            (1100, 700),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.6,
+            (20, 20, 20),
+            1,
+        )
+        frames.append(frame)
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+
+    def full(frame):
+        return cv2.imencode(".jpg", frame, encode_param)[1].tobytes()
+
+    tile_encoder = TileEncoder(refresh_interval=float("inf"))
+
+    def tiles(frame):
+        return tile_encoder.encode(frame, encode_param)
+
+    for name, encode in (("Full JPEG", full), ("Tiles", tiles)):
+        decoder = FrameDecoder(res_w, res_h)
+        sent_bytes = 0
+        encode_time = 0.0
+        for frame in frames:
+            start_time = time.perf_counter()
+            data = encode(frame)
+            encode_time += time.perf_counter() - start_time
+            sent_bytes += len(data)
+            if data:
+                output = decoder.decode(data)
+        error = np.abs(output.astype(np.int16) - frames[-1]).mean()
+        print(
+            "{}: {} ms encode per frame, {} KB per frame, {} mean error".format(
+                name,
+                encode_time / amount * 1000,
+                sent_bytes / 1024.0 / amount,
+                error,
+            )
+        )
+
+
+def simulcast_encoding(amount=20, clients=(1, 3, 10, 30), res_w=1920, res_h=1080):
+    """encode time per frame with an encode per client vs one per tier in use
+
+    Clients are spread evenly over SIMULCAST_TIERS.
+    """
+    noise = np.random.randint(0, 256, (res_h, res_w, 3), dtype=np.uint8)
+    frame = cv2.GaussianBlur(noise, (31, 31), 0)  # Smooth like a camera image
+
+    def encode(resized, encode_param):
+        return cv2.imencode(".jpg", resized, encode_param)[1].tobytes()
+
+    def from_captured(tier):
+        width, height, quality = SIMULCAST_TIERS[tier]
+        resized = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        return encode(resized, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+
+    for count in clients:
+        simulcast = Simulcast()
+        for client in range(count):
+            simulcast.subscribe(client, client % simulcast.get_tiers())
+
+        def per_client():
+            for client in range(count):
+                from_captured(simulcast.get_tier(client))
+
+        def per_tier():
+            for tier in simulcast.get_active():
+                from_captured(tier)
+
+        def shared():
+            simulcast.encode(frame, encode)
+
+        print(
+            "{} clients, {} tiers: {} ms per client, {} ms per tier, {} ms simulcast".format(
+                count,
+                len(simulcast.get_active()),
+                1000 / timeit(per_client, amount),
+                1000 / timeit(per_tier, amount),
+                1000 / timeit(shared, amount),
+            )
+        )
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "codec":
+        packet_codec()
+    if sys.argv[1] == "reassembly":
+        reassembly()
+    if sys.argv[1] == "large":
+        large_frames()
+    if sys.argv[1] == "fanout":
+        fanout()
+    if sys.argv[1] == "latency":
+        frame_latency()
+    if sys.argv[1] == "fec":
+        FEC_goodput()
+    if sys.argv[1] == "sizes":
+        packet_sizes()
+    if sys.argv[1] == "capture":
+        camera_capture()
+    if sys.argv[1] == "pipeline":
+        encode_pipeline()
+    if sys.argv[1] == "decode":
+        frame_decoding()
+    if sys.argv[1] == "static":
+        static_scene()
+    if sys.argv[1] == "tiles":
+        tile_encoding()
+    if sys.argv[1] == "simulcast":
+        simulcast_encoding()
+    if sys.argv[1] == "multicast":
+        multicast()
+    if sys.argv[1] == "shards":
+        sender_processes()
+    if sys.argv[1] == "local":
+        local_transport()
+    if sys.argv[1] == "strips":
+        strip_frames()
+    if sys.argv[1] == "receive":
+        burst_receive()
+    if sys.argv[1] == "batch":
+        batched_send()
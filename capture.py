@@ -0,0 +1,123 @@
+import cv2
+import time
+import numpy as np
+
+from threading import Condition
+from protocol import Analytics
+from constents import *
+
+
+class FrameSlot:
+    """single-slot buffer between the camera and the encoder
+
+    Publishing replaces a frame that was not taken yet, so the encoder
+    always gets the newest frame and never falls behind the camera.
+    Replaced frames are counted as dropped. Every published frame gets the
+    next index so later stages can keep frames in capture order.
+    """
+
+    def __init__(self):
+        self.frame = None
+        self.index = -1  # Index of the last published frame
+        self.closed = False
+        self.condition = Condition()
+        self.analytics = Analytics()
+
+    def publish(self, frame, replace=True):
+        """stores a frame for the next take
+
+        :param replace: replace a frame that was not taken yet, otherwise
+            the new frame is not published
+        :type replace: bool
+        """
+        self.condition.acquire()
+        if self.frame is not None:
+            if not replace:
+                self.condition.release()
+                return
+            self.analytics.add_frames_dropped()
+        self.frame = frame
+        self.index += 1
+        self.analytics.add_frames_received()
+        self.condition.notify()
+        self.condition.release()
+
+    def take(self, timeout=None):
+        """waits for a frame that was not taken yet
+
+        :return: the newest frame and its index, (None, -1) on timeout or
+            once closed
+        :rtype: tuple
+        """
+        self.condition.acquire()
+        while self.frame is None and not self.closed:
+            if not self.condition.wait(timeout):
+                break
+        frame = self.frame
+        index = self.index if frame is not None else -1
+        self.frame = None
+        self.condition.release()
+        return frame, index
+
+    def is_full(self) -> bool:
+        return self.frame is not None
+
+    def close(self):
+        self.condition.acquire()
+        self.closed = True
+        self.condition.notify_all()
+        self.condition.release()
+
+    def get_analytics(self) -> Analytics:
+        return self.analytics
+
+
+class ChangeDetector:
+    """tells if a frame changed enough since the last sent frame to be sent
+
+    Frames are compared as small grayscale thumbnails. Every thumbnail
+    pixel is the average of a block of the frame, sampled every few pixels,
+    so sensor noise cancels out while a block where something moved still
+    differs.
+    An unchanged scene is still sent every refresh_interval seconds.
+    """
+
+    def __init__(
+        self,
+        threshold=STATIC_THRESHOLD,
+        refresh_interval=STATIC_REFRESH_INTERVAL,
+        size=STATIC_THUMBNAIL_SIZE,
+    ):
+        self.threshold = threshold
+        self.refresh_interval = refresh_interval
+        self.size = size
+        self.reference = None  # Thumbnail of the last sent frame
+        self.last_sent_time = 0.0
+        self.forced = False
+
+    def force(self):
+        """makes the next frame count as changed"""
+        self.forced = True
+
+    def is_changed(self, frame) -> bool:
+        step = STATIC_SAMPLE_STEP
+        thumbnail = cv2.resize(
+            frame[::step, ::step], self.size, interpolation=cv2.INTER_AREA
+        )
+        if thumbnail.ndim == 3:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+        thumbnail = thumbnail.astype(np.int16)
+
+        current_time = time.time()
+        if (
+            not self.forced
+            and self.reference is not None
+            and current_time - self.last_sent_time < self.refresh_interval
+            and np.abs(thumbnail - self.reference).max() <= self.threshold
+        ):
+            return False
+
+        self.forced = False
+        self.reference = thumbnail
+        self.last_sent_time = current_time
+        return True
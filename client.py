@@ -1,3 +1,4 @@
+import asyncio
 import pyvirtualcam
 import cv2
 import socket
@@ -5,10 +6,17 @@ import binascii
 import logging, logging.handlers
 import time
 import signal
-import numpy as np
+import struct
+import sys
 import tkinter as tk
 from threading import Thread, Lock
-from protocol import Agent, Data
+from protocol import Agent, Data, IP_MTU
+from async_receiver import AsyncReceiver
+from local import LocalReceiver
+from decoder import FrameDecoder, CONVERSIONS
+from tiles import is_tiles
+from strips import is_strips
+from constents import *
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +30,8 @@ class Client:
         res_h=720,
         res_w=1280,
         RUN=True,
+        use_asyncio=False,
+        tier=None,
     ):
         self.fps = fps
         self.res_h = res_h
@@ -30,9 +40,22 @@ class Client:
         self.addr = addr
         self.lock = Lock()
         self.agent = None
+        self.use_asyncio = use_asyncio
+        self.tier = tier  # Simulcast tier asked for on connect, None leaves it to ABR
+        self.loop = None
+        self.receiver = None
+        self.multicast_addr = None  # Group and port, when the stream is multicast
+        self.multicast_sock = None
+        self.multicast_thread = None
+        self.ring_name = None  # Shared memory ring, when the server is on this host
+        self.local_receiver = None
+        self.last_serial = 0  # Of the last frame handed to the decoder
+        self.receive_thread = None
         self.output_camera = output_camera
+        self.pixel_format = "BGR"  # What cv2.imshow takes
         if self.output_camera:
             self.set_up_camera()
+        self.decoder = FrameDecoder(self.res_w, self.res_h, self.pixel_format)
 
     def set_up_camera(self):
         self.cam = pyvirtualcam.Camera(
@@ -42,19 +65,37 @@ class Client:
             fmt=pyvirtualcam.PixelFormat.BGR,
             print_fps=False,
         )
+        # Frames in the backend's own format are passed through as is, so
+        # the decoder converts straight into it instead of going through BGR
+        native_fmt = self.cam.native_fmt
+        if native_fmt.name in CONVERSIONS and native_fmt.name != self.pixel_format:
+            self.cam.close()
+            self.cam = pyvirtualcam.Camera(
+                width=self.res_w,
+                height=self.res_h,
+                fps=self.fps,
+                fmt=native_fmt,
+                print_fps=False,
+            )
+            self.pixel_format = native_fmt.name
 
     def check_valid_data(self, data, CRC):
         logging.debug("{} | {}".format(CRC, binascii.crc32(data)))
         return CRC == binascii.crc32(data)
 
     def decode_frame(self, data):
-        """decodes the data from bytes to a frame
+        """decodes the data from bytes to a frame in the output size and format
 
         :param data: encoded frame
         :type data: bytes
         """
-        data = np.frombuffer(data, dtype=np.uint8)
-        return cv2.imdecode(data, 1)
+        return self.decoder.decode(data)
+
+    def output_frame(self, frame, complete_time):
+        """called by the decoder worker with every decoded frame"""
+        self.send_frame_to_camera(frame)
+        if complete_time is not None:
+            self.record_latency(complete_time)
 
     def send_frame_to_camera(self, frame):
         try:
@@ -69,50 +110,263 @@ class Client:
             exit()
 
     def exit(self, *args, **kargs):
+        self.decoder.stop()
         if self.output_camera:
             self.cam.close()
         self.lock.acquire()
         self.RUN = False
         self.agent.stop_receive()
         self.lock.release()
+
+        if self.receiver is not None:
+            self.loop.call_soon_threadsafe(self.receiver.close)
+            return  # The event loop closes the sockets
+
         self.tcp_sock.close()
         self.udp_sock.close()
+        if self.multicast_sock is not None:
+            self.multicast_sock.close()
 
-        self.receive_thread.join()
+        if self.receive_thread is not None:
+            self.receive_thread.join()
+        if self.multicast_thread is not None:
+            self.multicast_thread.join()
 
-    def receive_loop(self):
+    def create_sockets(self):
         self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.udp_sock.settimeout(5)
 
         self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.tcp_sock.connect(self.addr)
 
-        self.port = self.tcp_sock.recv(16).decode()
-        self.udp_sock.bind(("0.0.0.0", int(self.port)))
+    def read_handshake(self, message):
+        """reads the UDP port, packet size and shared memory ring or multicast
+        group the server sends on connect"""
+        fields = message.decode().split()
+        self.port = fields[0]
+        # Older servers only send the port
+        self.packet_size = int(fields[1]) if len(fields) > 1 else PACKET_SIZE
+        if len(fields) == 3:
+            self.ring_name = fields[2]
+        elif len(fields) > 3:
+            self.multicast_addr = (fields[2], int(fields[3]))
+        self.check_path_MTU()
 
-        self.agent = Agent(self.udp_sock, self.tcp_sock, self.addr, fps=self.fps)
-        self.receive_thread = Thread(target=self.agent.start_receive)
-        self.receive_thread.start()
+    def join_multicast(self):
+        """joins the server's multicast group on the interface facing the server
 
+        Frames arrive on the group's socket, retransmits still come to the
+        unicast socket and reports and NACKs still go over TCP.
+        """
+        group, port = self.multicast_addr
+        self.multicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.multicast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.multicast_sock.bind(("", port))
+        interface = self.tcp_sock.getsockname()[0]
+        self.multicast_sock.setsockopt(
+            socket.IPPROTO_IP,
+            socket.IP_ADD_MEMBERSHIP,
+            struct.pack("4s4s", socket.inet_aton(group), socket.inet_aton(interface)),
+        )
+        logger.info("Joined multicast group {}:{}".format(group, port))
+
+    def check_path_MTU(self):
+        """warns when the server's packets are fragmented on the way here"""
+        if not sys.platform.startswith("linux"):
+            return
+        try:
+            MTU = self.tcp_sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+        except OSError:
+            return
+        if self.packet_size + IP_UDP_HEADER_SIZE > MTU:
+            logger.warning(
+                "Packets of {} bytes are fragmented on a {} bytes MTU path".format(
+                    self.packet_size, MTU
+                )
+            )
+
+    def start_analytics(self):
         logger.info("Starting analytics thread")
         self.analytics_thread = Thread(target=self.print_analytics)
         self.analytics_thread.start()
         logger.info("Started analytics thread")
 
-        sleep_time = 1.0 / self.fps  # TODO: change to var
+    def receive_loop(self):
+        if self.use_asyncio:
+            asyncio.run(self.receive_loop_async())
+            return
+
+        self.create_sockets()
+        self.udp_sock.settimeout(5)
+        self.tcp_sock.connect(self.addr)
+
+        self.read_handshake(self.tcp_sock.recv(64))
+        self.udp_sock.bind(("0.0.0.0", int(self.port)))
+        if self.multicast_addr is not None:
+            self.join_multicast()
+            self.multicast_sock.settimeout(5)
+
+        self.agent = Agent(
+            self.udp_sock,
+            self.tcp_sock,
+            self.addr,
+            fps=self.fps,
+            use_NACK=True,
+            send_reports=True,
+            packet_size=self.packet_size,
+        )
+        if self.tier is not None:
+            self.agent.request_tier(self.tier)
+        if self.ring_name is not None:
+            self.start_analytics()
+            self.decoder.start(self.output_frame)
+            self.receive_local()
+            return
+
+        self.receive_thread = Thread(target=self.agent.start_receive)
+        self.receive_thread.start()
+        if self.multicast_sock is not None:
+            self.multicast_thread = Thread(
+                target=self.agent.start_receive, args=(self.multicast_sock,)
+            )
+            self.multicast_thread.start()
+
+        self.start_analytics()
+        self.decoder.start(self.output_frame)
 
         while self.RUN:
-            data, serial = self.agent.get_last_data()
+            data, serial = self.agent.wait_for_data(timeout=0.5)
             logger.debug("Got last data - {}".format(serial))
+            repeats = self.agent.take_repeats()
             frame = data.get_data()
             if not frame:
-                time.sleep(sleep_time / 10)
+                if repeats:
+                    # The scene did not change, keep the camera's cadence
+                    self.decoder.repeat()
+                continue
+            logger.debug("Received {}".format(data))
+            self.check_strips(frame)
+            self.check_tiles(frame, serial)
+            # Decoded on the decoder's thread while the next frame arrives
+            self.decoder.submit(
+                frame, self.agent.get_complete_time(), self.agent.is_partial()
+            )
+
+    async def receive_loop_async(self):
+        """receives, decodes and outputs frames from the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.create_sockets()
+        self.tcp_sock.setblocking(False)
+        await self.loop.sock_connect(self.tcp_sock, self.addr)
+
+        self.read_handshake(await self.loop.sock_recv(self.tcp_sock, 64))
+        self.udp_sock.bind(("0.0.0.0", int(self.port)))
+        if self.multicast_addr is not None:
+            self.join_multicast()
+
+        self.agent = Agent(
+            self.udp_sock,
+            self.tcp_sock,
+            self.addr,
+            fps=self.fps,
+            use_NACK=True,
+            send_reports=True,
+            packet_size=self.packet_size,
+        )
+        if self.tier is not None:
+            self.agent.request_tier(self.tier)
+        if self.ring_name is not None:
+            self.udp_sock.settimeout(5)
+            self.start_analytics()
+            self.decoder.start(self.output_frame)
+            await self.loop.run_in_executor(None, self.receive_local)
+            self.tcp_sock.close()
+            return
+
+        _, self.receiver = await self.loop.create_datagram_endpoint(
+            lambda: AsyncReceiver(self.agent), sock=self.udp_sock
+        )
+        if self.multicast_sock is not None:
+            await self.loop.create_datagram_endpoint(
+                lambda: self.receiver, sock=self.multicast_sock
+            )
+
+        self.start_analytics()
+        self.decoder.start(self.output_frame)
+
+        while self.RUN:
+            data, serial = await self.receiver.next_frame()
+            if serial == -1:
+                if self.receiver.closed:
+                    break
+                # The scene did not change, keep the camera's cadence
+                self.decoder.repeat()
                 continue
             logger.debug("Received {}".format(data))
-            self.send_frame_to_camera(self.decode_frame(frame))
-            # time.sleep(sleep_time)
+            self.check_strips(data.get_data())
+            self.check_tiles(data.get_data(), serial)
+            # Decoding releases the GIL, packets keep arriving meanwhile
+            self.decoder.submit(
+                data.get_data(),
+                self.agent.get_complete_time(),
+                self.agent.is_partial(),
+            )
+
+        self.receiver.close()
+        self.tcp_sock.close()
+
+    def set_tier(self, tier):
+        """switches to another simulcast tier, -1 lets the server's ABR pick"""
+        self.tier = tier
+        if self.agent is not None:
+            self.agent.request_tier(tier)
+
+    def check_strips(self, frame):
+        """lets the agent hand out frames that lost packets once the server sends strips"""
+        if not self.agent.use_partial and is_strips(frame):
+            self.agent.set_use_partial(True)
+
+    def check_tiles(self, frame, serial):
+        """asks the server for a full frame once tile frames were lost
+
+        A tile frame only carries the tiles that changed since the frame
+        before it, so after a skipped frame the output stays stale until the
+        next full frame.
+        """
+        lost = self.decoder.take_lost()
+        # Serials wrap around to 1
+        skipped = serial not in (self.last_serial + 1, 1)
+        self.last_serial = serial
+        if is_tiles(frame) and (lost or skipped):
+            self.agent.request_full_frame()
+
+    def receive_local(self):
+        """hands the frames a server on this host writes to shared memory to the decoder
+
+        The UDP socket only gets a short wake message for every frame.
+        """
+        self.local_receiver = LocalReceiver(self.ring_name, self.agent.get_analytics())
+        while self.RUN:
+            try:
+                message = self.udp_sock.recv(64)
+            except OSError:
+                continue  # Timed out, or closed by exit
+            complete_time = time.perf_counter()
+            data, serial = self.local_receiver.read(message)
+            if serial == -1:
+                continue
+            if not data:
+                # The scene did not change, keep the camera's cadence
+                self.decoder.repeat()
+                continue
+            self.check_tiles(data, serial)
+            self.decoder.submit(data, complete_time)
+        self.local_receiver.close()
+
+    def record_latency(self, complete_time):
+        self.agent.get_analytics().add_display_latency(
+            time.perf_counter() - complete_time
+        )
 
     def print_analytics(self):
         sleep_time = 5.0
@@ -123,6 +377,7 @@ class Client:
                 "Receive FPS: {}".format(analytics.get_frames_received() / sleep_time)
             )
             print("Actual FPS: {}".format(analytics.get_good_frames() / sleep_time))
+            print("Partial FPS: {}".format(analytics.get_frames_partial() / sleep_time))
             print(
                 "Bitrate: {} Mbps".format(
                     analytics.get_bits_received() / sleep_time / 1000000
@@ -131,6 +386,33 @@ class Client:
             print("PPS: {}".format(analytics.get_packets_received() / sleep_time))
             print("CRC Error Percentage: {}%".format(analytics.get_packet_CRC_error()))
             print("CRC Errors: {}".format(analytics.get_packet_CRC()))
+            print("Header Errors: {}".format(analytics.get_packets_header_error()))
+            print("FEC Recovered Packets: {}".format(analytics.get_packets_recovered()))
+            print("NACKs Sent: {}".format(analytics.get_NACKs_sent()))
+            print("Repeated Frames: {}".format(analytics.get_frames_repeated()))
+            print(
+                "Expired Frames: {}, Evicted Frames: {}".format(
+                    analytics.get_frames_expired(), analytics.get_frames_evicted()
+                )
+            )
+            print(
+                "Complete To Display Latency: {} ms".format(
+                    analytics.get_display_latency()
+                )
+            )
+            decoded = self.decoder.get_analytics()
+            stage_times = self.decoder.get_stage_times()
+            print(
+                "Decode: {} ms at 1/{} scale, Convert To {}: {} ms, Replaced Before Decoding: {}".format(
+                    stage_times.get_average("decode"),
+                    self.decoder.get_scale(),
+                    self.pixel_format,
+                    stage_times.get_average("convert"),
+                    decoded.get_frames_dropped(),
+                )
+            )
+            decoded.reset()
+            stage_times.reset()
             print("")
             analytics.reset()
 
@@ -138,6 +420,11 @@ class Client:
             # self.exit()
 
 
+async def run_clients(clients):
+    """drives several streams from a single event loop"""
+    await asyncio.gather(*(client.receive_loop_async() for client in clients))
+
+
 def main():
     """
     ch = logging.StreamHandler()
@@ -0,0 +1,410 @@
+import binascii
+import socket
+import struct
+import numpy as np
+
+from constents import *
+
+# Cookie, CRC, Flags, Index, Serial, Data Length, Payload Length
+HEADER_STRUCT = struct.Struct("<IIBBHHH")
+# The same with a reserved byte, a 16-bit Index and a 32-bit Serial, version 2
+HEADER_STRUCT_2 = struct.Struct("<IIBxHIHH")
+CRC_STRUCT = struct.Struct("<I")
+HEADER_FIELDS = [
+    ("cookie", "<u4"),
+    ("CRC", "<u4"),
+    ("flags", "u1"),
+    ("index", "u1"),
+    ("serial", "<u2"),
+    ("data_length", "<u2"),
+    ("payload_length", "<u2"),
+]
+HEADER_FIELDS_2 = [
+    ("cookie", "<u4"),
+    ("CRC", "<u4"),
+    ("flags", "u1"),
+    ("reserved", "u1"),
+    ("index", "<u2"),
+    ("serial", "<u4"),
+    ("data_length", "<u2"),
+    ("payload_length", "<u2"),
+]
+
+COOKIE_VALUE = int(COOKIE)
+VERSION_MASK = 0b11110000
+CHUNK_MASK = 0b00001100
+FEC_MASK = 0b00000010
+SEC_MASK = 0b00000001
+
+_VERSION_1 = int(VERSION_1_FLAG)
+_VERSION_2 = int(VERSION_2_FLAG)
+_FLAGS_OFFSET = HEADER_SIZE  # Same in every version, so the version is read first
+_CHUNK_LAST = int(CHUNK_LAST_FLAG)
+_CHUNK_FIRST = int(CHUNK_FIRST_FLAG)
+_ZEROS = memoryview(bytes(MAX_PACKET_SIZE))
+
+
+def build_flags(chunk_flag, FEC_flag, SEC_flag, version=_VERSION_1) -> int:
+    return int(version) | int(chunk_flag) | int(FEC_flag) | int(SEC_flag)
+
+
+def get_header_struct(version=_VERSION_1) -> struct.Struct:
+    if int(version) == _VERSION_2:
+        return HEADER_STRUCT_2
+    return HEADER_STRUCT
+
+
+def get_max_chunks(version=_VERSION_1) -> int:
+    """data packets a frame can have, bound by the width of the index"""
+    return MAX_CHUNKS_2 if int(version) == _VERSION_2 else MAX_CHUNKS
+
+
+def get_max_serial(version=_VERSION_1) -> int:
+    return MAX_SERIAL_2 if int(version) == _VERSION_2 else MAX_SERIAL
+
+
+def build_repeat(serial, version=_VERSION_1) -> bytes:
+    """a header only packet asking to show the last frame again"""
+    buffer = bytearray(get_header_struct(version).size)
+    flags = build_flags(CHUNK_REPEAT_FLAG, FEC_OFF_FLAG, SEC_OFF_FLAG, version)
+    encode_into(buffer, flags, 0, serial, pad=False)
+    return bytes(buffer)
+
+
+def get_batches(packets, max_size=GSO_MAX_SIZE, max_segments=GSO_MAX_SEGMENTS):
+    """groups packets so every group can be sent in one UDP_SEGMENT send
+
+    The kernel splits a send into datagrams the size of its first packet,
+    so only the last packet of a group may be shorter.
+    """
+    batches = []
+    batch = []
+    for packet in packets:
+        length = len(packet)
+        if batch and (
+            length > segment_size
+            or size + length > max_size
+            or len(batch) == max_segments
+        ):
+            batches.append(batch)
+            batch = []
+        if not batch:
+            segment_size = length
+            size = 0
+        batch.append(packet)
+        size += length
+        if length < segment_size:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_chunk_size(
+    packet_size=PACKET_SIZE, FEC_flag=FEC_OFF_FLAG, version=_VERSION_1
+) -> int:
+    """frame bytes carried by a full packet, FEC packets keep room for FEC info"""
+    chunk_size = packet_size - get_header_struct(version).size
+    if FEC_flag:
+        chunk_size -= FEC_PAYLOAD_SIZE
+    return chunk_size
+
+
+def get_first_chunk_size(
+    packet_size=PACKET_SIZE, FEC_flag=FEC_OFF_FLAG, version=_VERSION_1
+) -> int:
+    """frame bytes carried by the first packet, which also carries the frame
+    CRC, and in version 2 the frame size"""
+    chunk_size = get_chunk_size(packet_size, FEC_flag, version) - FRAME_CRC_SIZE
+    if int(version) == _VERSION_2:
+        chunk_size -= FRAME_SIZE_SIZE
+    return chunk_size
+
+
+def get_packet_size(MTU=DEFAULT_MTU) -> int:
+    """largest packet that is sent without IP fragmentation on a path"""
+    return check_packet_size(MTU - IP_UDP_HEADER_SIZE)
+
+
+def check_packet_size(packet_size) -> int:
+    packet_size = int(packet_size)
+    if not MIN_PACKET_SIZE <= packet_size <= MAX_PACKET_SIZE:
+        raise ValueError(
+            "Packet size must be between {} and {}, got {}".format(
+                MIN_PACKET_SIZE, MAX_PACKET_SIZE, packet_size
+            )
+        )
+    return packet_size
+
+
+def encode_into(
+    buffer,
+    flags,
+    index,
+    serial,
+    payload=b"",
+    data=b"",
+    packet_size=PACKET_SIZE,
+    pad=True,
+) -> int:
+    """packs a full packet into a caller-supplied buffer
+
+    The buffer is padded with zeros up to packet_size so the output is
+    byte-for-byte identical to Packet.encode(). Without padding the packet
+    ends right after its data and the CRC only covers what is sent.
+
+    :param buffer: writable buffer of at least packet_size bytes
+    :type buffer: bytearray
+    :param flags: the flags byte, see build_flags, its version picks the header
+    :type flags: int
+    :param payload: ascii payload, already encoded
+    :type payload: bytes
+    :param data: chunk data, any bytes-like object
+    :param pad: pad the packet with zeros up to packet_size
+    :type pad: bool
+    :return: amount of bytes written
+    :rtype: int
+    """
+    payload_length = len(payload)
+    data_length = len(data)
+    header = get_header_struct(flags & VERSION_MASK)
+
+    header.pack_into(
+        buffer, 0, COOKIE_VALUE, 0, flags, index, serial, data_length, payload_length
+    )
+
+    written_bytes = header.size
+    if payload_length:
+        buffer[written_bytes : written_bytes + payload_length] = payload
+        written_bytes += payload_length
+
+    buffer[written_bytes : written_bytes + data_length] = data
+    written_bytes += data_length
+
+    if not pad:
+        packet_size = written_bytes
+    elif written_bytes < packet_size:
+        buffer[written_bytes:packet_size] = _ZEROS[: packet_size - written_bytes]
+
+    view = memoryview(buffer)
+    CRC_STRUCT.pack_into(
+        buffer, COOKIE_SIZE, binascii.crc32(view[HEADER_SIZE:packet_size])
+    )
+    return packet_size
+
+
+class ReceiveRing:
+    """receives bursts of datagrams into preallocated slots
+
+    After the first datagram of a burst, everything already waiting on the
+    socket is read without blocking, one slot each. The headers of a burst
+    are read at once through a structured view over the slots, so packets
+    with a wrong cookie or lengths that do not fit are dropped before any
+    per-packet object is made. There is a view for every header version.
+    Call close once done, it releases the ring's handle on the socket.
+    """
+
+    def __init__(self, slots=RECEIVE_BURST, packet_size=PACKET_SIZE):
+        self.packet_size = packet_size
+        self.buffer = bytearray(slots * packet_size)
+        view = memoryview(self.buffer)
+        self.slots = [
+            view[slot * packet_size : (slot + 1) * packet_size] for slot in range(slots)
+        ]
+        self.lengths = np.zeros(slots, dtype=np.int64)
+        # One record per slot, the header at the start of it
+        self.headers = self._get_headers(HEADER_FIELDS)
+        self.headers_2 = self._get_headers(HEADER_FIELDS_2)
+        # Without MSG_DONTWAIT, on Windows, every burst is one datagram
+        self.flags = getattr(socket, "MSG_DONTWAIT", None)
+        self.drain = None  # Socket object without a timeout, on the received fd
+
+    def receive(self, sock) -> int:
+        """waits for a datagram, then reads every datagram already waiting
+
+        :return: amount of datagrams read, 0 on timeout
+        :rtype: int
+        """
+        try:
+            self.lengths[0] = sock.recv_into(self.slots[0])
+        except OSError:
+            return 0
+        count = 1
+        if self.flags is None or sock.fileno() < 0:
+            return count
+        # With a timeout, Python polls until it runs out even for MSG_DONTWAIT,
+        # so the rest is read through a socket object without one, same fd
+        if self.drain is None or self.drain.fileno() != sock.fileno():
+            self.close()
+            self.drain = socket.socket(
+                sock.family, sock.type, sock.proto, sock.fileno()
+            )
+        drain_into = self.drain.recv_into
+        slots = self.slots
+        while count < len(slots):
+            try:
+                self.lengths[count] = drain_into(slots[count], 0, self.flags)
+            except OSError:
+                break  # Nothing waiting, or closed
+            count += 1
+        return count
+
+    def close(self):
+        """detaches the drain socket, the fd stays open for its owner"""
+        if self.drain is not None:
+            self.drain.detach()
+            self.drain = None
+
+    def _get_headers(self, fields):
+        dtype = np.dtype(
+            {
+                "names": [name for name, _ in fields],
+                "formats": [fmt for _, fmt in fields],
+                "itemsize": self.packet_size,
+            }
+        )
+        return np.frombuffer(self.buffer, dtype=dtype)
+
+    def get_size(self, count) -> int:
+        return int(self.lengths[:count].sum())
+
+    def get_valid(self, count):
+        """slots of the burst whose header can be trusted enough to decode
+
+        :return: slot numbers in arrival order
+        :rtype: np.ndarray
+        """
+        lengths = self.lengths[:count]
+        is_version_2 = (self.headers["flags"][:count] & VERSION_MASK) == _VERSION_2
+        valid = np.zeros(count, dtype=bool)
+        for headers, header_size, is_version in (
+            (self.headers[:count], HEADER_STRUCT.size, ~is_version_2),
+            (self.headers_2[:count], HEADER_STRUCT_2.size, is_version_2),
+        ):
+            valid |= (
+                is_version
+                & (headers["cookie"] == COOKIE_VALUE)
+                & (lengths >= header_size)
+                & (
+                    header_size
+                    + headers["payload_length"].astype(np.int64)
+                    + headers["data_length"]
+                    <= lengths
+                )
+            )
+        return np.flatnonzero(valid)
+
+    def get_packet(self, slot):
+        return PacketView(self.slots[slot], int(self.lengths[slot]))
+
+
+class PacketView:
+    """decoded packet that references the received buffer instead of copying it
+
+    The header is read in the layout of the packet's version.
+    """
+
+    __slots__ = (
+        "Raw",
+        "Cookie",
+        "CRC",
+        "Flags",
+        "Index",
+        "Serial",
+        "Data_Length",
+        "Payload_Length",
+        "Payload",
+        "Data",
+    )
+
+    def __init__(self, raw, length=None):
+        self.Raw = memoryview(raw)
+        if length is not None:
+            self.Raw = self.Raw[:length]
+
+        header = HEADER_STRUCT
+        if (
+            len(self.Raw) > _FLAGS_OFFSET
+            and self.Raw[_FLAGS_OFFSET] & VERSION_MASK == _VERSION_2
+        ):
+            header = HEADER_STRUCT_2
+        if len(self.Raw) < header.size:
+            self.Cookie = 0
+            self.CRC = 0
+            self.Flags = 0
+            self.Index = 0
+            self.Serial = 0
+            self.Data_Length = 0
+            self.Payload_Length = 0
+            self.Payload = self.Raw[:0]
+            self.Data = self.Raw[:0]
+            return
+
+        (
+            self.Cookie,
+            self.CRC,
+            self.Flags,
+            self.Index,
+            self.Serial,
+            self.Data_Length,
+            self.Payload_Length,
+        ) = header.unpack_from(self.Raw)
+
+        read_bytes = header.size
+        self.Payload = self.Raw[read_bytes : read_bytes + self.Payload_Length]
+
+        read_bytes += self.Payload_Length
+        self.Data = self.Raw[read_bytes : read_bytes + self.Data_Length]
+
+    def check_cookie(self) -> bool:
+        return self.Cookie == COOKIE_VALUE
+
+    def check_CRC(self) -> bool:
+        return self.CRC == binascii.crc32(self.Raw[HEADER_SIZE:])
+
+    def is_first(self) -> bool:
+        return self.Flags & CHUNK_MASK == _CHUNK_FIRST
+
+    def is_last(self) -> bool:
+        return self.Flags & CHUNK_MASK == _CHUNK_LAST
+
+    def is_parity(self) -> bool:
+        return self.Flags & (CHUNK_MASK | FEC_MASK) == FEC_MASK
+
+    def is_repeat(self) -> bool:
+        return self.Flags & (CHUNK_MASK | FEC_MASK) == 0
+
+    def is_valid(self) -> bool:
+        return self.check_cookie() and self.check_CRC()
+
+    def get_version(self) -> int:
+        return self.Flags & VERSION_MASK
+
+    def get_FEC_flag(self) -> int:
+        return self.Flags & FEC_MASK
+
+    def get_layout(self) -> int:
+        """version and FEC flag, which together set the chunk size"""
+        return self.Flags & (VERSION_MASK | FEC_MASK)
+
+    def get_SEC_flag(self) -> int:
+        return self.Flags & SEC_MASK
+
+    def get_serial(self) -> int:
+        return self.Serial
+
+    def get_index(self) -> int:
+        return self.Index
+
+    def get_raw(self):
+        return self.Raw
+
+    def get_payload(self) -> str:
+        return bytes(self.Payload).decode()
+
+    def get_data(self):
+        return self.Data
+
+    def __str__(self) -> str:
+        return "{}...{}".format(bytes(self.Raw[:16]), bytes(self.Raw[-17:]))
@@ -5,20 +5,31 @@ COOKIE = np.uint32(0x16F5F7A7)
 
 ### FLAGS ###
 VERSION_1_FLAG = np.uint8(0b00010000)
+VERSION_2_FLAG = np.uint8(0b00100000)  # Wide index and serial, for large frames
 CHUNK_FIRST_FLAG = np.uint8(0b00001000)
 CHUNK_LAST_FLAG = np.uint8(0b00000100)
 CHUNK_NORMAL_FLAG = np.uint8(0b00001100)
+CHUNK_PARITY_FLAG = np.uint8(0b00000000)  # Only with FEC on
+CHUNK_REPEAT_FLAG = np.uint8(0b00000000)  # Only with FEC off
 FEC_ON_FLAG = np.uint8(0b00000010)
 FEC_OFF_FLAG = np.uint8(0b00000000)
 SEC_ON_FLAG = np.uint8(0b00000001)
 SEC_OFF_FLAG = np.uint8(0b00000000)
 
 ### SIZES (Amount of bytes) ###
-PACKET_SIZE = 8192
+PACKET_SIZE = 8192  # Default, servers may negotiate any size in the range below
+MIN_PACKET_SIZE = 548  # 576 bytes IPv4 minimum MTU
+MAX_PACKET_SIZE = 8972  # 9000 bytes jumbo frame MTU
+IP_HEADER_SIZE = 20
+UDP_HEADER_SIZE = 8
+IP_UDP_HEADER_SIZE = IP_HEADER_SIZE + UDP_HEADER_SIZE
+DEFAULT_MTU = 1500
+MTU_PACKET_SIZE = DEFAULT_MTU - IP_UDP_HEADER_SIZE  # Largest unfragmented packet
 HEADER_SIZE = 8
-BODY_SIZE = 8184
+BODY_SIZE = PACKET_SIZE - HEADER_SIZE
 METADATA_SIZE = 8
-RAW_SIZE = 8176
+PACKET_HEADER_SIZE = HEADER_SIZE + METADATA_SIZE
+RAW_SIZE = PACKET_SIZE - PACKET_HEADER_SIZE
 COOKIE_SIZE = 4
 CRC_SIZE = 4
 FLAGS_SIZE = 1
@@ -26,8 +37,103 @@ INDEX_SIZE = 1
 SERIAL_SIZE = 2
 DATA_LENGTH_SIZE = 2
 PAYLOAD_LENGTH_SIZE = 2
+FEC_PAYLOAD_SIZE = 16
+FEC_RAW_SIZE = RAW_SIZE - FEC_PAYLOAD_SIZE
+FRAME_CRC_SIZE = 10  # Decimal digits of the frame CRC in the first packet
+FRAME_SIZE_SIZE = 10  # Decimal digits of the frame size after it, version 2 only
+FEC_MAX_FRAME_SIZE = 10**8  # The FEC info has 8 decimal digits for the frame size
+FEC_MAX_GROUP_SIZE = 9999  # And 4 for the group size
 
 ### OTHER ###
 DATA_DTYPE = np.uint8
 TIMEOUT = 3
 PACKETS_PER_FARME = 36
+MAX_CHUNKS = 256
+MAX_CHUNKS_2 = 65536  # Version 2 packets, a 16-bit index
+MAX_SERIAL = 65535
+MAX_SERIAL_2 = 0xFFFFFFFF  # Version 2 packets, a 32-bit serial
+MAX_FRAME_SIZE = MAX_CHUNKS * RAW_SIZE
+EMPTY_BITMAP = bytes(MAX_CHUNKS)
+EMPTY_CHUNK = memoryview(bytes(MAX_PACKET_SIZE))
+MAX_PARTIAL_FRAMES = 8  # Frames being reassembled at once, bounds client memory
+
+### PACING ###
+PACING_BURST = 4 * PACKET_SIZE  # Bytes allowed back to back
+PACING_SPREAD = 0.8  # Part of the frame interval used for sending
+PACING_MIN_SLEEP = 0.0005  # Shorter waits are carried over as debt
+SEND_QUEUE_SIZE = 2  # Frames waiting per agent before the oldest is dropped
+
+### RECEIVING ###
+RECEIVE_BURST = 64  # Datagrams read at once by an Agent that opts into bursts
+
+### BATCHED SENDS ###
+GSO_MAX_SEGMENTS = 64  # Packets the kernel splits one send into, UDP_MAX_SEGMENTS
+GSO_MAX_SIZE = 65535 - IP_UDP_HEADER_SIZE  # A send is one IP packet before splitting
+
+### PIPELINE ###
+ENCODE_WORKERS = 4  # Threads resizing and encoding frames at once
+ENCODE_QUEUE_SIZE = 6  # Frames encoding or waiting to be sent
+
+### STATIC SCENES ###
+STATIC_THUMBNAIL_SIZE = (64, 36)  # Frames are compared at this size
+STATIC_SAMPLE_STEP = 4  # Only every 4th pixel of every 4th row is compared
+STATIC_THRESHOLD = 4  # Largest thumbnail pixel difference of an unchanged frame
+STATIC_REFRESH_INTERVAL = 1.0  # Seconds between frames of an unchanged scene
+
+### TILES ###
+TILE_SIZE = 64  # Pixels, a multiple of 8 so tiles decode at reduced scales
+TILE_THRESHOLD = 12  # Largest pixel difference of an unchanged tile
+TILE_MAX_DIRTY = 0.5  # Part of dirty tiles above which a full frame is sent
+TILE_REFRESH_INTERVAL = 2.0  # Seconds between full frames
+TILE_QUEUE_SIZE = 8  # Tile frames waiting for the decoder before one is lost
+FULL_FRAME_REQUEST_INTERVAL = 0.2  # Seconds between requests for a full frame
+
+### STRIPS ###
+STRIP_HEIGHT = 64  # Pixels, a multiple of 8 so strips decode at reduced scales
+STRIP_MAX_PADDING = 0.25  # Part of a packet left empty to start a strip in the next
+PARTIAL_DELAY = 0.1  # Seconds before the newest incomplete frame is shown in part
+
+### FEC ###
+FEC_RATIO = 0.1  # Parity packets per data packet
+
+### RETRANSMISSION ###
+RETRANSMIT_CACHE_SIZE = 8  # Frames kept by the server
+RETRANSMIT_DEADLINE = 0.25  # Seconds after which a frame is not resent
+NACK_DELAY = 0.01  # Time allowed for reordering before asking again
+NACK_INTERVAL = 0.04  # Between two NACKs for the same frame
+NACK_CHECK_INTERVAL = 0.005
+NACK_MAX_MISSING = 16  # Frames missing more are not worth retransmitting
+
+### ABR ###
+REPORT_INTERVAL = 1.0  # Seconds between client reports
+# (Resolution scale, JPEG quality scale, FPS scale) of the configured settings
+ABR_LEVELS = ((0.5, 0.6, 0.5), (0.5, 1.0, 1.0), (0.75, 1.0, 1.0), (1.0, 1.0, 1.0))
+ABR_DOWN_PACKET_LOSS = 0.05
+ABR_DOWN_FRAME_LOSS = 0.2
+ABR_UP_FRAME_LOSS = 0.02
+ABR_UP_REPORTS = 5  # Clean reports in a row before going up a level
+
+### SIMULCAST ###
+# (Width, Height, JPEG quality) of every tier, lowest first like ABR_LEVELS
+SIMULCAST_TIERS = ((640, 360, 40), (1280, 720, 50), (1920, 1080, 80))
+
+### SENDER PROCESSES ###
+SENDER_PROCESSES = 2  # Processes packetizing and sending, each with its own clients
+RING_SLOTS = 8  # Encoded frames kept in shared memory for the senders
+RING_SLOT_SIZE = MAX_CHUNKS * MAX_PACKET_SIZE  # Larger frames never fit in packets
+LARGE_RING_SLOT_SIZE = 16 * 1024 * 1024  # With version 2 packets, for large frames
+
+### LOCAL CLIENTS ###
+LOCAL_RING_SLOTS = 4  # Frames kept in shared memory for clients on the server's host
+
+### MULTICAST ###
+MULTICAST_GROUP = "239.255.42.99"  # Administratively scoped, stays in the site
+MULTICAST_PORT = 20002
+MULTICAST_TTL = 1  # Hops, 1 keeps packets on the local network
+
+### CONTROL MESSAGES ###
+CONTROL_NACK = 1
+CONTROL_REPORT = 2
+CONTROL_NACK_2 = 3  # For frames of version 2 packets
+CONTROL_TIER = 4  # A client picks its simulcast tier
+CONTROL_FULL_FRAME = 5  # A client lost a tile frame and needs a full frame
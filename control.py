@@ -0,0 +1,90 @@
+import struct
+
+from constents import *
+
+# Type, Body Length
+CONTROL_HEADER = struct.Struct("<BH")
+# Serial, Tail flag, followed by one byte per missing index
+NACK_STRUCT = struct.Struct("<HB")
+# The same with a 32-bit Serial and two bytes per missing index, version 2
+NACK_STRUCT_2 = struct.Struct("<IB")
+INDEX_STRUCT_2 = struct.Struct("<H")
+# Simulcast tier, -1 leaves it to the server's ABR
+TIER_STRUCT = struct.Struct("<b")
+
+
+def encode_message(message_type, body=b"") -> bytes:
+    return CONTROL_HEADER.pack(message_type, len(body)) + body
+
+
+def encode_NACK(serial, indices, tail=False, version=VERSION_1_FLAG) -> bytes:
+    """builds a NACK for the missing chunks of a frame
+
+    :param indices: indices of the missing chunks
+    :type indices: list
+    :param tail: the last chunk was not received, so every chunk after
+        the largest index is missing as well
+    :type tail: bool
+    :param version: version of the frame's packets
+    """
+    if int(version) == int(VERSION_2_FLAG):
+        body = NACK_STRUCT_2.pack(serial, tail) + b"".join(
+            INDEX_STRUCT_2.pack(index) for index in indices
+        )
+        return encode_message(CONTROL_NACK_2, body)
+    body = NACK_STRUCT.pack(serial, tail) + bytes(indices)
+    return encode_message(CONTROL_NACK, body)
+
+
+def decode_NACK(body, message_type=CONTROL_NACK):
+    """:raises ValueError: if the body is too short or splits an index"""
+    if message_type == CONTROL_NACK_2:
+        if (
+            len(body) < NACK_STRUCT_2.size
+            or (len(body) - NACK_STRUCT_2.size) % INDEX_STRUCT_2.size
+        ):
+            raise ValueError("Invalid NACK {}".format(bytes(body)))
+        serial, tail = NACK_STRUCT_2.unpack_from(body)
+        indices = [
+            index for (index,) in INDEX_STRUCT_2.iter_unpack(body[NACK_STRUCT_2.size :])
+        ]
+        return serial, indices, bool(tail)
+    if len(body) < NACK_STRUCT.size:
+        raise ValueError("Invalid NACK {}".format(bytes(body)))
+    serial, tail = NACK_STRUCT.unpack_from(body)
+    return serial, list(body[NACK_STRUCT.size :]), bool(tail)
+
+
+def encode_tier(tier) -> bytes:
+    """builds a request for a simulcast tier, -1 lets the server's ABR pick"""
+    return encode_message(CONTROL_TIER, TIER_STRUCT.pack(tier))
+
+
+def decode_tier(body) -> int:
+    """:raises ValueError: if the body is too short"""
+    if len(body) < TIER_STRUCT.size:
+        raise ValueError("Invalid tier request {}".format(bytes(body)))
+    return TIER_STRUCT.unpack_from(body)[0]
+
+
+class ControlReader:
+    """splits the bytes read from a TCP control socket into messages"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data) -> list:
+        """adds received bytes and returns every complete (type, body) message"""
+        self.buffer += data
+        messages = []
+        read_bytes = 0
+        while len(self.buffer) - read_bytes >= CONTROL_HEADER.size:
+            message_type, length = CONTROL_HEADER.unpack_from(self.buffer, read_bytes)
+            start = read_bytes + CONTROL_HEADER.size
+            if len(self.buffer) < start + length:
+                break
+            messages.append((message_type, bytes(self.buffer[start : start + length])))
+            read_bytes = start + length
+
+        del self.buffer[:read_bytes]
+        return messages
@@ -0,0 +1,398 @@
+import cv2
+import time
+import numpy as np
+
+from collections import deque
+from threading import Condition, Thread
+from protocol import Analytics
+from pipeline import StageTimes
+from tiles import is_tiles, read_tiles
+from strips import is_strips, read_strips
+from constents import *
+
+# cvtColor code from BGR for every output pixel format, None if not needed
+CONVERSIONS = {
+    "BGR": None,
+    "GRAY": None,  # Decoded as grayscale
+    "RGB": cv2.COLOR_BGR2RGB,
+    "I420": cv2.COLOR_BGR2YUV_I420,
+    "NV12": cv2.COLOR_BGR2YUV_I420,  # Chroma planes are interleaved after
+    "YUYV": cv2.COLOR_BGR2YUV_YUYV,
+    "UYVY": cv2.COLOR_BGR2YUV_UYVY,
+}
+REDUCED_COLOR = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+REDUCED_GRAYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def _has_imdecode_dst() -> bool:
+    """newer OpenCV versions decode into a given array instead of a new one"""
+    _, encoded = cv2.imencode(".jpg", np.zeros((8, 8), dtype=np.uint8))
+    try:
+        cv2.imdecode(encoded, cv2.IMREAD_GRAYSCALE, np.empty((8, 8), dtype=np.uint8))
+    except (cv2.error, TypeError):
+        return False
+    return True
+
+
+IMDECODE_DST = _has_imdecode_dst()
+
+
+class DecodeQueue:
+    """frames waiting for the decoder worker
+
+    Like FrameSlot a new frame replaces the ones that were not taken yet,
+    except tile frames: every tile frame only carries the tiles that changed
+    since the frame before it, so they are queued behind each other. A full
+    frame replaces the queued tile frames as well. When more than
+    TILE_QUEUE_SIZE tile frames wait, the oldest one is dropped and the
+    queue is marked as lost until take_lost is called.
+    Queued frames are copied into buffers that are recycled once the frame
+    was decoded or dropped, so frames are queued without allocations.
+    """
+
+    def __init__(self):
+        self.items = deque()
+        self.buffers = []  # Recycled buffers, free for the next frames
+        self.closed = False
+        self.lost = False
+        self.condition = Condition()
+        self.analytics = Analytics()
+
+    def copy(self, data) -> memoryview:
+        """copies a frame into a recycled buffer, a new one if none is large enough"""
+        size = len(data)
+        self.condition.acquire()
+        buffer = self.buffers.pop() if self.buffers else None
+        self.condition.release()
+        if buffer is None or len(buffer) < size:
+            buffer = bytearray(size + size // 4)  # Room for larger frames
+        view = memoryview(buffer)[:size]
+        view[:] = data
+        return view
+
+    def recycle(self, data):
+        """frees the buffer of a frame that was decoded"""
+        if isinstance(data, memoryview):
+            self.condition.acquire()
+            self.buffers.append(data.obj)
+            self.condition.release()
+
+    def _drop(self, item):
+        """must hold the lock"""
+        if isinstance(item[0], memoryview):
+            self.buffers.append(item[0].obj)
+        self.analytics.add_frames_dropped()
+
+    def publish(self, item, replace=True):
+        """queues a frame in place of the ones that were not taken yet
+
+        :param replace: replace frames that were not taken yet, otherwise
+            the new frame is only queued if none is waiting
+        :type replace: bool
+        """
+        self.condition.acquire()
+        if self.items and not replace:
+            self.condition.release()
+            return
+        while self.items:
+            self._drop(self.items.popleft())
+        self.items.append(item)
+        self.analytics.add_frames_received()
+        self.condition.notify()
+        self.condition.release()
+
+    def append(self, item):
+        """queues a tile frame behind the frames that were not taken yet"""
+        self.condition.acquire()
+        if len(self.items) >= TILE_QUEUE_SIZE:
+            self._drop(self.items.popleft())
+            self.lost = True
+        self.items.append(item)
+        self.analytics.add_frames_received()
+        self.condition.notify()
+        self.condition.release()
+
+    def take(self):
+        """waits for the oldest queued frame, None once closed"""
+        self.condition.acquire()
+        while not self.items and not self.closed:
+            self.condition.wait()
+        item = self.items.popleft() if self.items else None
+        self.condition.release()
+        return item
+
+    def set_lost(self):
+        self.condition.acquire()
+        self.lost = True
+        self.condition.release()
+
+    def take_lost(self) -> bool:
+        """True if a tile frame was lost since the last call"""
+        self.condition.acquire()
+        lost = self.lost
+        self.lost = False
+        self.condition.release()
+        return lost
+
+    def close(self):
+        self.condition.acquire()
+        self.closed = True
+        self.condition.notify_all()
+        self.condition.release()
+
+    def get_analytics(self):
+        return self.analytics
+
+
+class FrameDecoder:
+    """decodes received frames straight into the output size and pixel format
+
+    When the output is at least 2, 4 or 8 times smaller than the source the
+    JPEG is decoded at that scale, which skips most of the decoding work.
+    Resizing and color conversion write into buffers that are allocated
+    once and reused, so a returned frame is only valid until the next one.
+    Where OpenCV supports it (IMDECODE_DST), full frames are decoded into
+    the canvas of the frame before as well.
+    Frames can be decoded on a worker thread that always takes the newest
+    submitted frame, or every tile frame in order (see DecodeQueue).
+    Tile frames are pasted onto the last full frame, decoded at the same
+    scale, which is kept as the canvas. Strip frames are pasted onto the
+    canvas as well, so strips lost on the way keep the previous frame's rows.
+    """
+
+    def __init__(self, res_w, res_h, pixel_format="BGR"):
+        if pixel_format not in CONVERSIONS:
+            raise ValueError("Unsupported pixel format {}".format(pixel_format))
+        if pixel_format in ("I420", "NV12") and (res_w % 2 or res_h % 2):
+            raise ValueError("{} needs an even resolution".format(pixel_format))
+
+        self.res_w = res_w
+        self.res_h = res_h
+        self.pixel_format = pixel_format
+        self.source_size = None  # (width, height) of the last decoded frame
+        self.canvas = None  # Last full frame, tiles are pasted onto it
+        self.canvas_scale = 1
+        if pixel_format == "GRAY":
+            self.flags = REDUCED_GRAYSCALE
+            self.resized = np.empty((res_h, res_w), dtype=np.uint8)
+        else:
+            self.flags = REDUCED_COLOR
+            self.resized = np.empty((res_h, res_w, 3), dtype=np.uint8)
+
+        if pixel_format in ("I420", "NV12"):
+            self.output = np.empty((res_h * 3 // 2, res_w), dtype=np.uint8)
+        elif pixel_format in ("YUYV", "UYVY"):
+            self.output = np.empty((res_h, res_w, 2), dtype=np.uint8)
+        elif pixel_format == "RGB":
+            self.output = np.empty((res_h, res_w, 3), dtype=np.uint8)
+        else:
+            self.output = self.resized
+        self.planar = np.empty_like(self.output) if pixel_format == "NV12" else None
+
+        self.queue = DecodeQueue()
+        self.stage_times = StageTimes()
+        self.thread = None
+        self.last_frame = None  # Last decoded frame, for repeats
+
+    def get_scale(self) -> int:
+        """the largest JPEG scale that still covers the output size"""
+        if self.source_size is None:
+            return 1
+        width, height = self.source_size
+        for scale in (8, 4, 2):
+            if width // scale >= self.res_w and height // scale >= self.res_h:
+                return scale
+        return 1
+
+    def decode(self, data, partial=False):
+        """decodes an encoded frame into the output size and pixel format
+
+        :param data: encoded frame
+        :type data: bytes
+        :param partial: the frame lost packets, only its intact strips are used
+        :type partial: bool
+        :return: the frame, None if it could not be decoded
+        :rtype: np.ndarray
+        """
+        start_time = time.perf_counter()
+        if partial or is_strips(data):
+            frame = self._decode_strips(data)
+        elif is_tiles(data):
+            frame = self._decode_tiles(data)
+        else:
+            frame = self._decode_full(data)
+        if frame is None:
+            return None
+        self.stage_times.add("decode", time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        if frame.shape[:2] != (self.res_h, self.res_w):
+            frame = cv2.resize(
+                frame,
+                (self.res_w, self.res_h),
+                dst=self.resized,
+            )
+        frame = self._convert(frame)
+        self.stage_times.add("convert", time.perf_counter() - start_time)
+        return frame
+
+    def _decode_full(self, data):
+        scale = self.get_scale()
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        if IMDECODE_DST and self.canvas is not None:
+            # Reallocated by OpenCV when the size or scale changed
+            frame = cv2.imdecode(buffer, self.flags[scale], self.canvas)
+        else:
+            frame = cv2.imdecode(buffer, self.flags[scale])
+        if frame is None or frame.size == 0:
+            if IMDECODE_DST:
+                self.canvas = None  # May hold part of the broken frame
+            return None
+        # Reduced decoding rounds up, so this can be a few pixels too large
+        self.source_size = (frame.shape[1] * scale, frame.shape[0] * scale)
+        self.canvas = frame
+        self.canvas_scale = scale
+        return frame
+
+    def _decode_tiles(self, data):
+        """pastes the tiles onto the canvas, None until a full frame of the same size arrived"""
+        width, height, tile_size, tiles = read_tiles(data)
+        scale = self.canvas_scale
+        if self.canvas is None or self.canvas.shape[:2] != (
+            -(-height // scale),
+            -(-width // scale),
+        ):
+            return None
+
+        step = tile_size // scale
+        for column, row, encoded in tiles:
+            tile = cv2.imdecode(
+                np.frombuffer(encoded, dtype=np.uint8), self.flags[scale]
+            )
+            if tile is None:
+                continue
+            y = row * step
+            x = column * step
+            target = self.canvas[y : y + tile.shape[0], x : x + tile.shape[1]]
+            if target.shape == tile.shape:
+                target[...] = tile
+        return self.canvas
+
+    def _decode_strips(self, data):
+        """pastes the intact strips onto the canvas, None if none arrived"""
+        strips = read_strips(data)
+        if not strips:
+            return None
+        width, height = strips[0][:2]
+        self.source_size = (width, height)
+        scale = self.get_scale()
+        shape = (-(-height // scale), -(-width // scale)) + self.resized.shape[2:]
+        if self.canvas is None or self.canvas.shape != shape:
+            self.canvas = np.zeros(shape, dtype=np.uint8)
+        self.canvas_scale = scale
+
+        for strip_width, strip_height, row, encoded in strips:
+            if (strip_width, strip_height) != (width, height):
+                continue
+            strip = cv2.imdecode(
+                np.frombuffer(encoded, dtype=np.uint8), self.flags[scale]
+            )
+            if strip is None:
+                continue
+            y = row // scale
+            target = self.canvas[y : y + strip.shape[0], : strip.shape[1]]
+            if target.shape == strip.shape:
+                target[...] = strip
+        return self.canvas
+
+    def _convert(self, frame):
+        code = CONVERSIONS[self.pixel_format]
+        if code is None:
+            return frame
+        if self.pixel_format != "NV12":
+            return cv2.cvtColor(frame, code, dst=self.output)
+
+        cv2.cvtColor(frame, code, dst=self.planar)
+        luma = self.res_w * self.res_h
+        planar = self.planar.reshape(-1)
+        chroma = self.output.reshape(-1)[luma:].reshape(-1, 2)
+        self.output.reshape(-1)[:luma] = planar[:luma]
+        chroma[:, 0] = planar[luma : luma + luma // 4]
+        chroma[:, 1] = planar[luma + luma // 4 :]
+        return self.output
+
+    def start(self, output):
+        """decodes submitted frames on a worker thread
+
+        :param output: called with every decoded frame and the time its
+            data completed, which is None for repeated frames
+        :type output: function
+        """
+        self.thread = Thread(target=self._work, args=(output,))
+        self.thread.start()
+
+    def stop(self):
+        self.queue.close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, data, complete_time=0.0, partial=False):
+        """hands a frame to the worker, replacing the ones it did not take yet
+
+        Tile frames are queued instead, since they need the frames before them.
+        The data is copied into a recycled buffer, so pooled receive buffers
+        can be reused right away.
+        """
+        item = (self.queue.copy(data), complete_time, partial)
+        if not partial and is_tiles(item[0]):
+            self.queue.append(item)
+        else:
+            self.queue.publish(item)
+
+    def repeat(self):
+        """outputs the last decoded frame again, unless a new frame is waiting"""
+        self.queue.publish((b"", None, False), replace=False)
+
+    def take_lost(self) -> bool:
+        """True if tile frames were lost since the last call
+
+        Either one was dropped from a full queue or it arrived without a
+        canvas to paste onto, in both cases only a full frame repairs the
+        output.
+        """
+        return self.queue.take_lost()
+
+    def _work(self, output):
+        while True:
+            item = self.queue.take()
+            if item is None:
+                return  # Closed
+            data, complete_time, partial = item
+            if data:
+                frame = self.decode(data, partial)
+                if frame is None and not partial and is_tiles(data):
+                    self.queue.set_lost()
+                self.queue.recycle(data)
+                if frame is None:
+                    continue
+                self.last_frame = frame
+            if self.last_frame is not None:
+                output(self.last_frame, complete_time)
+
+    def get_analytics(self):
+        """received counts submitted frames, dropped the ones replaced before decoding"""
+        return self.queue.get_analytics()
+
+    def get_stage_times(self) -> StageTimes:
+        return self.stage_times
@@ -0,0 +1,138 @@
+import ipaddress
+import struct
+
+from threading import Lock
+from protocol import Analytics
+from ring import FrameRing
+from constents import *
+
+# Sequence of the new frame in the ring
+WAKE = struct.Struct("<Q")
+
+
+def is_local_peer(sock) -> bool:
+    """True when the other end of a connected socket is on this host"""
+    peer = sock.getpeername()[0]
+    return ipaddress.ip_address(peer).is_loopback or peer == sock.getsockname()[0]
+
+
+class LocalSender:
+    """hands encoded frames to clients on the same host through a FrameRing
+
+    Every frame is copied once into shared memory, instead of being split
+    into packets, and each client is woken by a datagram with the frame's
+    sequence sent to its UDP socket.
+    Frames and repeats come from different threads, so a frame is written
+    and announced under one lock, every sequence is written once and the
+    wake messages leave in sequence order.
+    """
+
+    def __init__(self, udp_sock, slots=LOCAL_RING_SLOTS, slot_size=RING_SLOT_SIZE):
+        self.udp_sock = udp_sock
+        self.ring = FrameRing(slots, slot_size)
+        self.lock = Lock()
+        self.write_lock = Lock()
+        self.addrs = []
+        self.analytics = Analytics()
+
+    def get_name(self) -> str:
+        return self.ring.get_name()
+
+    def add_client(self, addr):
+        self.lock.acquire()
+        self.addrs.append(addr)
+        self.lock.release()
+
+    def remove_client(self, addr):
+        self.lock.acquire()
+        if addr in self.addrs:
+            self.addrs.remove(addr)
+        self.lock.release()
+
+    def has_client(self, addr) -> bool:
+        return addr in self.addrs
+
+    def has_clients(self) -> bool:
+        return len(self.addrs) > 0
+
+    def publish(self, data, serial) -> bool:
+        """writes a frame to the ring and wakes every client
+
+        :return: False if the frame does not fit in a ring slot
+        :rtype: bool
+        """
+        self.write_lock.acquire()
+        sequence = self.ring.write(data, serial)
+        if not sequence:
+            self.write_lock.release()
+            return False
+        wake = WAKE.pack(sequence)
+        self.lock.acquire()
+        addrs = list(self.addrs)
+        self.lock.release()
+        for addr in addrs:
+            try:
+                self.udp_sock.sendto(wake, addr)
+            except OSError:
+                pass  # Removed once its TCP connection is found closed
+        self.write_lock.release()
+        if data:
+            self.analytics.add_frames_sent(len(addrs))
+            self.analytics.add_bytes_sent(len(data))
+        else:
+            self.analytics.add_frames_repeated(len(addrs))
+        return True
+
+    def publish_repeat(self, serial):
+        """tells every client to show the last frame again"""
+        self.publish(b"", serial)
+
+    def get_analytics(self) -> Analytics:
+        return self.analytics
+
+    def close(self):
+        self.ring.close()
+        self.ring.unlink()
+
+
+class LocalReceiver:
+    """reads the frames a LocalSender on the same host points to
+
+    The ring is left to the server to unlink, unless track is set, see
+    FrameRing.
+    """
+
+    def __init__(self, name, analytics=None, track=False):
+        self.ring = FrameRing(name=name, track=track)
+        self.analytics = Analytics() if analytics is None else analytics
+
+    def read(self, message):
+        """copies out the frame a wake message points to
+
+        :return: the frame, empty for a repeat, and its serial, -1 when the
+            message is not a wake message or the frame was already overwritten
+        :rtype: tuple
+        """
+        if len(message) != WAKE.size:
+            return b"", -1
+        (sequence,) = WAKE.unpack(message)
+        item = self.ring.read(sequence)
+        if item is None:
+            self.analytics.add_frames_dropped()
+            return b"", -1
+        serial, view, _ = item
+        data = bytes(view)
+        view.release()
+        if not self.ring.is_valid(sequence):
+            self.analytics.add_frames_dropped()  # Overwritten while copying
+            return b"", -1
+        if not data:
+            self.analytics.add_frames_repeated()
+            return data, serial
+        self.analytics.add_frames_received()
+        self.analytics.add_good_frames()
+        self.analytics.add_bytes_received(len(data))
+        return data, serial
+
+    def close(self):
+        self.ring.close()
@@ -0,0 +1,75 @@
+import time
+
+from threading import Lock
+from constents import *
+from protocol import Analytics
+
+
+class Pacer:
+    """token bucket that paces packets from every agent of a server
+
+    The bucket is measured in bytes. Sending takes tokens up front and the
+    caller sleeps off any debt, so packets leave evenly at the target rate
+    with at most burst bytes sent back to back.
+    When no rate is given the pacer is in auto mode and the rate is fitted
+    to every frame so its packets are spread over the frame interval.
+    """
+
+    def __init__(self, rate=None, burst=PACING_BURST):
+        self.auto = rate is None
+        self.rate = float(rate or 0)  # bytes/s, 0 means unlimited
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_time = time.perf_counter()
+        self.lock = Lock()
+        self.analytics = Analytics()
+        self.analytics.set_target_rate(self.rate)
+
+    def set_rate(self, rate, burst=None):
+        self.lock.acquire()
+        self.rate = float(rate)
+        if burst is not None:
+            self.burst = burst
+        self.lock.release()
+        self.analytics.set_target_rate(self.rate)
+
+    def spread(self, frame_bytes, interval):
+        """fits the rate so frame_bytes are sent within PACING_SPREAD of interval
+
+        :param frame_bytes: bytes that will be sent for this frame by all agents
+        :type frame_bytes: int
+        :param interval: time between frames in seconds
+        :type interval: float
+        """
+        if not self.auto or frame_bytes == 0:
+            return
+        self.set_rate(frame_bytes / (interval * PACING_SPREAD))
+
+    def consume(self, amount):
+        """blocks until amount bytes may be sent"""
+        self.lock.acquire()
+        self.analytics.add_bytes_sent(amount)
+        if self.rate <= 0:
+            self.lock.release()
+            return
+
+        current_time = time.perf_counter()
+        self.tokens = min(
+            self.burst, self.tokens + (current_time - self.last_time) * self.rate
+        )
+        self.last_time = current_time
+        self.tokens -= amount
+        wait = -self.tokens / self.rate
+        self.lock.release()
+
+        if wait > PACING_MIN_SLEEP:
+            time.sleep(wait)
+
+    def get_rate(self) -> float:
+        return self.rate
+
+    def get_burst(self) -> int:
+        return self.burst
+
+    def get_analytics(self) -> Analytics:
+        return self.analytics
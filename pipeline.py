@@ -0,0 +1,169 @@
+import time
+
+from threading import Thread, Lock, Condition
+from capture import FrameSlot
+from constents import *
+
+
+class StageTimes:
+    """average time spent per frame in each stage of the server"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        self.total = dict()
+        self.count = dict()
+        self.lock.release()
+
+    def add(self, stage, seconds):
+        self.lock.acquire()
+        self.total[stage] = self.total.get(stage, 0.0) + seconds
+        self.count[stage] = self.count.get(stage, 0) + 1
+        self.lock.release()
+
+    def get_average(self, stage) -> float:
+        """average time in ms, 0 when the stage did not run"""
+        self.lock.acquire()
+        count = self.count.get(stage, 0)
+        total = self.total.get(stage, 0.0)
+        self.lock.release()
+        if count == 0:
+            return 0.0
+        return total / count * 1000
+
+    def get_count(self, stage) -> int:
+        return self.count.get(stage, 0)
+
+
+REPEAT = object()  # Published in place of a frame that did not change
+
+
+class EncodePipeline:
+    """encodes frames from a FrameSlot on several workers, in capture order
+
+    OpenCV releases the GIL while resizing and encoding, so the workers run
+    in parallel. Every frame keeps the index it was published with, and
+    get() only hands out a frame once every earlier frame a worker took is
+    done, so frames leave in order. At most queue_size frames are taken and
+    not handed out yet, past that the workers stop taking and the slot
+    keeps only the newest frame. Repeats go through the same order, so a
+    repeat never overtakes a changed frame that is still encoding.
+    """
+
+    def __init__(
+        self,
+        frame_slot: FrameSlot,
+        encode,
+        workers=ENCODE_WORKERS,
+        queue_size=ENCODE_QUEUE_SIZE,
+        stage_times=None,
+    ):
+        self.frame_slot = frame_slot
+        self.encode = encode  # frame -> (status, bytes)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.stage_times = StageTimes() if stage_times is None else stage_times
+        self.RUN = False
+        self.threads = []
+        self.take_lock = Lock()  # Frames are taken and registered in order
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.in_flight = set()  # Indices being encoded
+        self.done = dict()  # Encoded frames by index, None when encoding failed
+
+    def start(self):
+        self.RUN = True
+        for _ in range(self.workers):
+            thread = Thread(target=self._work)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.lock.acquire()
+        self.RUN = False
+        self.changed.notify_all()
+        self.lock.release()
+        self.frame_slot.close()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _work(self):
+        while self.RUN:
+            self.lock.acquire()
+            while self.RUN and len(self.in_flight) + len(self.done) >= self.queue_size:
+                self.changed.wait()
+            self.lock.release()
+
+            self.take_lock.acquire()
+            frame, index = self.frame_slot.take()
+            if frame is not None:
+                self.lock.acquire()
+                self.in_flight.add(index)
+                self.lock.release()
+            self.take_lock.release()
+            if frame is None:
+                continue
+
+            if frame is REPEAT:
+                status, data = True, b""
+            else:
+                start_time = time.perf_counter()
+                status, data = self.encode(frame)
+                self.stage_times.add("encode", time.perf_counter() - start_time)
+
+            self.lock.acquire()
+            self.in_flight.discard(index)
+            self.done[index] = data if status else None
+            self.changed.notify_all()
+            self.lock.release()
+
+    def repeat(self):
+        """queues a repeat behind the frames taken so far, unless a frame is waiting
+
+        get() hands it out as empty data, like a tile frame without changes.
+        """
+        self.frame_slot.publish(REPEAT, replace=False)
+
+    def _next_index(self):
+        """the smallest done index with no earlier frame still encoding"""
+        if not self.done:
+            return -1
+        index = min(self.done)
+        if self.in_flight and min(self.in_flight) < index:
+            return -1
+        return index
+
+    def get(self, timeout=None):
+        """waits for the next encoded frame in capture order
+
+        :return: the encoded frame and its index, empty for a repeat, or
+            (b"", -1) on timeout or once stopped
+        :rtype: tuple
+        """
+        self.lock.acquire()
+        while True:
+            index = self._next_index()
+            if index != -1:
+                data = self.done.pop(index)
+                self.changed.notify_all()
+                if data is None:
+                    continue  # Encoding failed, the next frame may be ready
+                self.lock.release()
+                return data, index
+            if not self.RUN or not self.changed.wait(timeout):
+                self.lock.release()
+                return b"", -1
+
+    def get_queue_depths(self) -> tuple:
+        """frames encoding and frames encoded but waiting to be sent"""
+        self.lock.acquire()
+        depths = len(self.in_flight), len(self.done)
+        self.lock.release()
+        return depths
+
+    def get_stage_times(self) -> StageTimes:
+        return self.stage_times
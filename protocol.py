@@ -1,11 +1,56 @@
 import binascii
+import errno
+import struct
+import sys
 import time
 import logging
 import socket
 import numpy as np
 
-from threading import Lock
+from collections import deque
+from threading import Condition, Lock, Thread
 from constents import *
+from codec import (
+    PacketView,
+    ReceiveRing,
+    build_flags,
+    encode_into,
+    get_batches,
+    get_chunk_size,
+    get_max_chunks,
+    get_max_serial,
+)
+from control import ControlReader, encode_NACK, encode_message, encode_tier
+from abr import ABRController, Report
+
+logger = logging.getLogger(__name__)
+
+UDP_SEGMENT = 103  # Linux SOL_UDP option, not exported by the socket module
+IP_MTU = 14  # Linux getsockopt option, not exported by the socket module
+GSO_SIZE = struct.Struct("=H")  # Segment size in the UDP_SEGMENT control message
+# Errors of kernels or devices that can not split sends, or of segments larger
+# than the MTU, which the kernel does not fragment, anything else is real
+GSO_ERRORS = (
+    errno.EINVAL,
+    errno.ENOPROTOOPT,
+    errno.EOPNOTSUPP,
+    errno.EIO,
+    errno.EMSGSIZE,
+)
+
+
+def get_route_MTU(addr):
+    """MTU of the route to addr, None where it can not be read"""
+    if addr is None or not sys.platform.startswith("linux"):
+        return None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(addr)  # Only picks the route, nothing is sent
+        return sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+    finally:
+        sock.close()
 
 
 class Analytics:
@@ -13,13 +58,29 @@ class Analytics:
         self.packets_sent = 0
         self.packets_received = 0
         self.packets_CRC_error = 0
+        self.packets_header_error = 0  # Wrong cookie or lengths, not from us
+        self.packets_recovered = 0
+        self.packets_retransmitted = 0
+        self.NACKs_sent = 0
         self.frames_sent = 0
         self.frames_received = 0
         self.good_frames = 0
+        self.frames_partial = 0
+        self.frames_dropped = 0
+        self.frames_expired = 0
+        self.frames_evicted = 0
+        self.frames_repeated = 0
+        self.display_latency = 0.0
+        self.displayed_frames = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.target_rate = 0.0
         self.init_time = time.time()
 
     def reset(self):
+        target_rate = self.target_rate  # A setting, not a counter
         self.__init__()
+        self.target_rate = target_rate
 
     def add_packets_sent(self, amount=1):
         self.packets_sent += amount
@@ -33,6 +94,18 @@ class Analytics:
     def add_packets_CRC_error(self, amount=1):
         self.packets_CRC_error += amount
 
+    def add_packets_header_error(self, amount=1):
+        self.packets_header_error += amount
+
+    def add_packets_recovered(self, amount=1):
+        self.packets_recovered += amount
+
+    def add_packets_retransmitted(self, amount=1):
+        self.packets_retransmitted += amount
+
+    def add_NACKs_sent(self, amount=1):
+        self.NACKs_sent += amount
+
     def add_frames_sent(self, amount=1):
         self.frames_sent += amount
 
@@ -42,9 +115,37 @@ class Analytics:
     def add_good_frames(self, amount=1):
         self.good_frames += amount
 
+    def add_frames_partial(self, amount=1):
+        self.frames_partial += amount
+
     def set_frames_received(self, amount):
         self.frames_received = amount
 
+    def add_frames_dropped(self, amount=1):
+        self.frames_dropped += amount
+
+    def add_frames_expired(self, amount=1):
+        self.frames_expired += amount
+
+    def add_frames_evicted(self, amount=1):
+        self.frames_evicted += amount
+
+    def add_frames_repeated(self, amount=1):
+        self.frames_repeated += amount
+
+    def add_display_latency(self, latency):
+        self.display_latency += latency
+        self.displayed_frames += 1
+
+    def add_bytes_sent(self, amount):
+        self.bytes_sent += amount
+
+    def add_bytes_received(self, amount):
+        self.bytes_received += amount
+
+    def set_target_rate(self, rate):
+        self.target_rate = rate
+
     def get_packets_sent(self) -> int:
         return self.packets_sent
 
@@ -60,9 +161,42 @@ class Analytics:
     def get_good_frames(self) -> int:
         return self.good_frames
 
+    def get_frames_partial(self) -> int:
+        return self.frames_partial
+
+    def get_frames_dropped(self) -> int:
+        return self.frames_dropped
+
+    def get_frames_expired(self) -> int:
+        return self.frames_expired
+
+    def get_frames_evicted(self) -> int:
+        return self.frames_evicted
+
+    def get_frames_repeated(self) -> int:
+        return self.frames_repeated
+
+    def get_display_latency(self) -> float:
+        """average time in ms from a frame's last chunk to its display"""
+        if self.displayed_frames == 0:
+            return 0.0
+        return self.display_latency / self.displayed_frames * 1000
+
     def get_packet_CRC(self):
         return self.packets_CRC_error
 
+    def get_packets_header_error(self) -> int:
+        return self.packets_header_error
+
+    def get_packets_recovered(self) -> int:
+        return self.packets_recovered
+
+    def get_packets_retransmitted(self) -> int:
+        return self.packets_retransmitted
+
+    def get_NACKs_sent(self) -> int:
+        return self.NACKs_sent
+
     def get_packet_lost(self):
         return float(self.packets_received) / self.packets_sent * 100
 
@@ -77,17 +211,22 @@ class Analytics:
         return float(self.frames_received) / self.frames_sent * 100
 
     def get_bits_sent(self):
-        return self.packets_sent * PACKET_SIZE * 8
+        return self.bytes_sent * 8
 
     def get_bits_received(self):
-        return self.packets_received * PACKET_SIZE * 8
+        return self.bytes_received * 8
 
     def get_bitrate(self):
-        return (
-            float(self.packets_sent * PACKET_SIZE * 8)
-            / (time.time() - self.init_time)
-            / 1000000
-        )
+        return float(self.bytes_sent * 8) / (time.time() - self.init_time) / 1000000
+
+    def get_bytes_sent(self) -> int:
+        return self.bytes_sent
+
+    def get_target_rate(self) -> float:
+        return self.target_rate
+
+    def get_achieved_rate(self) -> float:
+        return float(self.bytes_sent) / (time.time() - self.init_time)
 
     def get_received_framerate(self):
         return float(self.frames_received) / (time.time() - self.init_time)
@@ -156,30 +295,30 @@ class Packet:
         ).tobytes()
 
         written_bytes += FLAGS_SIZE
-        self.Raw[
-            written_bytes : written_bytes + INDEX_SIZE
-        ] = self.Index.tobytes()  # Index
+        self.Raw[written_bytes : written_bytes + INDEX_SIZE] = (
+            self.Index.tobytes()
+        )  # Index
 
         written_bytes += INDEX_SIZE
-        self.Raw[
-            written_bytes : written_bytes + SERIAL_SIZE
-        ] = self.Serial.tobytes()  # Serial
+        self.Raw[written_bytes : written_bytes + SERIAL_SIZE] = (
+            self.Serial.tobytes()
+        )  # Serial
 
         written_bytes += SERIAL_SIZE
-        self.Raw[
-            written_bytes : written_bytes + DATA_LENGTH_SIZE
-        ] = self.Data_Length.tobytes()  # Data Length
+        self.Raw[written_bytes : written_bytes + DATA_LENGTH_SIZE] = (
+            self.Data_Length.tobytes()
+        )  # Data Length
 
         written_bytes += DATA_LENGTH_SIZE
-        self.Raw[
-            written_bytes : written_bytes + PAYLOAD_LENGTH_SIZE
-        ] = self.Payload_Length.tobytes()  # Payload Length
+        self.Raw[written_bytes : written_bytes + PAYLOAD_LENGTH_SIZE] = (
+            self.Payload_Length.tobytes()
+        )  # Payload Length
 
         written_bytes += PAYLOAD_LENGTH_SIZE
         if self.Payload:
-            self.Raw[
-                written_bytes : written_bytes + self.Payload_Length
-            ] = self.Payload.encode()
+            self.Raw[written_bytes : written_bytes + self.Payload_Length] = (
+                self.Payload.encode()
+            )
 
         written_bytes += self.Payload_Length
         self.Raw[written_bytes : written_bytes + self.Data_Length] = self.Data
@@ -267,14 +406,14 @@ class Packet:
 class Data:
     def __init__(self, data):
         self.raw = data
+        self.view = memoryview(data)
         self.pointer = 0
         self.end = False
         self.size = len(data)
-        if self.size > 0:
-            self.CRC = np.uint32(binascii.crc32(data))
+        self.CRC = None  # Calculated on first use
 
     def get_data_chunk(self, size):
-        sliced_data = self.raw[self.pointer : self.pointer + size]
+        sliced_data = self.view[self.pointer : self.pointer + size]
         self.move_pointer(size)
         return sliced_data
 
@@ -292,6 +431,8 @@ class Data:
         return self.end
 
     def get_CRC(self):
+        if self.CRC is None and self.size > 0:
+            self.CRC = np.uint32(binascii.crc32(self.raw))
         return self.CRC
 
     def get_data(self):
@@ -304,37 +445,506 @@ class Data:
         return Data(self.raw)
 
     def __str__(self) -> str:
-        return "{}...{}".format(str(self.raw[:16]), str(self.raw[-17:]))
+        return "{}...{}".format(bytes(self.raw[:16]), bytes(self.raw[-17:]))
+
+
+def _grow(buffer, size) -> bytearray:
+    grown = bytearray(size)
+    grown[: len(buffer)] = buffer
+    return grown
 
 
 class PacketList:
-    def __init__(self, packet: Packet) -> None:
+    """reassembles a single frame in place inside a preallocated buffer
+
+    Chunk i is copied once to i * stride, where the stride is the chunk
+    size of the frame. The first chunk is shorter by the length of its
+    payload, so it is written right-aligned to end at the stride and the
+    frame is handed out as a memoryview starting at that offset.
+    With FEC on, every chunk slot is a row of the XOR parity groups, so a
+    single lost chunk per group is rebuilt straight into its slot.
+    The buffers hold MAX_CHUNKS chunks and grow for frames of version 2
+    packets, which announce their size in the first packet.
+    """
+
+    def __init__(self, packet_size=PACKET_SIZE) -> None:
+        self.packet_size = packet_size
+        self.chunk_size = get_chunk_size(packet_size)
+        self.buffer = bytearray(MAX_CHUNKS * self.chunk_size)
+        self.view = memoryview(self.buffer)
+        self.received = bytearray(MAX_CHUNKS)  # Bitmap of received chunks
+        self.parity = None  # Allocated on the first parity packet
+        self.parity_received = bytearray(MAX_CHUNKS)
+        self.reset()
+
+    def reset(self, serial=-1):
         self.init_time = time.time()
-        self.packets = dict()
+        self.serial = serial
+        self.stride = self.chunk_size
+        self.version = int(VERSION_1_FLAG)
+        self.layout = -1  # Version and FEC flag of the frame's packets
+        self.received[:] = EMPTY_BITMAP
+        self.parity_received[:] = EMPTY_BITMAP
+        self.num_of_received = 0
         self.num_of_packets = -1  # Gets its value when last packet is received
-        self.add_packet(packet)
+        self.num_of_recovered = 0
+        self.group_size = 0  # Gets its value when a parity packet is received
+        self.groups = 0
+        self.max_index = -1
+        self.start = 0
+        self.end = 0
+        self.complete_time = 0.0
+        self.last_NACK_time = 0.0
+
+    def add_packet(self, packet: PacketView) -> bool:
+        if packet.get_layout() != self.layout:
+            self._set_layout(packet)
+        if packet.is_parity():
+            return self._add_parity(packet)
+
+        index = packet.get_index()
+        if index >= len(self.received):
+            self._reserve(index + 1)
+        if self.received[index]:
+            return False
 
-    def add_packet(self, packet: Packet):
-        self.packets[str(packet.get_index())] = packet
+        data = packet.get_data()
+        length = len(data)
+        stride = self.stride
+        if index == 0:
+            offset = stride - length
+            if self.version == int(VERSION_2_FLAG) and not self._read_size(
+                packet.get_payload(), length
+            ):
+                return False
+        else:
+            offset = index * stride
+
+        if offset < 0 or length > stride or offset + length > len(self.buffer):
+            return False
+
+        self.view[offset : offset + length] = data
+        self.received[index] = 1
+        self.num_of_received += 1
+        self.max_index = max(self.max_index, index)
+        if index == 0:
+            self.start = offset
+            self.view[:offset] = EMPTY_CHUNK[:offset]
         if packet.is_last():
-            self.num_of_packets = int(packet.get_index()) + 1
+            self.num_of_packets = index + 1
+            self.end = offset + length
+            padding = stride - length if index else 0
+            self.view[self.end : self.end + padding] = EMPTY_CHUNK[:padding]
+
+        if self.group_size:
+            self._recover(index % self.groups)
+        if self.is_complete():
+            self.complete_time = time.perf_counter()
+        return True
+
+    def _set_layout(self, packet: PacketView):
+        """takes the chunk size of the frame from the version and FEC flag of its packets"""
+        self.layout = packet.get_layout()
+        self.version = packet.get_version()
+        self.stride = get_chunk_size(
+            self.packet_size, packet.get_FEC_flag(), self.version
+        )
+
+    def _reserve(self, chunks):
+        """grows the buffers to hold at least chunks chunks, keeping their content
+
+        New buffers replace the old ones instead of resizing them, frames
+        handed out earlier may still be viewing the old ones.
+        """
+        chunks = min(max(chunks, 2 * len(self.received)), get_max_chunks(self.version))
+        if chunks > len(self.received):
+            self.received = _grow(self.received, chunks)
+            self.parity_received = _grow(self.parity_received, chunks)
+        size = chunks * self.stride
+        if size > len(self.buffer):
+            self.buffer = _grow(self.buffer, size)
+            self.view = memoryview(self.buffer)
+        if self.parity is not None and size > len(self.parity):
+            self.parity = _grow(self.parity, size)
+
+    def _read_size(self, payload: str, length) -> bool:
+        """makes room for the frame size announced by the first packet
+
+        :return: False if the announced size is invalid
+        :rtype: bool
+        """
+        try:
+            size = int(payload[FRAME_CRC_SIZE:])
+        except ValueError:
+            return False
+        chunks = 1 + -(-(size - length) // self.stride)
+        if size < length or chunks > get_max_chunks(self.version):
+            return False
+        self._reserve(chunks)
+        return True
+
+    def _add_parity(self, packet: PacketView) -> bool:
+        group = packet.get_index()
+        data = packet.get_data()
+        stride = self.stride
+        if len(data) != stride:
+            return False
+
+        if not self.group_size:
+            try:
+                self._set_FEC_info(packet.get_payload())
+            except ValueError:
+                return False
+        if group >= self.groups or self.parity_received[group]:
+            return False
+
+        if self.parity is None:
+            self.parity = bytearray(len(self.buffer))
+        self.parity[group * stride : (group + 1) * stride] = data
+        self.parity_received[group] = 1
+
+        self._recover(group)
+        if self.is_complete():
+            self.complete_time = time.perf_counter()
+        return True
+
+    def _set_FEC_info(self, payload: str):
+        """reads the frame layout sent in every parity packet"""
+        size = int(payload[:8])
+        first_length = int(payload[8:12])
+        group_size = int(payload[12:16])
+        if group_size == 0 or first_length > self.stride or size < first_length:
+            raise ValueError("Invalid FEC info {}".format(payload))
+
+        num_of_packets = 1 + -(-(size - first_length) // self.stride)
+        if num_of_packets > get_max_chunks(self.version):
+            raise ValueError("Invalid FEC info {}".format(payload))
+        self._reserve(num_of_packets)
+
+        self.num_of_packets = num_of_packets
+        self.start = self.stride - first_length
+        self.end = self.start + size
+        self.group_size = group_size
+        self.groups = -(-num_of_packets // group_size)
+
+    def _recover(self, group):
+        """rebuilds the chunk of a group when exactly one is missing"""
+        if not self.parity_received[group]:
+            return
+
+        missing = -1
+        for index in range(group, self.num_of_packets, self.groups):
+            if not self.received[index]:
+                if missing != -1:
+                    return  # More than one chunk is missing
+                missing = index
+        if missing == -1:
+            return
+
+        stride = self.stride
+        chunks = np.frombuffer(
+            self.buffer, dtype=np.uint8, count=self.num_of_packets * stride
+        ).reshape(-1, stride)
+        parity = np.frombuffer(
+            self.parity, dtype=np.uint8, count=stride, offset=group * stride
+        )
+        chunks[missing] = 0
+        chunks[missing] = np.bitwise_xor.reduce(chunks[group :: self.groups], axis=0)
+        chunks[missing] ^= parity
+
+        self.received[missing] = 1
+        self.num_of_received += 1
+        self.num_of_recovered += 1
 
     def is_complete(self) -> bool:
         if self.num_of_packets > -1:
-            return self.num_of_packets == len(self.packets)
+            return self.num_of_packets == self.num_of_received
         return False
 
-    def get_packet(self, index) -> Packet:
-        return self.packets[index]
+    def get_NACK(self, current_time, has_newer):
+        """returns the missing indices worth asking for again, or None
+
+        A frame is NACKed once its last chunk arrived, or once a newer frame
+        started arriving which means the tail of this one was lost. Only
+        nearly complete frames young enough to be retransmitted qualify.
+
+        :return: missing indices and whether the tail is missing as well
+        :rtype: tuple
+        """
+        age = current_time - self.init_time
+        if age < NACK_DELAY or age > RETRANSMIT_DEADLINE:
+            return None
+        if current_time - self.last_NACK_time < NACK_INTERVAL:
+            return None
+
+        tail = self.num_of_packets == -1
+        if tail and not has_newer:
+            return None
+        end = self.max_index + 1 if tail else self.num_of_packets
+        missing = [i for i in range(end) if not self.received[i]]
+        if tail and end < get_max_chunks(self.version):
+            missing.append(end)  # Everything from here on is missing
+        if not missing or len(missing) > NACK_MAX_MISSING:
+            return None
+
+        self.last_NACK_time = current_time
+        return missing, tail
+
+    def has_packet(self, index) -> bool:
+        return bool(self.received[index])
+
+    def get_serial(self) -> int:
+        return self.serial
+
+    def get_version(self) -> int:
+        """version of the frame's packets, version 1 before any arrived"""
+        return self.version
 
     def get_init_time(self) -> float:
         return self.init_time
 
+    def get_complete_time(self) -> float:
+        return self.complete_time
+
+    def get_recovered(self) -> int:
+        return self.num_of_recovered
+
+    def get_expected(self) -> int:
+        """amount of data chunks the frame has, as far as is known"""
+        if self.num_of_packets > -1:
+            return self.num_of_packets
+        return self.max_index + 1
+
+    def get_received(self) -> int:
+        """amount of data chunks that arrived, without the recovered ones"""
+        return self.num_of_received - self.num_of_recovered
+
+    def get_frame(self) -> memoryview:
+        return self.view[self.start : self.end]
+
+    def get_partial_frame(self) -> memoryview:
+        """the frame as far as it arrived, with every missing chunk zeroed
+
+        Without the first chunk the frame starts at the buffer, without the
+        last one it ends after the newest chunk that arrived.
+        """
+        stride = self.stride
+        for index in range(self.get_expected()):
+            if not self.received[index]:
+                self.view[index * stride : (index + 1) * stride] = EMPTY_CHUNK[:stride]
+        start = self.start if self.received[0] else 0
+        end = self.end if self.num_of_packets > -1 else (self.max_index + 1) * stride
+        return self.view[start:end]
+
     def to_data(self) -> Data:
-        data = b""
-        for i in range(self.num_of_packets):
-            data += self.packets[str(i)].get_data()
-        return Data(data)
+        return Data(self.get_frame())
+
+
+class FramePool:
+    """recycles PacketList buffers so frames are reassembled without allocations"""
+
+    def __init__(self, packet_size=PACKET_SIZE):
+        self.packet_size = packet_size
+        self.free = []
+        self.allocated = 0
+        self.lock = Lock()
+
+    def acquire(self, serial) -> PacketList:
+        self.lock.acquire()
+        packet_list = self.free.pop() if self.free else None
+        self.lock.release()
+
+        if packet_list is None:
+            packet_list = PacketList(self.packet_size)
+            self.allocated += 1
+        packet_list.reset(serial)
+        return packet_list
+
+    def release(self, packet_list: PacketList):
+        self.lock.acquire()
+        self.free.append(packet_list)
+        self.lock.release()
+
+    def get_allocated(self) -> int:
+        return self.allocated
+
+
+class PacketizedFrame:
+    """a frame split into encoded packets once and shared by all agents
+
+    All packets live in one contiguous buffer and are handed out as
+    read-only memoryviews, so the same bytes are sent to every agent.
+    Packets are packet_size bytes long except for the last data packet,
+    which is trimmed to the end of the frame instead of padded.
+    With FEC on, XOR parity packets for interleaved groups of chunks are
+    appended after the data packets.
+    Version 2 packets carry frames of up to MAX_CHUNKS_2 chunks, their
+    first packet also carries the frame size so the receiver can make
+    room for it.
+
+    :raises ValueError: if the frame needs more packets than the version allows
+    """
+
+    def __init__(
+        self,
+        data: Data,
+        serial,
+        FEC_flag=FEC_OFF_FLAG,
+        SEC_flag=SEC_OFF_FLAG,
+        FEC_ratio=FEC_RATIO,
+        packet_size=PACKET_SIZE,
+        version=VERSION_1_FLAG,
+    ):
+        self.serial = serial
+        self.size = data.get_size()
+        self.version = int(version)
+        # Fixed width, so frame formats can line their parts up with the chunks
+        self.CRC_payload = str(data.get_CRC()).zfill(FRAME_CRC_SIZE).encode()
+        if self.version == int(VERSION_2_FLAG):
+            self.CRC_payload += str(self.size).zfill(FRAME_SIZE_SIZE).encode()
+        # Chunks are shorter with FEC on, so parity packets fit their FEC info
+        self.chunk_size = get_chunk_size(packet_size, FEC_flag, version)
+        self.packet_size = packet_size
+        self.wire_size = 0
+        # The first chunk is shortened by its payload
+        num_of_packets = max(
+            1, -(-(self.size + len(self.CRC_payload)) // self.chunk_size)
+        )
+        if num_of_packets > get_max_chunks(version):
+            raise ValueError(
+                "Frame {} does not fit in {} packets of {} bytes".format(
+                    serial, get_max_chunks(version), packet_size
+                )
+            )
+        if FEC_flag and self.size >= FEC_MAX_FRAME_SIZE:
+            raise ValueError("Frame {} is too large for the FEC info".format(serial))
+        num_of_parity = 0
+        if FEC_flag:
+            group_size = min(FEC_MAX_GROUP_SIZE, max(1, round(1.0 / FEC_ratio)))
+            num_of_parity = -(-num_of_packets // group_size)
+
+        self.buffer = bytearray((num_of_packets + num_of_parity) * packet_size)
+        view = memoryview(self.buffer)
+        self.packets = []
+        index = 0
+        while not data.is_end():
+            packet = view[index * packet_size : (index + 1) * packet_size]
+            length = self._encode_packet(packet, index, data, FEC_flag, SEC_flag)
+            self.packets.append(packet[:length].toreadonly())
+            self.wire_size += length
+            index += 1
+        self.num_of_data = index
+
+        if num_of_parity:
+            self._encode_parity(
+                view[index * packet_size :],
+                data,
+                group_size,
+                num_of_parity,
+                FEC_flag,
+                SEC_flag,
+            )
+
+    def _encode_packet(self, packet, index, data: Data, FEC_flag, SEC_flag):
+        payload = b""
+        chunk_flag = CHUNK_NORMAL_FLAG
+
+        if index == 0:
+            chunk_flag = CHUNK_FIRST_FLAG
+            payload = self.CRC_payload
+
+        data_chunk_length = self.chunk_size - len(payload)
+
+        if data.amount_to_end() <= data_chunk_length:
+            chunk_flag = CHUNK_LAST_FLAG
+            data_chunk_length = data.amount_to_end()
+
+        return encode_into(
+            packet,
+            build_flags(chunk_flag, FEC_flag, SEC_flag, self.version),
+            index,
+            self.serial,
+            payload,
+            data.get_data_chunk(data_chunk_length),
+            pad=False,
+        )
+
+    def _encode_parity(self, view, data: Data, group_size, groups, FEC_flag, SEC_flag):
+        """XORs every groups-th chunk together, the layout matches PacketList"""
+        chunk_size = self.chunk_size
+        first_length = min(self.size, chunk_size - len(self.CRC_payload))
+        chunks = np.zeros(group_size * groups * chunk_size, dtype=np.uint8)
+        offset = chunk_size - first_length
+        chunks[offset : offset + self.size] = np.frombuffer(
+            data.get_data(), dtype=np.uint8
+        )
+        parity = np.bitwise_xor.reduce(
+            chunks.reshape(group_size, groups, chunk_size), axis=0
+        )
+
+        payload = "{:08d}{:04d}{:04d}".format(
+            self.size, first_length, group_size
+        ).encode()
+        flags = build_flags(CHUNK_PARITY_FLAG, FEC_flag, SEC_flag, self.version)
+        packet_size = self.packet_size
+        for group in range(groups):
+            packet = view[group * packet_size : (group + 1) * packet_size]
+            encode_into(
+                packet, flags, group, self.serial, payload, parity[group], packet_size
+            )
+            self.packets.append(packet.toreadonly())
+            self.wire_size += packet_size
+
+    def get_packets(self) -> list:
+        return self.packets
+
+    def get_data_packets(self, indices, tail=False) -> list:
+        """returns the data packets asked for by a NACK"""
+        indices = [i for i in indices if i < self.num_of_data]
+        if tail and indices:
+            indices += range(indices[-1] + 1, self.num_of_data)
+        return [self.packets[i] for i in indices]
+
+    def get_serial(self) -> int:
+        return self.serial
+
+    def get_size(self) -> int:
+        return self.size
+
+    def get_wire_size(self) -> int:
+        """bytes sent for the frame, every packet included"""
+        return self.wire_size
+
+    def __len__(self) -> int:
+        return len(self.packets)
+
+
+class RetransmitCache:
+    """ring buffer of the last frames sent on a stream, for retransmissions"""
+
+    def __init__(self, size=RETRANSMIT_CACHE_SIZE, deadline=RETRANSMIT_DEADLINE):
+        self.frames = deque(maxlen=size)  # (send time, PacketizedFrame)
+        self.deadline = deadline
+        self.lock = Lock()
+
+    def add(self, frame: PacketizedFrame):
+        self.lock.acquire()
+        self.frames.append((time.time(), frame))
+        self.lock.release()
+
+    def get_packets(self, serial, indices, tail=False) -> list:
+        """returns the packets to resend, nothing once the frame is past its deadline"""
+        current_time = time.time()
+        self.lock.acquire()
+        for send_time, frame in reversed(self.frames):
+            if frame.get_serial() != serial:
+                continue
+            self.lock.release()
+            if current_time - send_time > self.deadline:
+                return []
+            return frame.get_data_packets(indices, tail)
+        self.lock.release()
+        return []
 
 
 class Agent:
@@ -346,18 +956,66 @@ class Agent:
         fps=15,
         FEC_flag=FEC_OFF_FLAG,
         SEC_flag=SEC_OFF_FLAG,
+        pacer=None,
+        send_queue_size=SEND_QUEUE_SIZE,
+        max_partial_frames=MAX_PARTIAL_FRAMES,
+        use_NACK=False,
+        send_reports=False,
+        packet_size=PACKET_SIZE,
+        batch_send=True,
+        receive_burst=1,
+        version=VERSION_1_FLAG,
     ):
         self.FEC_flag = FEC_flag
+        self.packet_size = packet_size
         self.SEC_flag = SEC_flag
-        self.data_serial = np.uint16(0)
+        self.version = version  # Of the packets sent, received ones carry theirs
+        self.data_serial = 0
         self.RUN = False
         self.udp_sock = udp_sock
         self.tcp_sock = tcp_sock
         self.addr = addr
         self.fps = fps
+        self.pacer = pacer
         self.data_dict = dict()
+        self.expiry = deque()  # (init time, serial, PacketList) in arrival order
+        self.max_partial_frames = max_partial_frames
+        self.delivered = None  # PacketList handed out by get_last_data
         self.lock = Lock()
+        self.frame_ready = Condition(self.lock)
+        self.complete_serial = -1  # Newest complete frame
+        self.complete_time = 0.0  # When the last handed out frame completed
+        self.use_partial = False  # Hand out frames that lost packets as well
+        self.partial = False  # The last handed out frame lost packets
+        self.repeats = 0  # Repeat packets received since the last take_repeats
         self.analytics = Analytics()
+        self.receive_buffer = bytearray(packet_size)
+        # 1 handles every datagram on its own. Bursts, like RECEIVE_BURST, are
+        # opt-in: benchmark.py receive shows them no cheaper per packet yet
+        self.receive_burst = receive_burst
+        self.frame_pool = FramePool(packet_size)
+        self.send_queue = deque()
+        self.retransmit_queue = deque()
+        self.repeat_queue = deque()
+        self.send_queue_size = send_queue_size
+        self.send_condition = Condition()
+        self.send_thread = None
+        self.control_reader = ControlReader()
+        self.use_NACK = use_NACK
+        self.last_NACK_check = 0.0
+        self.last_full_frame_request = 0.0
+        self.send_reports = send_reports
+        self.report = Report()  # Client-side statistics for the next report
+        self.last_report_time = time.time()
+        self.ABR = ABRController()  # Server-side quality for this client
+        # Packets of a frame go out in a few UDP_SEGMENT sends instead of one each,
+        # only when they fit the route's MTU, the kernel does not fragment segments
+        self.use_GSO = (
+            batch_send
+            and sys.platform.startswith("linux")
+            and hasattr(udp_sock, "sendmsg")
+            and packet_size + IP_UDP_HEADER_SIZE <= (get_route_MTU(addr) or 0)
+        )
 
     def is_tcp_socket_closed(self) -> bool:
         try:
@@ -381,124 +1039,482 @@ class Agent:
 
     def send_data(self, data: Data):  # Server-side
         # logging.debug("Sending {} to {}".format(data, addr))
-        self.analytics.add_frames_sent()
-        index = np.uint8(0)
-        while not data.is_end():
-            self._send_packet(self._create_packet(index, data))
-            index += np.uint8(1)
-            time.sleep(0.001)  # packet_spacing)
-
+        # Serials start at 1, clients take 0 for nothing handed out yet
         self._increase_serial()
+        self.send_frame(
+            PacketizedFrame(
+                data,
+                int(self.data_serial),
+                self.FEC_flag,
+                self.SEC_flag,
+                packet_size=self.packet_size,
+                version=self.version,
+            )
+        )
 
-    def _increase_serial(self):
-        if self.data_serial == 65535:
-            self.data_serial = np.uint16(0)
-        self.data_serial += np.uint16(1)
-        # check max
-
-    def _create_packet(self, index, data: Data):
-        payload = str()
-        payload_length = np.uint16(len(payload))
-        chunk_flag = CHUNK_NORMAL_FLAG
+    def start_sender(self):  # Server-side
+        self.RUN = True
+        self.send_thread = Thread(target=self._send_loop)
+        self.send_thread.start()
 
-        if index == 0:
-            chunk_flag = CHUNK_FIRST_FLAG
-            payload = str(data.get_CRC())
-            payload_length = np.uint16(len(payload))
+    def stop_sender(self):
+        self.send_condition.acquire()
+        self.RUN = False
+        self.send_condition.notify_all()
+        self.send_condition.release()
+        if self.send_thread is not None:
+            self.send_thread.join()
+
+    def enqueue_frame(self, frame: PacketizedFrame):  # Server-side
+        """queues a frame for the sender thread, dropping the oldest when full"""
+        self.send_condition.acquire()
+        while len(self.send_queue) >= self.send_queue_size:
+            self.send_queue.popleft()
+            self.analytics.add_frames_dropped()
+        self.send_queue.append(frame)
+        self.send_condition.notify()
+        self.send_condition.release()
+
+    def enqueue_retransmit(self, packets):  # Server-side
+        """queues packets to resend, they go out before the next frame"""
+        self.send_condition.acquire()
+        self.retransmit_queue.extend(packets)
+        self.send_condition.notify()
+        self.send_condition.release()
+
+    def enqueue_repeat(self, packet):  # Server-side
+        """queues a repeat packet, sent in place of an unchanged frame"""
+        self.send_condition.acquire()
+        self.repeat_queue.append(packet)
+        self.send_condition.notify()
+        self.send_condition.release()
+
+    def _send_loop(self):
+        while self.RUN:
+            self.send_condition.acquire()
+            while (
+                self.RUN
+                and not self.send_queue
+                and not self.retransmit_queue
+                and not self.repeat_queue
+            ):
+                self.send_condition.wait()
+            packets = list(self.retransmit_queue)
+            self.retransmit_queue.clear()
+            repeats = list(self.repeat_queue)
+            self.repeat_queue.clear()
+            frame = self.send_queue.popleft() if self.send_queue else None
+            self.send_condition.release()
+
+            try:
+                self._send_packets(packets)
+                self.analytics.add_packets_retransmitted(len(packets))
+                for packet in repeats:
+                    self._send_packet(packet)
+                    self.analytics.add_frames_repeated()
+                if frame is not None:
+                    self.send_frame(frame)
+            except OSError as ex:
+                # The rest of the frame is lost, the next one may get through
+                logger.warning("Could not send to {}: {}".format(self.addr, ex))
+
+    def read_control(self):  # Server-side
+        """reads the control messages sent by the client
+
+        :return: the complete messages, or None once the socket is closed
+        :rtype: list
+        """
+        try:
+            data = self.tcp_sock.recv(4096)
+        except BlockingIOError:
+            return []
+        except OSError:
+            data = b""
+        if not data:
+            return None
+        return self.control_reader.feed(data)
 
-        data_chunk_length = np.uint16(RAW_SIZE - payload_length)
+    def get_queue_depth(self) -> int:
+        return len(self.send_queue)
 
-        if data.amount_to_end() < RAW_SIZE:
-            chunk_flag = CHUNK_LAST_FLAG
-            data_chunk_length = np.uint16(data.amount_to_end())
+    def send_frame(self, frame: PacketizedFrame):  # Server-side
+        self.analytics.add_frames_sent()
+        self._send_packets(frame.get_packets())
+
+    def _send_packets(self, packets):  # Server-side
+        """sends packets in as few syscalls as the socket allows"""
+        if not self.use_GSO:
+            for packet in packets:
+                if self.pacer is not None:
+                    self.pacer.consume(len(packet))
+                self._send_packet(packet)
+            return
 
-        return Packet(
-            (
-                chunk_flag,
-                self.FEC_flag,
-                self.SEC_flag,
-                index,
-                self.data_serial,
-                data_chunk_length,
-                payload_length,
-                payload,
-                data.get_data_chunk(data_chunk_length),
+        max_size = GSO_MAX_SIZE
+        if self.pacer is not None:
+            # Batches stay within a burst so pacing stays as smooth
+            max_size = min(max_size, self.pacer.get_burst())
+        for batch in get_batches(packets, max_size):
+            size = sum(len(packet) for packet in batch)
+            if self.pacer is not None:
+                self.pacer.consume(size)
+            if not self.use_GSO or len(batch) == 1 or not self._send_batch(batch, size):
+                for packet in batch:
+                    self._send_packet(packet)
+
+    def _send_batch(self, batch, size) -> bool:  # Server-side
+        """sends packets of one size, but for a shorter last one, in one syscall
+
+        The packets are passed as separate buffers and the kernel splits
+        them into datagrams again.
+
+        :return: False if the kernel can not split sends, nothing was sent
+            and the agent sends packet by packet from now on
+        :rtype: bool
+        """
+        try:
+            self.udp_sock.sendmsg(
+                batch,
+                [(socket.IPPROTO_UDP, UDP_SEGMENT, GSO_SIZE.pack(len(batch[0])))],
+                0,
+                self.addr,
             )
-        )
+        except OSError as ex:
+            if ex.errno not in GSO_ERRORS:
+                raise
+            logger.info(
+                "Can not send UDP_SEGMENT batches to {} ({}), sending packet by packet".format(
+                    self.addr, errno.errorcode.get(ex.errno, ex.errno)
+                )
+            )
+            self.use_GSO = False
+            return False
+        self.analytics.add_packets_sent(len(batch))
+        self.analytics.add_bytes_sent(size)
+        return True
+
+    def _increase_serial(self):
+        self.data_serial = self.data_serial % get_max_serial(self.version) + 1
 
-    def _send_packet(self, packet: Packet):  # Agent-side
-        self.udp_sock.sendto(packet.get_raw(), self.addr)
+    def _send_packet(self, packet):  # Agent-side
+        self.udp_sock.sendto(packet, self.addr)
         self.analytics.add_packets_sent()
+        self.analytics.add_bytes_sent(len(packet))
 
-    def start_receive(self):
-        # dict serials for keys and list/sets of packets orderby index
+    def start_receive(self, udp_sock=None):
+        """receives and reassembles packets until stop_receive
+
+        :param udp_sock: another socket to receive from, like a multicast
+            group's, every socket needs its own thread
+        """
+        # dict serials for keys and a PacketList reassembling each frame
         self.RUN = True
+        if udp_sock is None:
+            udp_sock = self.udp_sock
+            receive_buffer = self.receive_buffer
+        else:
+            receive_buffer = bytearray(self.packet_size)
+        if self.receive_burst > 1:
+            self._receive_bursts(udp_sock)
+            return
         while self.RUN:
-            is_full, packet = self._receive_packet()
+            is_full, packet = self._receive_packet(udp_sock, receive_buffer)
             # logging.debug("Received {}".format(packet))
             if not is_full:
                 continue
+            self.handle_packet(packet)
 
-            if not packet.is_valid():
-                self.analytics.add_packets_CRC_error()
-                continue
-            serial = packet.get_serial()
-            if str(serial) in self.data_dict:
-                # logging.debug("Adding {} to {}".format(packet, serial))
-                self.data_dict[str(serial)].add_packet(packet)
-                # logging.debug("Added")
-            else:
-                # logging.debug(
-                #    "Adding {} with {} key to {}".format(packet, serial, self.data_dict)
-                # )
-                self.data_dict[str(serial)] = PacketList(packet)
-                self.analytics.add_frames_received()
-                logging.debug("Added both")
-
-            self._clean_up()
+    def _receive_bursts(self, udp_sock):  # Client-side
+        """receives and handles everything waiting on the socket at once
+
+        Expiry, NACKs and reports are handled once per burst.
+        """
+        ring = ReceiveRing(self.receive_burst, self.packet_size)
+        try:
+            while self.RUN:
+                count = ring.receive(udp_sock)
+                if count == 0:
+                    continue
+                self.analytics.add_packets_received(count)
+                self.analytics.add_bytes_received(ring.get_size(count))
+                valid = ring.get_valid(count)
+                if len(valid) < count:
+                    self.analytics.add_packets_header_error(count - len(valid))
+                for slot in valid.tolist():
+                    self._add_packet(ring.get_packet(slot))
+                self._maintain()
+        finally:
+            ring.close()
+
+    def handle_packet(self, packet: PacketView) -> bool:
+        """adds a received packet to its frame
+
+        :return: True if the packet was the last missing chunk of its frame,
+            asked to show the last frame again, or, with use_partial on, left
+            an earlier frame without more packets to come
+        :rtype: bool
+        """
+        completed = self._add_packet(packet)
+        self._maintain()
+        return completed
+
+    def _add_packet(self, packet: PacketView) -> bool:  # Client-side
+        if not packet.check_cookie():
+            self.analytics.add_packets_header_error()
+            return False
+        if not packet.check_CRC():
+            self.analytics.add_packets_CRC_error()
+            self.report.add_CRC_error()
+            return False
+        if packet.is_repeat():
+            self.lock.acquire()
+            self.repeats += 1
+            self.frame_ready.notify_all()
+            self.lock.release()
+            self.analytics.add_frames_repeated()
+            return True
+        serial = packet.get_serial()
+        if serial <= self.data_serial:
+            return False  # Not newer than the last frame handed out
+
+        self.lock.acquire()
+        packet_list = self.data_dict.get(serial)
+        started = packet_list is None
+        if started:
+            while len(self.data_dict) >= self.max_partial_frames and self.expiry:
+                if self._remove_oldest():
+                    self.analytics.add_frames_evicted()
+            packet_list = self.frame_pool.acquire(serial)
+            self.data_dict[serial] = packet_list
+            self.expiry.append((packet_list.get_init_time(), serial, packet_list))
+            self.analytics.add_frames_received()
+        recovered = packet_list.get_recovered()
+        completed = packet_list.add_packet(packet) and packet_list.is_complete()
+        self.analytics.add_packets_recovered(packet_list.get_recovered() - recovered)
+        if completed and serial > self.complete_serial:
+            self.complete_serial = serial
+            self.frame_ready.notify_all()
+        elif started and self.use_partial:
+            # The frames before this one get no more packets
+            completed = self._get_partial_serial(time.time()) != -1
+            if completed:
+                self.frame_ready.notify_all()
+        self.lock.release()
+        return completed
+
+    def _maintain(self):  # Client-side
+        """expires old frames and sends the NACKs and report that are due"""
+        self._clean_up()
+        if self.use_NACK:
+            self._send_NACKs()
+        if self.send_reports:
+            self._send_report()
 
     def _clean_up(self):
         current_time = time.time()
-        for i in list(self.data_dict.keys()):  # iter(self.data_dict):
-            if i not in self.data_dict:
-                continue
-            if current_time - self.data_dict[i].get_init_time() > TIMEOUT:
-                self.lock.acquire()
-                del self.data_dict[i]
-                self.lock.release()
+        self.lock.acquire()
+        while self.expiry and current_time - self.expiry[0][0] > TIMEOUT:
+            if self._remove_oldest():
+                self.analytics.add_frames_expired()
+        self.lock.release()
+
+    def _send_NACKs(self):  # Client-side
+        current_time = time.time()
+        if current_time - self.last_NACK_check < NACK_CHECK_INTERVAL:
+            return
+        self.last_NACK_check = current_time
+
+        messages = []
+        self.lock.acquire()
+        newest = max(self.data_dict) if self.data_dict else -1
+        for serial, packet_list in self.data_dict.items():
+            NACK = packet_list.get_NACK(current_time, serial < newest)
+            if NACK is not None:
+                messages.append(
+                    encode_NACK(serial, *NACK, version=packet_list.get_version())
+                )
+        self.lock.release()
+
+        for message in messages:
+            try:
+                self.tcp_sock.send(message)
+                self.analytics.add_NACKs_sent()
+            except OSError:
+                logging.warning("Could not send a NACK")
+
+    def _send_report(self):  # Client-side
+        current_time = time.time()
+        if current_time - self.last_report_time < REPORT_INTERVAL:
+            return
+        self.last_report_time = current_time
+
+        self.lock.acquire()
+        report = self.report
+        self.report = Report()
+        self.lock.release()
+
+        try:
+            self.tcp_sock.send(encode_message(CONTROL_REPORT, report.encode()))
+        except OSError:
+            logging.warning("Could not send a report")
+
+    def request_tier(self, tier):  # Client-side
+        """asks a simulcast server for a tier, -1 lets its ABR pick again"""
+        try:
+            self.tcp_sock.send(encode_tier(tier))
+        except OSError:
+            logging.warning("Could not request tier {}".format(tier))
+
+    def request_full_frame(self):  # Client-side
+        """asks the server for a full frame, at most once every FULL_FRAME_REQUEST_INTERVAL"""
+        current_time = time.time()
+        if current_time - self.last_full_frame_request < FULL_FRAME_REQUEST_INTERVAL:
+            return
+        self.last_full_frame_request = current_time
+        try:
+            self.tcp_sock.send(encode_message(CONTROL_FULL_FRAME))
+        except OSError:
+            logging.warning("Could not request a full frame")
+
+    def _drop_frame(self, packet_list: PacketList):
+        """releases a frame that was never handed out, must hold the lock"""
+        # Complete frames skipped for a newer one still made it over the link
+        self.report.add_frame(
+            packet_list.get_expected(),
+            packet_list.get_received(),
+            packet_list.is_complete(),
+        )
+        self.frame_pool.release(packet_list)
+
+    def _remove_oldest(self) -> bool:
+        """pops the oldest expiry entry and releases its frame if it is still in use
+
+        Entries of frames that were already handed out or evicted are stale
+        and only skipped. Must be called with the lock held.
+        """
+        init_time, serial, packet_list = self.expiry.popleft()
+        if (
+            self.data_dict.get(serial) is not packet_list
+            or packet_list.get_init_time() != init_time
+        ):
+            return False
+        self._drop_frame(self.data_dict.pop(serial))
+        return True
 
     def stop_receive(self):
+        self.lock.acquire()
         self.RUN = False
+        self.frame_ready.notify_all()
+        self.lock.release()
 
-    def _receive_packet(self):  # Client-side
-        # receive packet via sock
+    def _receive_packet(self, udp_sock, receive_buffer):  # Client-side
+        # receive packet via sock into the reusable buffer
         try:
-            data = self.udp_sock.recvfrom(PACKET_SIZE)[0]
+            length = udp_sock.recv_into(receive_buffer)
             self.analytics.add_packets_received()
-            return True, Packet(data)
+            self.analytics.add_bytes_received(length)
+            return True, PacketView(receive_buffer, length)
         except Exception as ex:
             pass
-        return False, Packet(b"")
+        return False, None
 
-    def get_last_data(self) -> Data:
-        # return the data with the largest serial number
+    def set_use_partial(self, use_partial):
+        """hands out frames that lost packets too, for formats decodable in parts"""
         self.lock.acquire()
-        completed = []
-        for i in list(self.data_dict.keys()):  # iter(self.data_dict):
-            if self.data_dict[i].is_complete():
-                completed.append(int(i))
-
+        self.use_partial = use_partial
         self.lock.release()
-        if not completed:
-            return Data(b""), -1
 
-        serial = max(completed)
-        if serial <= self.data_serial:
+    def _get_partial_serial(self, current_time) -> int:
+        """the newest incomplete frame that gets no more packets, -1 if none
+
+        That is a frame once a newer one started arriving, or once it is
+        older than PARTIAL_DELAY. Must be called with the lock held.
+        """
+        serials = sorted(
+            (serial for serial in self.data_dict if serial > self.data_serial),
+            reverse=True,
+        )
+        for serial in serials:
+            packet_list = self.data_dict[serial]
+            if packet_list.is_complete():
+                return -1  # Older frames are outdated by it
+            if (
+                serial < serials[0]
+                or current_time - packet_list.get_init_time() > PARTIAL_DELAY
+            ):
+                return serial
+        return -1
+
+    def get_last_data(self) -> Data:
+        """returns the complete frame with the largest serial number
+
+        With use_partial on, a newer frame that lost packets is returned
+        instead, with its missing chunks zeroed, see is_partial.
+        The returned data is a view into a pooled buffer, it stays valid
+        until the next call.
+        """
+        self.lock.acquire()
+        serial = self.complete_serial
+        partial = False
+        if self.use_partial:
+            partial_serial = self._get_partial_serial(time.time())
+            if partial_serial > serial:
+                serial = partial_serial
+                partial = True
+        packet_list = self.data_dict.get(serial)
+        if serial <= self.data_serial or packet_list is None:
+            self.lock.release()
             return Data(b""), -1
 
-        self.analytics.add_good_frames()
+        # Frames older than the new one can no longer be handed out
+        for i in [i for i in self.data_dict if i < serial]:
+            self._drop_frame(self.data_dict.pop(i))
+        # The previous frame is only released now, its view was in use until this call
+        if self.delivered is not None:
+            self.frame_pool.release(self.delivered)
+        self.delivered = self.data_dict.pop(serial)
+        self.report.add_frame(
+            packet_list.get_expected(), packet_list.get_received(), not partial
+        )
         self.data_serial = serial
-        return self.data_dict[str(self.data_serial)].to_data(), serial
+        self.partial = partial
+        self.lock.release()
+
+        if partial:
+            self.analytics.add_frames_partial()
+            self.complete_time = time.perf_counter()
+            return Data(packet_list.get_partial_frame()), serial
+        self.analytics.add_good_frames()
+        self.complete_time = packet_list.get_complete_time()
+        return packet_list.to_data(), serial
+
+    def wait_for_data(self, timeout=None) -> Data:
+        """blocks until a newer frame is complete, then returns it like get_last_data"""
+        self.lock.acquire()
+        self.frame_ready.wait_for(
+            lambda: self.complete_serial > self.data_serial
+            or self.repeats
+            or not self.RUN
+            or (self.use_partial and self._get_partial_serial(time.time()) != -1),
+            timeout,
+        )
+        self.lock.release()
+        return self.get_last_data()
+
+    def take_repeats(self) -> int:
+        """returns how many times the server asked to repeat the last frame since the last call"""
+        self.lock.acquire()
+        repeats = self.repeats
+        self.repeats = 0
+        self.lock.release()
+        return repeats
+
+    def get_complete_time(self) -> float:
+        return self.complete_time
+
+    def is_partial(self) -> bool:
+        """True when the last handed out frame lost packets"""
+        return self.partial
 
     def get_analytics(self):
         return self.analytics
@@ -0,0 +1,104 @@
+import struct
+
+from multiprocessing import resource_tracker, shared_memory
+from constents import *
+
+# Slots, Slot Size, Sequence of the newest frame
+RING_HEADER = struct.Struct("<IIQ")
+# Sequence, Serial, Data Length, Frame Interval
+SLOT_HEADER = struct.Struct("<QIId")
+
+
+class FrameRing:
+    """encoded frames in named shared memory, written by one process and read by many
+
+    Frame number sequence goes to slot sequence % slots, so readers that
+    fall more than slots frames behind lose frames. The writer clears a
+    slot's sequence before reusing it, so a reader checks the sequence
+    again after reading a frame to know that it was not overwritten
+    meanwhile. Frames are read in place, without copying them out.
+    An empty frame asks the readers to repeat the last one.
+    Other processes attach to the ring by its name.
+    """
+
+    def __init__(
+        self, slots=RING_SLOTS, slot_size=RING_SLOT_SIZE, name=None, track=True
+    ):
+        """creates a ring, or attaches to the ring called name
+
+        :param track: unlink an attached ring when this process exits, only
+            for processes started by the creator, which share its tracker
+        :type track: bool
+        """
+        if name is None:
+            self.memory = shared_memory.SharedMemory(
+                create=True,
+                size=RING_HEADER.size + slots * (SLOT_HEADER.size + slot_size),
+            )
+            RING_HEADER.pack_into(self.memory.buf, 0, slots, slot_size, 0)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            if not track and shared_memory._USE_POSIX:
+                # Before Python 3.13 attaching registers the ring for unlinking
+                resource_tracker.unregister(self.memory._name, "shared_memory")
+            slots, slot_size, _ = RING_HEADER.unpack_from(self.memory.buf)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = SLOT_HEADER.size + slot_size
+        self.view = self.memory.buf
+
+    def get_name(self) -> str:
+        return self.memory.name
+
+    def _get_offset(self, sequence) -> int:
+        return RING_HEADER.size + sequence % self.slots * self.stride
+
+    def write(self, data, serial, interval=0.0) -> int:
+        """writes a frame to the next slot
+
+        :param interval: time between frames in seconds, for pacing
+        :type interval: float
+        :return: the sequence of the frame, 0 if it does not fit in a slot
+        :rtype: int
+        """
+        size = len(data)
+        if size > self.slot_size:
+            return 0
+        sequence = self.get_head() + 1
+        offset = self._get_offset(sequence)
+        start = offset + SLOT_HEADER.size
+        SLOT_HEADER.pack_into(self.view, offset, 0, 0, 0, 0.0)
+        self.view[start : start + size] = data
+        SLOT_HEADER.pack_into(self.view, offset, sequence, serial, size, interval)
+        RING_HEADER.pack_into(self.view, 0, self.slots, self.slot_size, sequence)
+        return sequence
+
+    def get_head(self) -> int:
+        """the sequence of the newest frame, 0 before the first one"""
+        return RING_HEADER.unpack_from(self.view)[2]
+
+    def read(self, sequence):
+        """returns the serial, data and interval of a frame, None once overwritten
+
+        The data is a view into the ring, only valid while is_valid(sequence).
+        """
+        offset = self._get_offset(sequence)
+        slot_sequence, serial, size, interval = SLOT_HEADER.unpack_from(
+            self.view, offset
+        )
+        if slot_sequence != sequence:
+            return None
+        start = offset + SLOT_HEADER.size
+        return serial, self.view[start : start + size], interval
+
+    def is_valid(self, sequence) -> bool:
+        """False once the writer started reusing the slot of frame sequence"""
+        offset = self._get_offset(sequence)
+        return SLOT_HEADER.unpack_from(self.view, offset)[0] == sequence
+
+    def close(self):
+        self.view = None
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
@@ -1,12 +1,25 @@
 import cv2
 import os
+import selectors
 import socket
 import logging, logging.handlers
 import signal
 import time
 import keyboard
-from threading import Thread, Lock
-from protocol import Agent, Data, Analytics
+from threading import Thread, Lock, Condition
+from protocol import Agent, Data, Analytics, PacketizedFrame, RetransmitCache
+from pacer import Pacer
+from capture import FrameSlot, ChangeDetector
+from pipeline import EncodePipeline
+from tiles import TileEncoder
+from strips import StripEncoder
+from tiers import Simulcast
+from shards import SenderPool
+from local import LocalSender, is_local_peer
+from control import decode_NACK, decode_tier
+from abr import ABRController, Report
+from codec import build_repeat, check_packet_size, get_max_serial, get_packet_size
+from constents import *
 
 
 os.environ["OPENCV_VIDEOIO_PRIORITY_MSMF"] = "0"  # Insurance for camera release
@@ -15,8 +28,34 @@ logger = logging.getLogger(__name__)
 
 class ServerService:
     def __init__(
-        self, cam_id=0, fps=15, res_h=720, res_w=1280, compress_quailty=50, RUN=True
+        self,
+        cam_id=0,
+        fps=15,
+        res_h=720,
+        res_w=1280,
+        compress_quailty=50,
+        RUN=True,
+        pacing_rate=None,
+        pacing_burst=PACING_BURST,
+        FEC_ratio=None,
+        use_ABR=True,
+        packet_size=PACKET_SIZE,
+        MTU=None,
+        encode_workers=ENCODE_WORKERS,
+        suppress_static=True,
+        use_tiles=False,
+        use_strips=False,
+        multicast_group=None,
+        multicast_port=MULTICAST_PORT,
+        multicast_interface="0.0.0.0",
+        sender_processes=0,
+        use_local=True,
+        large_frames=False,
+        tiers=None,
     ):
+        # Checked before the camera and sockets are opened
+        if FEC_ratio is not None and not 0 < FEC_ratio <= 1:
+            raise ValueError("FEC ratio {} is not in (0, 1]".format(FEC_ratio))
         self.cam = cv2.VideoCapture(cam_id)  # cam = cv2.VideoCapture(0)
         self.cam.set(
             cv2.CAP_PROP_FRAME_WIDTH, 1920
@@ -31,6 +70,7 @@ class ServerService:
 
         self.RUN = RUN
         self.lock = Lock()
+        self.agents_changed = Condition(self.lock)
 
         self.fps = fps
         self.frame_devider = round(30 / self.fps)
@@ -38,6 +78,14 @@ class ServerService:
         self.res_w = res_w
         self.res_h = res_h
 
+        # The configured settings are the top ABR level
+        self.max_fps = fps
+        self.max_res_w = res_w
+        self.max_res_h = res_h
+        self.max_quality = compress_quailty
+        self.use_ABR = use_ABR
+        self.level = len(ABR_LEVELS) - 1
+
         self.agents = []
 
         self.local_addr = ("0.0.0.0", 20001)
@@ -46,21 +94,124 @@ class ServerService:
         self.UDP_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.UDP_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 131072)
         self.UDP_sock.bind(self.local_addr)
+        # Frames are sent once to the group instead of once per client
+        self.multicast_addr = (
+            None if multicast_group is None else (multicast_group, multicast_port)
+        )
+        if self.multicast_addr is not None:
+            self.UDP_sock.setsockopt(
+                socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL
+            )
+            self.UDP_sock.setsockopt(
+                socket.IPPROTO_IP,
+                socket.IP_MULTICAST_IF,
+                socket.inet_aton(multicast_interface),
+            )
 
         self.TCP_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.TCP_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.TCP_sock.bind(self.local_addr)
 
-        self.FEC_flag = False
-        self.SEC_flag = False
+        self.FEC_flag = FEC_OFF_FLAG if FEC_ratio is None else FEC_ON_FLAG
+        self.FEC_ratio = FEC_ratio
+        self.SEC_flag = SEC_OFF_FLAG
+        # Version 2 packets carry frames past MAX_CHUNKS chunks, clients read either
+        self.version = VERSION_2_FLAG if large_frames else VERSION_1_FLAG
+        self.ring_slot_size = LARGE_RING_SLOT_SIZE if large_frames else RING_SLOT_SIZE
+        # Sent to clients on connect, an MTU keeps datagrams from fragmenting
+        if MTU is None:
+            self.packet_size = check_packet_size(packet_size)
+        else:
+            self.packet_size = get_packet_size(MTU)
+
+        self.pacer = Pacer(pacing_rate, pacing_burst)  # Shared by all agents
+        self.multicast_agent = None
+        if self.multicast_addr is not None:
+            # Sends the stream to the group, retransmits stay per client
+            self.multicast_agent = Agent(
+                self.UDP_sock,
+                None,
+                self.multicast_addr,
+                self.fps,
+                pacer=self.pacer,
+                packet_size=self.packet_size,
+            )
+        # Every tier in use is encoded once per frame and sent to its subscribers
+        self.simulcast = None
+        if tiers is not None:
+            if use_tiles or self.multicast_addr is not None or sender_processes:
+                raise ValueError(
+                    "Simulcast works without tiles, multicast and sender processes"
+                )
+            self.simulcast = Simulcast(tiers)
+        # Clients are spread across processes that packetize and send frames
+        self.sender_pool = None
+        if sender_processes:
+            if self.multicast_addr is not None:
+                raise ValueError("Multicast sends every frame once, use one process")
+            self.sender_pool = SenderPool(
+                sender_processes,
+                self.packet_size,
+                self.FEC_flag,
+                FEC_ratio,
+                pacing_rate,
+                pacing_burst,
+                slot_size=self.ring_slot_size,
+                version=self.version,
+            )
+        # Clients on this host read frames from shared memory, made on demand
+        self.use_local = use_local and self.simulcast is None  # The ring has one stream
+        self.local_sender = None
+        # Shared by all agents so every packet is built once, clients drop
+        # serial 0, it means no frame was handed out yet
+        self.serial = 1
+        # Frames of every tier are kept, so each tier has as much time for NACKs
+        tier_count = 1 if self.simulcast is None else self.simulcast.get_tiers()
+        self.retransmit_cache = RetransmitCache(RETRANSMIT_CACHE_SIZE * tier_count)
+        self.frame_slot = FrameSlot()  # Newest camera frame for the encoder
+        # Only changed tiles are sent, which needs frames encoded in order
+        self.tile_encoder = TileEncoder() if use_tiles else None
+        if use_tiles:
+            encode_workers = 1
+        # Strips line up with the packets, so a lost packet only loses a strip
+        self.strip_encoder = None
+        if use_strips:
+            if use_tiles:
+                raise ValueError("Tiles and strips are separate modes, pick one")
+            self.strip_encoder = StripEncoder(
+                self.packet_size, self.FEC_flag, version=self.version
+            )
+        self.pipeline = EncodePipeline(
+            self.frame_slot, self.encode_frame, encode_workers
+        )
+        self.stage_times = self.pipeline.get_stage_times()
+        # Unchanged frames are replaced by a repeat packet
+        self.change_detector = ChangeDetector() if suppress_static else None
+        self.last_serial = 0  # Serial of the last frame sent
+        self.capture_thread = None
 
         self.analytics_thread = Thread(target=self.print_analytics)
         self.analytics_thread.start()
 
     def start(self):
+        keyboard.add_hotkey("q", self.stop)
+
+        if self.sender_pool is not None:
+            self.sender_pool.start()
+
         self.capture_thread = Thread(target=self.capture)
         self.capture_thread.start()
 
+        self.pipeline.start()
+        if self.multicast_agent is not None:
+            self.multicast_agent.start_sender()
+
+        self.stream_thread = Thread(target=self.stream)
+        self.stream_thread.start()
+
+        self.control_thread = Thread(target=self.control_loop)
+        self.control_thread.start()
+
         self.start_listener()
 
     def start_listener(self):
@@ -72,34 +223,198 @@ class ServerService:
                 continue
 
             client_sock.setblocking(False)
-            client_sock.send(str(addr[1]).encode())
+            local = self.use_local and is_local_peer(client_sock)
+            if local and self.local_sender is None:
+                self.local_sender = LocalSender(
+                    self.UDP_sock, slot_size=self.ring_slot_size
+                )
+            client_sock.send(self.get_handshake(addr, local).encode())
 
             print("Client connected from {}".format(addr))
             print("{} Clients connected".format(len(self.agents) + 1))
 
-            agent = Agent(self.UDP_sock, client_sock, addr, self.fps)
+            agent = Agent(
+                self.UDP_sock,
+                client_sock,
+                addr,
+                self.fps,
+                pacer=self.pacer,
+                packet_size=self.packet_size,
+            )
+            if self.simulcast is not None:
+                # The client's ABR level is its tier until it picks one
+                agent.ABR = ABRController(self.simulcast.get_tiers())
+                self.simulcast.subscribe(addr, agent.ABR.get_level())
+            if local:
+                # The agent only reads control messages, frames go through the ring
+                self.local_sender.add_client(addr)
+            elif self.sender_pool is None:
+                agent.start_sender()
+            else:
+                # The agent only reads control messages, a sender process sends
+                self.sender_pool.add_agent(addr, self.fps)
 
             self.lock.acquire()
             self.agents.append(agent)
+            self.agents_changed.notify_all()
             self.lock.release()
+            if self.change_detector is not None:
+                self.change_detector.force()  # The new client needs a frame
+            if self.tile_encoder is not None:
+                self.tile_encoder.force()
+
+    def get_handshake(self, addr, local=False) -> str:
+        """the client's UDP port and the packet size, followed by the name of
+        the shared memory ring for a client on this host, or by the
+        multicast group and port when the stream is multicast"""
+        handshake = "{} {}".format(addr[1], self.packet_size)
+        if local:
+            handshake += " {}".format(self.local_sender.get_name())
+        elif self.multicast_addr is not None:
+            handshake += " {} {}".format(*self.multicast_addr)
+        return handshake
+
+    def get_receivers(self) -> list:
+        """the agents every frame is sent through, local clients are left out"""
+        agents = self.agents
+        if self.local_sender is not None:
+            agents = [
+                agent
+                for agent in agents
+                if not self.local_sender.has_client(agent.addr)
+            ]
+        if self.multicast_agent is not None and agents:
+            return [self.multicast_agent]
+        return agents
 
     def stop(self, sig=None, farme=None):
         print("Stopping")
         self.lock.acquire()
         self.RUN = False
+        self.agents_changed.notify_all()
         self.lock.release()
+        self.pipeline.stop()
         time.sleep(0.5)
-        self.cam.release()
-        self.UDP_sock.close()
-        self.TCP_sock.close()
 
         self.lock.acquire()
         while self.agents:
-            self.agents.pop()
+            self.agents.pop().stop_sender()
         self.lock.release()
+        if self.multicast_agent is not None:
+            self.multicast_agent.stop_sender()
+        if self.sender_pool is not None:
+            self.sender_pool.stop()
+        if self.local_sender is not None:
+            self.local_sender.close()
+
+        if self.capture_thread is not None:
+            self.capture_thread.join()
+        self.cam.release()
+        self.UDP_sock.close()
+        self.TCP_sock.close()
 
         print("Stopped")
 
+    def control_loop(self):
+        """reads control messages from every agent's TCP socket"""
+        selector = selectors.DefaultSelector()
+        registered = set()
+        while self.RUN:
+            for agent in self.agents:
+                if agent not in registered:
+                    selector.register(agent.tcp_sock, selectors.EVENT_READ, agent)
+                    registered.add(agent)
+
+            for key, _ in selector.select(timeout=0.1):
+                agent = key.data
+                messages = agent.read_control()
+                if messages is None:
+                    selector.unregister(agent.tcp_sock)
+                    continue  # Closed, removed by the capture thread
+                for message_type, body in messages:
+                    try:
+                        self.handle_control(agent, message_type, body)
+                    except ValueError as ex:
+                        # Only that message is dropped, the loop serves every client
+                        logger.warning("From {}: {}".format(agent.addr, ex))
+
+            for agent in registered - set(self.agents):
+                registered.remove(agent)
+                if agent.tcp_sock in selector.get_map():
+                    selector.unregister(agent.tcp_sock)
+
+        selector.close()
+
+    def handle_control(self, agent, message_type, body):
+        is_NACK = message_type in (CONTROL_NACK, CONTROL_NACK_2)
+        if is_NACK and self.sender_pool is not None:
+            self.sender_pool.forward_NACK(agent.addr, message_type, body)
+        elif is_NACK:
+            serial, indices, tail = decode_NACK(body, message_type)
+            packets = self.retransmit_cache.get_packets(serial, indices, tail)
+            if packets:
+                agent.enqueue_retransmit(packets)
+        elif message_type == CONTROL_REPORT:
+            report = Report.decode(body)
+            logger.debug("Report from {}: {}".format(agent.addr, report))
+            if self.use_ABR and self.simulcast is not None:
+                level = agent.ABR.update(report)
+                if not self.simulcast.is_pinned(agent.addr):
+                    self.set_tier(agent, level)
+            elif self.use_ABR:
+                agent.ABR.update(report)
+                self.update_level()
+        elif message_type == CONTROL_TIER and self.simulcast is not None:
+            tier = decode_tier(body)
+            if tier < 0:
+                self.set_tier(agent, agent.ABR.get_level())
+            else:
+                self.set_tier(agent, tier, pinned=True)
+        elif message_type == CONTROL_FULL_FRAME:
+            # The client lost tile frames, its output is stale until a full frame
+            if self.tile_encoder is not None:
+                self.tile_encoder.force()
+            if self.change_detector is not None:
+                self.change_detector.force()
+        else:
+            logger.warning("Unknown control message {}".format(message_type))
+
+    def set_tier(self, agent, tier, pinned=False):
+        if self.simulcast.subscribe(agent.addr, tier, pinned):
+            if self.change_detector is not None:
+                self.change_detector.force()  # The new tier needs a frame
+            logger.info(
+                "{} moved to tier {}".format(
+                    agent.addr, self.simulcast.get_tier(agent.addr)
+                )
+            )
+
+    def update_level(self):
+        """runs the stream at the level of the client with the worst link"""
+        levels = [agent.ABR.get_level() for agent in self.agents]
+        level = min(levels) if levels else len(ABR_LEVELS) - 1
+        if level != self.level:
+            self.set_level(level)
+
+    def set_level(self, level):
+        resolution_scale, quality_scale, fps_scale = ABR_LEVELS[level]
+        self.level = level
+        self.res_w = int(self.max_res_w * resolution_scale) // 2 * 2
+        self.res_h = int(self.max_res_h * resolution_scale) // 2 * 2
+        self.encode_param = [
+            int(cv2.IMWRITE_JPEG_QUALITY),
+            int(self.max_quality * quality_scale),
+        ]
+        self.fps = max(1, round(self.max_fps * fps_scale))
+        self.frame_devider = max(1, round(30 / self.fps))
+        if self.change_detector is not None:
+            self.change_detector.force()  # Clients see the new level right away
+        print(
+            "Quality level {}: {}x{}, quality {}, {} fps".format(
+                level, self.res_w, self.res_h, self.encode_param[1], self.fps
+            )
+        )
+
     def handle_client(self, agent):
         while self.RUN:
             pass
@@ -112,75 +427,239 @@ class ServerService:
             self.capture()
 
     def capture(self):
-        """captures video from the camera
-
-        :param fps: how many frames per second the camera will capture
-        :type fps: int
-        :param res_h: height of the frame
-        :type res_h: int
-        :param res_w: width of the frame
-        :type res_w: int
+        """captures video from the camera into the frame slot
+
+        Frames skipped by frame_devider are only grabbed, so only the kept
+        frames are decoded. The camera is not read while no client is
+        connected. Kept frames that did not change since the last sent one
+        are not encoded, the clients get a repeat packet instead, sent in
+        capture order by the stream thread.
         """
         index = -1
         while self.RUN:
-            if keyboard.is_pressed("q"):
-                self.stop()
-                continue
+            self.lock.acquire()
+            while self.RUN and len(self.agents) == 0:
+                self.agents_changed.wait()
+            self.lock.release()
 
-            if len(self.agents) == 0:
-                continue
-            _, frame = self.cam.read()
             index += 1
             if not index % self.frame_devider == 0:
+                self.cam.grab()
                 continue
 
-            status, data = self.encode_frame(frame)
-            if not status:
+            start_time = time.perf_counter()
+            status, frame = self.cam.read()
+            if status:
+                self.stage_times.add("capture", time.perf_counter() - start_time)
+                if self.is_changed(frame):
+                    self.frame_slot.publish(frame)
+                else:
+                    self.pipeline.repeat()
+
+    def is_changed(self, frame) -> bool:
+        if self.change_detector is None:
+            return True
+        start_time = time.perf_counter()
+        changed = self.change_detector.is_changed(frame)
+        self.stage_times.add("detect", time.perf_counter() - start_time)
+        return changed
+
+    def send_repeat(self):
+        """tells every agent to show the last frame again"""
+        if self.local_sender is not None and self.local_sender.has_clients():
+            self.local_sender.publish_repeat(self.last_serial)
+        if self.sender_pool is not None:
+            self.sender_pool.publish_repeat(self.last_serial, 1.0 / self.fps)
+            return
+        packet = build_repeat(self.last_serial, self.version)
+        for agent in self.get_receivers():
+            agent.enqueue_repeat(packet)
+
+    def stream(self):
+        """packetizes the encoded frames in capture order and sends them to every agent
+
+        In multicast mode every frame is sent once, to the group. With sender
+        processes the frame is only written to their ring. Clients on this
+        host get the encoded frame through shared memory, not packetized.
+        """
+        while self.RUN:
+            data, index = self.pipeline.get()
+            if index == -1:
+                continue
+            if not data:
+                self.send_repeat()  # Unchanged frame, or no tile changed
                 continue
-            data = Data(data)
-            logger.info("Sending {}".format(data))
-            for_remove = []
-            for agent in self.agents:
-                if not agent.is_alive():
-                    for_remove.append(agent)
-                agent.send_data(data.clone())
-
-            if len(for_remove) > 0:
-                self.lock.acquire()
-                print("Removing agents: {}".format(for_remove))
-                self.agents = [
-                    agent for agent in self.agents if agent not in for_remove
-                ]
-                self.lock.release()
+
+            start_time = time.perf_counter()
+            if self.local_sender is not None and self.local_sender.has_clients():
+                if not self.local_sender.publish(data, self.serial):
+                    logger.warning(
+                        "{} bytes do not fit in a ring slot".format(len(data))
+                    )
+            if self.simulcast is not None:
+                self.send_tiers(data)
+            elif self.sender_pool is not None:
+                self.publish(data)
+            elif self.get_receivers():
+                self.send(data)
+            else:
+                self.next_serial()  # Every client is local
+            self.stage_times.add("send", time.perf_counter() - start_time)
+            self.remove_closed_agents()
+
+    def send(self, data):
+        """packetizes an encoded frame once and queues it on every receiver"""
+        frame = self.packetize(data)
+        if frame is None:
+            return
+        receivers = self.get_receivers()
+        self.pacer.spread(frame.get_wire_size() * len(receivers), 1.0 / self.fps)
+        for agent in receivers:
+            agent.enqueue_frame(frame)
+
+    def send_tiers(self, encoded):
+        """packetizes every tier of a frame once and queues it on the tier's subscribers
+
+        Every tier frame has its own serial, so NACKs find the right one.
+        """
+        receivers = self.get_receivers()
+        frames = []
+        for tier, data in encoded:
+            frame = self.packetize(data)
+            if frame is None:
+                continue
+            subscribers = [
+                agent
+                for agent in receivers
+                if self.simulcast.get_tier(agent.addr) == tier
+            ]
+            frames.append((frame, subscribers))
+        self.pacer.spread(
+            sum(
+                frame.get_wire_size() * len(subscribers)
+                for frame, subscribers in frames
+            ),
+            1.0 / self.fps,
+        )
+        for frame, subscribers in frames:
+            for agent in subscribers:
+                agent.enqueue_frame(frame)
+
+    def packetize(self, data) -> PacketizedFrame:
+        """splits an encoded frame into packets under the next serial
+
+        :return: the frame, None when it does not fit in packets
+        :rtype: PacketizedFrame
+        """
+        data = Data(data)
+        logger.info("Sending {}".format(data))
+        try:
+            frame = PacketizedFrame(
+                data,
+                self.serial,
+                self.FEC_flag,
+                self.SEC_flag,
+                self.FEC_ratio,
+                self.packet_size,
+                self.version,
+            )
+        except ValueError as ex:
+            logger.warning(ex)
+            return None
+        self.next_serial()
+        self.retransmit_cache.add(frame)
+        return frame
+
+    def publish(self, data):
+        """writes an encoded frame to the sender processes' ring"""
+        if not self.sender_pool.publish(data, self.serial, 1.0 / self.fps):
+            logger.warning("{} bytes do not fit in a ring slot".format(len(data)))
+            return
+        self.next_serial()
+
+    def next_serial(self):
+        self.last_serial = self.serial
+        self.serial = self.serial % get_max_serial(self.version) + 1
+
+    def remove_closed_agents(self):
+        for_remove = [agent for agent in self.agents if not agent.is_alive()]
+        if len(for_remove) > 0:
+            self.lock.acquire()
+            print("Removing agents: {}".format(for_remove))
+            for agent in for_remove:
+                agent.stop_sender()
+                if self.sender_pool is not None:
+                    self.sender_pool.remove_agent(agent.addr)
+                if self.local_sender is not None:
+                    self.local_sender.remove_client(agent.addr)
+                if self.simulcast is not None:
+                    self.simulcast.unsubscribe(agent.addr)
+            self.agents = [agent for agent in self.agents if agent not in for_remove]
+            self.lock.release()
 
     def encode_frame(self, frame):
         """compress frame to lower quailty
 
+        In tile mode the result is empty when no tile changed. In strip mode
+        it is a strip frame. With simulcast it is a list of (tier, encoded
+        frame) for every tier in use.
+
         :param frame: cv2 frame
         :type frame: np array
         """
         try:
+            if self.simulcast is not None:
+                return True, self.simulcast.encode(frame, self.encode_resized)
             resized = cv2.resize(frame, (self.res_w, self.res_h), cv2.INTER_AREA)
-
-            _, encoded_frame = cv2.imencode(".jpg", resized, self.encode_param)
-            #  tmp = cv2.imdecode(encoded_frame, 1)
-            #  cv2.imshow("Preview Server", tmp)
-            #  cv2.waitKey(1)
-            return True, encoded_frame.tobytes()
+            if self.tile_encoder is not None:
+                return True, self.tile_encoder.encode(resized, self.encode_param)
+            return True, self.encode_resized(resized, self.encode_param)
         except Exception as ex:
             logger.exception("Error while resizing and encoding")
 
         return False, b""
 
+    def encode_resized(self, resized, encode_param) -> bytes:
+        """encodes a frame already at its sent size as a JPEG or a strip frame"""
+        if self.strip_encoder is not None:
+            return self.strip_encoder.encode(resized, encode_param)
+
+        _, encoded_frame = cv2.imencode(".jpg", resized, encode_param)
+        #  tmp = cv2.imdecode(encoded_frame, 1)
+        #  cv2.imshow("Preview Server", tmp)
+        #  cv2.waitKey(1)
+        return encoded_frame.tobytes()
+
     def print_analytics(self):
         sleep_time = 5.0
         while self.RUN:
             time.sleep(sleep_time)
             analytics = Analytics()
-            for agent in self.agents:
-                data = agent.get_analytics()
+            senders = [
+                (agent.addr, agent.get_analytics(), agent.get_queue_depth())
+                for agent in self.agents
+            ]
+            if self.sender_pool is not None:
+                senders = self.sender_pool.get_analytics()
+            if self.local_sender is not None:
+                senders.append(("local", self.local_sender.get_analytics(), 0))
+            if self.multicast_agent is not None:
+                agent = self.multicast_agent
+                senders.append(
+                    (agent.addr, agent.get_analytics(), agent.get_queue_depth())
+                )
+            for addr, data, queue_depth in senders:
                 analytics.add_frames_sent(data.get_frames_sent())
                 analytics.add_packets_sent(data.get_packets_sent())
+                analytics.add_bytes_sent(data.get_bytes_sent())
+                analytics.add_frames_dropped(data.get_frames_dropped())
+                analytics.add_packets_retransmitted(data.get_packets_retransmitted())
+                analytics.add_frames_repeated(data.get_frames_repeated())
+                print(
+                    "Agent {}: Queue Depth: {}, Dropped Frames: {}".format(
+                        addr, queue_depth, data.get_frames_dropped()
+                    )
+                )
                 data.reset()
             print(
                 "Frame Per Second Send Overall: {}".format(
@@ -193,6 +672,39 @@ class ServerService:
                         analytics.get_frames_sent() / sleep_time / len(self.agents)
                     )
                 )
+            print("Dropped Frames Overall: {}".format(analytics.get_frames_dropped()))
+            captured = self.frame_slot.get_analytics()
+            print(
+                "Captured Frames: {}, Replaced Before Encoding: {}".format(
+                    captured.get_frames_received(), captured.get_frames_dropped()
+                )
+            )
+            captured.reset()
+            encoding, encoded = self.pipeline.get_queue_depths()
+            print(
+                "Queue Depth: Slot: {}, Encoding: {}, Waiting To Send: {}".format(
+                    int(self.frame_slot.is_full()), encoding, encoded
+                )
+            )
+            print(
+                "Stage Times: Capture: {} ms, Detect: {} ms, Encode: {} ms, Send: {} ms".format(
+                    self.stage_times.get_average("capture"),
+                    self.stage_times.get_average("detect"),
+                    self.stage_times.get_average("encode"),
+                    self.stage_times.get_average("send"),
+                )
+            )
+            self.stage_times.reset()
+            if self.simulcast is not None:
+                print("Tier Subscribers: {}".format(self.simulcast.get_subscribers()))
+            else:
+                print("Quality Level: {}".format(self.level))
+            print("Repeated Frames: {}".format(analytics.get_frames_repeated()))
+            print(
+                "Packets Retransmitted: {}".format(
+                    analytics.get_packets_retransmitted()
+                )
+            )
             print(
                 "Packet Per Second Send Overall: {}".format(
                     analytics.get_packets_sent() / sleep_time
@@ -209,6 +721,14 @@ class ServerService:
                     analytics.get_bits_sent() / sleep_time / 1000000
                 )
             )
+            pacing = self.pacer.get_analytics()
+            print(
+                "Pacing Rate: {} Mbps achieved, {} Mbps target".format(
+                    pacing.get_achieved_rate() * 8 / 1000000,
+                    pacing.get_target_rate() * 8 / 1000000,
+                )
+            )
+            pacing.reset()
             print("")
             analytics.reset()
 
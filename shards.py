@@ -0,0 +1,326 @@
+import copy
+import logging
+import multiprocessing
+import queue
+import socket
+
+from threading import Lock, Thread
+from protocol import Agent, Data, PacketizedFrame, RetransmitCache
+from pacer import Pacer
+from control import decode_NACK
+from codec import build_repeat
+from ring import FrameRing
+from constents import *
+
+logger = logging.getLogger(__name__)
+
+# Spawned, forking a server with running threads can deadlock the child
+_context = multiprocessing.get_context("spawn")
+
+
+class SenderRing(FrameRing):
+    """a FrameRing whose readers, the sender processes, can wait for frames"""
+
+    def __init__(self, slots=RING_SLOTS, slot_size=RING_SLOT_SIZE):
+        super().__init__(slots, slot_size)
+        self.condition = _context.Condition()
+
+    def __getstate__(self):
+        return self.get_name(), self.condition
+
+    def __setstate__(self, state):
+        name, self.condition = state
+        FrameRing.__init__(self, name=name)
+
+    def write(self, data, serial, interval=0.0) -> int:
+        """writes a frame and wakes the readers"""
+        self.condition.acquire()
+        sequence = super().write(data, serial, interval)
+        self.condition.notify_all()
+        self.condition.release()
+        return sequence
+
+    def wait(self, sequence, timeout=None) -> int:
+        """waits until frame sequence was written
+
+        :return: the sequence of the newest frame, smaller than sequence on timeout
+        :rtype: int
+        """
+        self.condition.acquire()
+        if self.get_head() < sequence:
+            self.condition.wait(timeout)
+        head = self.get_head()
+        self.condition.release()
+        return head
+
+
+class SenderShard:
+    """packetizes the frames in the ring and sends them to its own clients
+
+    Runs in a sender process. Every shard builds the packets of a frame
+    once and keeps them for retransmissions, so NACKs of its clients are
+    answered without the main process.
+    Commands come from the main process as tuples on a queue.
+    """
+
+    def __init__(
+        self,
+        ring: SenderRing,
+        commands,
+        replies,
+        packet_size=PACKET_SIZE,
+        FEC_flag=FEC_OFF_FLAG,
+        FEC_ratio=None,
+        pacing_rate=None,
+        pacing_burst=PACING_BURST,
+        version=VERSION_1_FLAG,
+    ):
+        self.ring = ring
+        self.commands = commands
+        self.replies = replies
+        self.packet_size = packet_size
+        self.FEC_flag = FEC_flag
+        self.FEC_ratio = FEC_ratio
+        self.version = version
+        self.RUN = True
+        self.lock = Lock()
+        self.agents = dict()  # Agents by address
+
+        self.UDP_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.UDP_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 131072)
+        self.pacer = Pacer(pacing_rate, pacing_burst)
+        self.retransmit_cache = RetransmitCache()
+
+    def run(self):
+        command_thread = Thread(target=self.read_commands)
+        command_thread.start()
+
+        sequence = self.ring.get_head() + 1
+        while self.RUN:
+            head = self.ring.wait(sequence, 0.5)
+            if head < sequence:
+                continue
+            if head - sequence >= self.ring.slots:
+                # Lapped by the writer, those frames are gone
+                self.drop_frames(head - self.ring.slots + 1 - sequence)
+                sequence = head - self.ring.slots + 1
+            while sequence <= head:
+                self.send(sequence)
+                sequence += 1
+
+        command_thread.join()
+        self.lock.acquire()
+        for agent in self.agents.values():
+            agent.stop_sender()
+        self.agents = dict()
+        self.lock.release()
+        self.UDP_sock.close()
+        self.ring.close()
+
+    def get_agents(self) -> list:
+        self.lock.acquire()
+        agents = list(self.agents.values())
+        self.lock.release()
+        return agents
+
+    def drop_frames(self, amount):
+        for agent in self.get_agents():
+            agent.get_analytics().add_frames_dropped(amount)
+
+    def send(self, sequence):
+        item = self.ring.read(sequence)
+        if item is None:
+            self.drop_frames(1)
+            return
+        serial, data, interval = item
+        agents = self.get_agents()
+        if len(data) == 0:
+            packet = build_repeat(serial, self.version)
+            for agent in agents:
+                agent.enqueue_repeat(packet)
+            return
+
+        try:
+            frame = PacketizedFrame(
+                Data(data),
+                serial,
+                self.FEC_flag,
+                SEC_OFF_FLAG,
+                self.FEC_ratio,
+                self.packet_size,
+                self.version,
+            )
+        except ValueError as ex:
+            logger.warning(ex)
+            return
+        if not self.ring.is_valid(sequence):
+            self.drop_frames(1)  # Overwritten while it was packetized
+            return
+        self.retransmit_cache.add(frame)
+        self.pacer.spread(frame.get_wire_size() * len(agents), interval)
+        for agent in agents:
+            agent.enqueue_frame(frame)
+
+    def read_commands(self):
+        while self.RUN:
+            command = self.commands.get()
+            name = command[0]
+            if name == "add":
+                _, addr, fps = command
+                agent = Agent(
+                    self.UDP_sock,
+                    None,
+                    addr,
+                    fps,
+                    pacer=self.pacer,
+                    packet_size=self.packet_size,
+                )
+                agent.start_sender()
+                self.lock.acquire()
+                self.agents[addr] = agent
+                self.lock.release()
+            elif name == "remove":
+                self.lock.acquire()
+                agent = self.agents.pop(command[1], None)
+                self.lock.release()
+                if agent is not None:
+                    agent.stop_sender()
+            elif name == "NACK":
+                _, addr, message_type, body = command
+                try:
+                    serial, indices, tail = decode_NACK(body, message_type)
+                except ValueError as ex:
+                    logger.warning("From {}: {}".format(addr, ex))
+                    continue
+                packets = self.retransmit_cache.get_packets(serial, indices, tail)
+                self.lock.acquire()
+                agent = self.agents.get(addr)
+                self.lock.release()
+                if agent is not None and packets:
+                    agent.enqueue_retransmit(packets)
+            elif name == "analytics":
+                self.replies.put(self.get_analytics())
+            elif name == "stop":
+                self.RUN = False
+
+    def get_analytics(self) -> list:
+        """(address, analytics, queue depth) of every agent, counters are reset"""
+        analytics = []
+        for agent in self.get_agents():
+            data = agent.get_analytics()
+            analytics.append((agent.addr, copy.copy(data), agent.get_queue_depth()))
+            data.reset()
+        return analytics
+
+
+def run_shard(*args):
+    SenderShard(*args).run()
+
+
+class SenderPool:
+    """spreads the clients of a server across sender processes
+
+    The main process only writes every encoded frame to a FrameRing, the
+    sender processes packetize and send it to their clients, so sending is
+    not bound by the main process' GIL. A new client goes to the process
+    with the fewest clients.
+    """
+
+    def __init__(
+        self,
+        processes=SENDER_PROCESSES,
+        packet_size=PACKET_SIZE,
+        FEC_flag=FEC_OFF_FLAG,
+        FEC_ratio=None,
+        pacing_rate=None,
+        pacing_burst=PACING_BURST,
+        slots=RING_SLOTS,
+        slot_size=RING_SLOT_SIZE,
+        version=VERSION_1_FLAG,
+    ):
+        self.ring = SenderRing(slots, slot_size)
+        self.lock = Lock()
+        self.owners = dict()  # Index of the process sending to an address
+        self.loads = [0] * processes
+        self.commands = [_context.Queue() for _ in range(processes)]
+        self.replies = _context.Queue()
+        # Every process paces its share of the rate
+        if pacing_rate is not None:
+            pacing_rate = float(pacing_rate) / processes
+        self.processes = [
+            _context.Process(
+                target=run_shard,
+                args=(
+                    self.ring,
+                    commands,
+                    self.replies,
+                    packet_size,
+                    FEC_flag,
+                    FEC_ratio,
+                    pacing_rate,
+                    pacing_burst,
+                    int(version),
+                ),
+                daemon=True,
+            )
+            for commands in self.commands
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def stop(self):
+        for commands in self.commands:
+            commands.put(("stop",))
+        for process in self.processes:
+            process.join()
+        self.ring.close()
+        self.ring.unlink()
+
+    def add_agent(self, addr, fps):
+        self.lock.acquire()
+        index = self.loads.index(min(self.loads))
+        self.owners[addr] = index
+        self.loads[index] += 1
+        self.lock.release()
+        self.commands[index].put(("add", addr, fps))
+
+    def remove_agent(self, addr):
+        self.lock.acquire()
+        index = self.owners.pop(addr, None)
+        if index is not None:
+            self.loads[index] -= 1
+        self.lock.release()
+        if index is not None:
+            self.commands[index].put(("remove", addr))
+
+    def forward_NACK(self, addr, message_type, body):
+        """lets the process sending to addr answer its NACK"""
+        index = self.owners.get(addr)
+        if index is not None:
+            self.commands[index].put(("NACK", addr, message_type, body))
+
+    def publish(self, data, serial, interval) -> bool:
+        """hands an encoded frame to every sender process
+
+        :return: False if the frame does not fit in a ring slot
+        :rtype: bool
+        """
+        return self.ring.write(data, serial, interval) != 0
+
+    def publish_repeat(self, serial, interval):
+        """tells every client to show the last frame again"""
+        self.ring.write(b"", serial, interval)
+
+    def get_analytics(self, timeout=1.0) -> list:
+        """(address, analytics, queue depth) of every client, counters are reset"""
+        for commands in self.commands:
+            commands.put(("analytics",))
+        analytics = []
+        for _ in self.commands:
+            try:
+                analytics.extend(self.replies.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return analytics
@@ -0,0 +1,114 @@
+import binascii
+import cv2
+import struct
+
+from codec import get_chunk_size, get_first_chunk_size
+from constents import *
+
+# Magic, Frame Width, Frame Height, First Row, JPEG Length, JPEG CRC,
+# followed by the JPEG
+STRIP_HEADER = struct.Struct("<4sHHHII")
+STRIP_MAGIC = b"STRP"  # JPEGs start with FF D8 and tile frames with TILE
+
+
+def is_strips(data) -> bool:
+    return bytes(data[: len(STRIP_MAGIC)]) == STRIP_MAGIC
+
+
+def read_strips(data):
+    """finds the strips that arrived intact in a strip frame
+
+    Missing chunks of a partial frame are zeroed, so strips are found by
+    their magic and only kept when their CRC matches.
+
+    :return: a list of (frame width, frame height, first row, JPEG) for
+        every intact strip
+    :rtype: list
+    """
+    data = bytes(data)
+    view = memoryview(data)
+    strips = []
+    position = data.find(STRIP_MAGIC)
+    while position != -1 and position + STRIP_HEADER.size <= len(data):
+        _, width, height, row, length, CRC = STRIP_HEADER.unpack_from(data, position)
+        start = position + STRIP_HEADER.size
+        jpeg = view[start : start + length]
+        if len(jpeg) == length and binascii.crc32(jpeg) == CRC:
+            strips.append((width, height, row, jpeg))
+            position = data.find(STRIP_MAGIC, start + length)
+        else:
+            position = data.find(STRIP_MAGIC, position + 1)  # A lost strip
+    return strips
+
+
+class StripEncoder:
+    """encodes a frame as horizontal strips that are decoded on their own
+
+    Every strip_height rows are a separate JPEG, so a lost packet only
+    loses the strips it carried and the client shows the previous frame's
+    rows there instead of dropping the frame.
+    A strip is moved to the start of the next packet when that makes it
+    span fewer packets and leaves at most max_padding of a packet empty,
+    so a lost packet takes few strips with it without sending much padding.
+    This needs the chunk sizes of the stream's packets.
+    """
+
+    def __init__(
+        self,
+        packet_size=PACKET_SIZE,
+        FEC_flag=FEC_OFF_FLAG,
+        strip_height=STRIP_HEIGHT,
+        max_padding=STRIP_MAX_PADDING,
+        version=VERSION_1_FLAG,
+    ):
+        self.chunk_size = get_chunk_size(packet_size, FEC_flag, version)
+        self.first_chunk_size = get_first_chunk_size(packet_size, FEC_flag, version)
+        self.strip_height = strip_height
+        self.max_padding = int(max_padding * self.chunk_size)
+
+    def get_chunk(self, position) -> int:
+        """index of the chunk that carries the frame byte at position"""
+        if position < self.first_chunk_size:
+            return 0
+        return 1 + (position - self.first_chunk_size) // self.chunk_size
+
+    def get_chunk_start(self, index) -> int:
+        if index == 0:
+            return 0
+        return self.first_chunk_size + (index - 1) * self.chunk_size
+
+    def get_padding(self, position, length) -> int:
+        """bytes to skip at position so length bytes span as few chunks as they can"""
+        chunk = self.get_chunk(position)
+        start = self.get_chunk_start(chunk + 1)
+        spanned = self.get_chunk(position + length - 1) - chunk
+        if spanned <= self.get_chunk(start + length - 1) - (chunk + 1):
+            return 0
+        if start - position > self.max_padding:
+            return 0
+        return start - position
+
+    def encode(self, frame, encode_param) -> bytes:
+        """encodes every strip of a frame
+
+        :return: the strip frame
+        :rtype: bytes
+        """
+        height, width = frame.shape[:2]
+        parts = []
+        position = 0
+        for row in range(0, height, self.strip_height):
+            _, encoded = cv2.imencode(
+                ".jpg", frame[row : row + self.strip_height], encode_param
+            )
+            jpeg = encoded.tobytes()
+            header = STRIP_HEADER.pack(
+                STRIP_MAGIC, width, height, row, len(jpeg), binascii.crc32(jpeg)
+            )
+            length = len(header) + len(jpeg)
+            padding = self.get_padding(position, length)
+            parts.append(bytes(padding))
+            parts.append(header)
+            parts.append(jpeg)
+            position += padding + length
+        return b"".join(parts)
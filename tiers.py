@@ -0,0 +1,95 @@
+import cv2
+
+from threading import Lock
+from constents import *
+
+
+class Simulcast:
+    """encodes every frame once per tier that has subscribers
+
+    Tiers are (width, height, JPEG quality), lowest first like ABR_LEVELS.
+    Every client subscribes to one tier and all subscribers of a tier get
+    the same encoded frame, so encoding grows with the tiers in use and
+    not with the clients. A client either picked its tier, which pins it
+    there, or follows its ABR level.
+    """
+
+    def __init__(self, tiers=SIMULCAST_TIERS):
+        self.tiers = tiers
+        self.lock = Lock()
+        self.subscriptions = dict()  # Tier by address
+        self.pinned = set()  # Addresses that picked their tier
+
+    def get_tiers(self) -> int:
+        return len(self.tiers)
+
+    def subscribe(self, addr, tier, pinned=False) -> bool:
+        """moves a client to a tier, clamped to the configured ones
+
+        :return: True if the client changed tiers
+        :rtype: bool
+        """
+        tier = min(max(tier, 0), len(self.tiers) - 1)
+        self.lock.acquire()
+        changed = self.subscriptions.get(addr) != tier
+        self.subscriptions[addr] = tier
+        if pinned:
+            self.pinned.add(addr)
+        else:
+            self.pinned.discard(addr)
+        self.lock.release()
+        return changed
+
+    def unsubscribe(self, addr):
+        self.lock.acquire()
+        self.subscriptions.pop(addr, None)
+        self.pinned.discard(addr)
+        self.lock.release()
+
+    def is_pinned(self, addr) -> bool:
+        return addr in self.pinned
+
+    def get_tier(self, addr) -> int:
+        """the tier of a client, -1 if it is not subscribed"""
+        return self.subscriptions.get(addr, -1)
+
+    def get_active(self) -> list:
+        """tiers with at least one subscriber, lowest first"""
+        self.lock.acquire()
+        active = sorted(set(self.subscriptions.values()))
+        self.lock.release()
+        return active
+
+    def get_subscribers(self) -> list:
+        """amount of clients on every tier"""
+        self.lock.acquire()
+        subscribers = [0] * len(self.tiers)
+        for tier in self.subscriptions.values():
+            subscribers[tier] += 1
+        self.lock.release()
+        return subscribers
+
+    def encode(self, frame, encode) -> list:
+        """encodes a frame for every tier in use
+
+        Every tier is resized from the next larger tier in use instead of
+        the captured frame, which reads fewer pixels.
+
+        :param encode: takes a resized frame and its encode params and
+            returns the encoded frame
+        :type encode: function
+        :return: (tier, encoded frame) of every tier in use, highest first
+        :rtype: list
+        """
+        encoded = []
+        resized = frame
+        for tier in reversed(self.get_active()):
+            width, height, quality = self.tiers[tier]
+            if resized.shape[1] != width or resized.shape[0] != height:
+                resized = cv2.resize(
+                    resized, (width, height), interpolation=cv2.INTER_AREA
+                )
+            encoded.append(
+                (tier, encode(resized, [int(cv2.IMWRITE_JPEG_QUALITY), quality]))
+            )
+        return encoded
@@ -0,0 +1,125 @@
+import cv2
+import struct
+import time
+import numpy as np
+
+from constents import *
+
+# Magic, Frame Width, Frame Height, Tile Size, Amount of Tiles
+TILE_HEADER = struct.Struct("<4sHHHH")
+# Column, Row, JPEG Length, followed by the JPEG
+TILE_ENTRY = struct.Struct("<HHI")
+TILE_MAGIC = b"TILE"  # JPEGs start with FF D8, so the two never mix up
+
+
+def is_tiles(data) -> bool:
+    return bytes(data[: len(TILE_MAGIC)]) == TILE_MAGIC
+
+
+def read_tiles(data):
+    """splits a tile frame into its tiles
+
+    :return: frame width, frame height, tile size and a list of
+        (column, row, JPEG) for every tile
+    :rtype: tuple
+    """
+    view = memoryview(data)
+    _, width, height, tile_size, amount = TILE_HEADER.unpack_from(view)
+    tiles = []
+    read_bytes = TILE_HEADER.size
+    for _ in range(amount):
+        column, row, length = TILE_ENTRY.unpack_from(view, read_bytes)
+        read_bytes += TILE_ENTRY.size
+        tiles.append((column, row, view[read_bytes : read_bytes + length]))
+        read_bytes += length
+    return width, height, tile_size, tiles
+
+
+class TileEncoder:
+    """encodes only the tiles of a frame that changed since they were last sent
+
+    The frame is split into a grid of tile_size squares. A tile is dirty
+    when any of its pixels differs from the last sent version of that tile
+    by more than threshold. Dirty tiles are encoded as separate JPEGs and
+    sent as a tile frame, the client pastes them onto the previous frame.
+    A full JPEG is sent every refresh_interval seconds, when the frame size
+    changes, or when most tiles are dirty anyway.
+    The encoder keeps state between frames, so frames have to be encoded
+    one at a time and in order.
+    """
+
+    def __init__(
+        self,
+        tile_size=TILE_SIZE,
+        threshold=TILE_THRESHOLD,
+        max_dirty=TILE_MAX_DIRTY,
+        refresh_interval=TILE_REFRESH_INTERVAL,
+    ):
+        self.tile_size = tile_size
+        self.threshold = threshold
+        self.max_dirty = max_dirty
+        self.refresh_interval = refresh_interval
+        self.reference = None  # Grayscale of what the clients have
+        self.last_refresh_time = 0.0
+        self.forced = False
+
+    def force(self):
+        """makes the next frame a full frame"""
+        self.forced = True
+
+    def encode(self, frame, encode_param) -> bytes:
+        """encodes a frame as a full JPEG or as a tile frame
+
+        :return: the encoded frame, empty when no tile changed
+        :rtype: bytes
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        current_time = time.time()
+        if (
+            self.forced
+            or self.reference is None
+            or self.reference.shape != gray.shape
+            or current_time - self.last_refresh_time >= self.refresh_interval
+        ):
+            return self._encode_full(frame, gray, encode_param, current_time)
+
+        dirty = self.get_dirty(gray)
+        if dirty.mean() > self.max_dirty:
+            return self._encode_full(frame, gray, encode_param, current_time)
+
+        rows, columns = np.nonzero(dirty)
+        if len(rows) == 0:
+            return b""
+
+        size = self.tile_size
+        height, width = gray.shape
+        parts = [TILE_HEADER.pack(TILE_MAGIC, width, height, size, len(rows))]
+        for row, column in zip(rows, columns):
+            tile = (
+                slice(row * size, (row + 1) * size),
+                slice(column * size, (column + 1) * size),
+            )
+            _, encoded = cv2.imencode(".jpg", frame[tile], encode_param)
+            self.reference[tile] = gray[tile]
+            parts.append(TILE_ENTRY.pack(column, row, len(encoded)))
+            parts.append(encoded.tobytes())
+        return b"".join(parts)
+
+    def _encode_full(self, frame, gray, encode_param, current_time) -> bytes:
+        self.forced = False
+        self.reference = gray
+        self.last_refresh_time = current_time
+        _, encoded = cv2.imencode(".jpg", frame, encode_param)
+        return encoded.tobytes()
+
+    def get_dirty(self, gray):
+        """returns a (rows, columns) bool array of the tiles that changed"""
+        size = self.tile_size
+        height, width = gray.shape
+        rows = -(-height // size)
+        columns = -(-width // size)
+        diff = np.zeros((rows * size, columns * size), dtype=np.uint8)
+        cv2.absdiff(gray, self.reference, dst=diff[:height, :width])
+        # Reducing the rows of every tile first keeps the memory access linear
+        diff = diff.reshape(rows, size, columns * size).max(axis=1)
+        return diff.reshape(rows, columns, size).max(axis=2) > self.threshold